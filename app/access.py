@@ -0,0 +1,251 @@
+"""
+Materialized user -> VSN access.
+
+Access is derived from project memberships: develop and schedule require both the user and node
+membership permission, files only requires the user membership permission. Computing this on every
+request takes several join queries, so the result is stored in UserAccess and rebuilt per user
+whenever a membership changes.
+"""
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+from django.db import transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import User, Node, Project, UserMembership, NodeMembership, UserAccess
+
+
+def compute_user_access(user_ids=None):
+    """
+    Compute access for the given user ids, or all users if user_ids is None, in two queries.
+    Returns a dict mapping user id to a dict mapping node id to set of access types.
+    """
+    user_memberships = UserMembership.objects.all()
+    node_memberships = NodeMembership.objects.all()
+
+    if user_ids is not None:
+        user_memberships = user_memberships.filter(user_id__in=user_ids)
+        node_memberships = node_memberships.filter(
+            project__in=user_memberships.values("project_id")
+        )
+
+    nodes_by_project = defaultdict(list)
+    for project_id, node_id, can_develop, can_schedule in node_memberships.values_list(
+        "project_id", "node_id", "can_develop", "can_schedule"
+    ):
+        nodes_by_project[project_id].append((node_id, can_develop, can_schedule))
+
+    access_by_user = defaultdict(lambda: defaultdict(set))
+
+    for (
+        user_id,
+        project_id,
+        can_develop,
+        can_schedule,
+        can_access_files,
+    ) in user_memberships.values_list(
+        "user_id", "project_id", "can_develop", "can_schedule", "can_access_files"
+    ):
+        for node_id, node_can_develop, node_can_schedule in nodes_by_project[
+            project_id
+        ]:
+            if can_develop and node_can_develop:
+                access_by_user[user_id][node_id].add("develop")
+            if can_schedule and node_can_schedule:
+                access_by_user[user_id][node_id].add("schedule")
+            if can_access_files:
+                access_by_user[user_id][node_id].add("files")
+
+    return access_by_user
+
+
+def rebuild_user_access(user_ids=None):
+    """
+    Rebuild the materialized access rows for the given user ids, or all users if user_ids is None.
+    """
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        if not user_ids:
+            return
+
+    access_by_user = compute_user_access(user_ids)
+
+    rows = [
+        UserAccess(user_id=user_id, node_id=node_id, access=access)
+        for user_id, access_by_node in access_by_user.items()
+        for node_id, access_types in access_by_node.items()
+        for access in access_types
+    ]
+
+    with transaction.atomic():
+        stale = UserAccess.objects.all()
+        if user_ids is not None:
+            stale = stale.filter(user_id__in=user_ids)
+        stale.delete()
+        UserAccess.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+def get_user_access_by_vsn(user):
+    """
+    Return user's access permissions per VSN from the materialized access table.
+    Returns a defaultdict mapping VSN to set of access types.
+    """
+    access_by_vsn = defaultdict(set)
+
+    for vsn, access in UserAccess.objects.filter(user=user).values_list(
+        "node__vsn", "access"
+    ):
+        access_by_vsn[vsn].add(access)
+
+    return access_by_vsn
+
+
+def compute_user_access_by_vsn(user):
+    """
+    Calculate user's access permissions per VSN directly from project memberships.
+    Returns a defaultdict mapping VSN to set of access types.
+    """
+    access_by_vsn = defaultdict(set)
+
+    # develop and schedule require both user and node membership permissions
+    for access_type in ["develop", "schedule"]:
+        vsns = user.project_set.filter(
+            **{
+                f"usermembership__can_{access_type}": True,
+                f"nodemembership__can_{access_type}": True,
+            }
+        ).values_list("nodes__vsn", flat=True)
+
+        for vsn in vsns:
+            access_by_vsn[vsn].add(access_type)
+
+    # files only requires user membership permission
+    vsns = user.project_set.filter(
+        usermembership__can_access_files=True,
+    ).values_list("nodes__vsn", flat=True)
+
+    for vsn in vsns:
+        # projects without any nodes yield a null vsn
+        if vsn is not None:
+            access_by_vsn[vsn].add("files")
+
+    return access_by_vsn
+
+
+def get_access_matrix_version():
+    """
+    Return a version of the access matrix, which changes whenever the matrix does, in one query.
+
+    Access rows are only ever inserted and deleted, never updated, so their count and largest id
+    identify the rows stored. Usernames, approval and vsns also appear in the matrix, so changing
+    them rebuilds the access rows involved.
+    """
+    stats = UserAccess.objects.aggregate(count=Count("id"), last_id=Max("id"))
+    return f"{stats['count']}-{stats['last_id'] or 0}"
+
+
+def iter_access_matrix():
+    """
+    Yield (username, {vsn: sorted access types}) for every approved user from the materialized
+    access table, ordered by username and vsn. Users without any access are omitted.
+    """
+    rows = (
+        UserAccess.objects.filter(user__is_approved=True)
+        .order_by("user__username", "node__vsn", "access")
+        .values_list("user__username", "node__vsn", "access")
+        .iterator()
+    )
+    for username, user_rows in groupby(rows, key=itemgetter(0)):
+        access_by_vsn = {}
+        for _, vsn, access in user_rows:
+            access_by_vsn.setdefault(vsn, []).append(access)
+        yield username, access_by_vsn
+
+
+def get_project_user_ids(project_ids):
+    return set(
+        UserMembership.objects.filter(project_id__in=project_ids).values_list(
+            "user_id", flat=True
+        )
+    )
+
+
+@receiver(post_save, sender=UserMembership)
+@receiver(post_delete, sender=UserMembership)
+def rebuild_access_for_user_membership(sender, instance, **kwargs):
+    rebuild_user_access([instance.user_id])
+
+
+@receiver(post_save, sender=NodeMembership)
+@receiver(post_delete, sender=NodeMembership)
+def rebuild_access_for_node_membership(sender, instance, **kwargs):
+    rebuild_user_access(get_project_user_ids([instance.project_id]))
+
+
+# Project.users.add / Project.nodes.add bulk create membership rows without sending post_save,
+# so we also listen for m2m changes. remove and clear delete rows one by one and are already
+# covered by post_delete above.
+@receiver(m2m_changed, sender=Project.users.through)
+def rebuild_access_for_project_users(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action != "post_add":
+        return
+    if reverse:
+        rebuild_user_access([instance.pk])
+    else:
+        rebuild_user_access(pk_set)
+
+
+@receiver(m2m_changed, sender=Project.nodes.through)
+def rebuild_access_for_project_nodes(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action != "post_add":
+        return
+    if reverse:
+        rebuild_user_access(get_project_user_ids(pk_set))
+    else:
+        rebuild_user_access(get_project_user_ids([instance.pk]))
+
+
+def get_matrix_state(instance, fields):
+    # avoid loading deferred fields just to track state
+    if any(field not in instance.__dict__ for field in fields):
+        return None
+    return tuple(getattr(instance, field) for field in fields)
+
+
+@receiver(post_init, sender=User)
+def track_user_matrix_state(sender, instance, **kwargs):
+    instance._access_matrix_state = get_matrix_state(
+        instance, ["username", "is_approved"]
+    )
+
+
+@receiver(post_init, sender=Node)
+def track_node_matrix_state(sender, instance, **kwargs):
+    instance._access_matrix_state = get_matrix_state(instance, ["vsn"])
+
+
+# usernames, approval and vsns appear in the access matrix, so the rows of the users involved are
+# rebuilt when they change, which changes the matrix version. new users and nodes have no access yet.
+@receiver(post_save, sender=User)
+def rebuild_access_for_user(sender, instance, created, **kwargs):
+    state = get_matrix_state(instance, ["username", "is_approved"])
+    if not created and instance._access_matrix_state != state:
+        rebuild_user_access([instance.pk])
+    instance._access_matrix_state = state
+
+
+@receiver(post_save, sender=Node)
+def rebuild_access_for_node(sender, instance, created, **kwargs):
+    state = get_matrix_state(instance, ["vsn"])
+    if not created and instance._access_matrix_state != state:
+        rebuild_user_access(
+            get_project_user_ids(
+                NodeMembership.objects.filter(node=instance).values("project_id")
+            )
+        )
+    instance._access_matrix_state = state
@@ -5,3 +5,8 @@ class AppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
     verbose_name = "Waggle Management"
+
+    def ready(self):
+        # register signal handlers which maintain the materialized user access table, invalidate
+        # cached node authorized keys and log service node user changes
+        from . import access, authorized_keys, service_node_users
@@ -0,0 +1,169 @@
+"""
+Cached rendering of the ssh keys served to nodes.
+
+Every node's sshd hits NodeAuthorizedKeysView / NodeUsersView on each login attempt, so the rendered
+bodies are cached per VSN along with a strong ETag. Cache keys include a generation which is
+incremented whenever user keys, memberships or nodes change, invalidating every rendered body at
+once. The generation is stored in the database rather than the per-process cache, so a change made
+through one process takes effect immediately in all of them.
+"""
+import hashlib
+import json
+import re
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from .models import (
+    AuthorizedKeysGeneration,
+    User,
+    Node,
+    Project,
+    UserMembership,
+    NodeMembership,
+)
+
+GENERATION_PK = 1
+
+# Used to filter only keys with valid type and content. This also excludes the comment to prevent accidentally
+# leaking sensitive information about user, even if this is unlikely to happen.
+ssh_public_key_pattern = re.compile(r"(ssh-\S+\s+\S+)")
+
+
+def get_generation():
+    return (
+        AuthorizedKeysGeneration.objects.filter(pk=GENERATION_PK)
+        .values_list("generation", flat=True)
+        .first()
+        or 0
+    )
+
+
+def invalidate():
+    """
+    Invalidate all cached bodies by starting a new generation.
+    """
+    updated = AuthorizedKeysGeneration.objects.filter(pk=GENERATION_PK).update(
+        generation=F("generation") + 1
+    )
+    if not updated:
+        AuthorizedKeysGeneration.objects.get_or_create(
+            pk=GENERATION_PK, defaults={"generation": 1}
+        )
+
+
+def get_node_developers(vsn):
+    try:
+        node = Node.objects.get(vsn=vsn)
+    except Node.DoesNotExist:
+        raise Http404
+
+    return node.project_set.filter(
+        usermembership__can_develop=True,
+        nodemembership__can_develop=True,
+    )
+
+
+def render_authorized_keys(vsn, user_filter=None):
+    queryset = get_node_developers(vsn)
+
+    if user_filter:
+        queryset = queryset.filter(users__username=user_filter)
+
+    user_ssh_public_keys = queryset.values_list(
+        "users__ssh_public_keys", flat=True
+    ).distinct()
+
+    keys = []
+
+    for s in user_ssh_public_keys:
+        keys += s.splitlines()
+
+    return "\n".join(keys).encode()
+
+
+def render_node_users(vsn):
+    items = get_node_developers(vsn).values_list(
+        "users__username", "users__ssh_public_keys"
+    )
+
+    results = [
+        {
+            "user": username,
+            "ssh_public_keys": "".join(
+                s + "\n" for s in ssh_public_key_pattern.findall(ssh_public_keys)
+            ),
+        }
+        for username, ssh_public_keys in items
+    ]
+
+    return json.dumps(results, separators=(",", ":")).encode()
+
+
+def get_rendered(name, render, vsn, *args):
+    """
+    Return (content, etag) for a rendered body, using the cache when possible.
+    """
+    # hash the parameters as they come from the url and may not be valid cache key characters
+    params = hashlib.sha256(json.dumps([vsn, *args]).encode()).hexdigest()
+    key = f"app:{name}:{get_generation()}:{params}"
+
+    rendered = cache.get(key)
+    if rendered is None:
+        content = render(vsn, *args)
+        rendered = (content, quote_etag(hashlib.sha256(content).hexdigest()))
+        cache.set(key, rendered, timeout=settings.AUTHORIZED_KEYS_CACHE_TTL)
+    return rendered
+
+
+def get_authorized_keys(vsn, user_filter=None):
+    return get_rendered("authorized_keys", render_authorized_keys, vsn, user_filter)
+
+
+def get_node_users(vsn):
+    return get_rendered("node_users", render_node_users, vsn)
+
+
+def make_response(request, content, etag, content_type):
+    """
+    Return a response for a rendered body, or 304 if the client already has it.
+    """
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(content, content_type=content_type)
+    response["ETag"] = etag
+    # nodes may store the response but must revalidate it so key removal takes effect immediately
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+@receiver(post_save, sender=User)
+def invalidate_for_user(sender, instance, update_fields=None, **kwargs):
+    # logins only update last_login, so avoid throwing away the cache every time
+    if update_fields is not None and not {"username", "ssh_public_keys"} & set(
+        update_fields
+    ):
+        return
+    invalidate()
+
+
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Node)
+@receiver(post_delete, sender=Node)
+@receiver(post_save, sender=UserMembership)
+@receiver(post_delete, sender=UserMembership)
+@receiver(post_save, sender=NodeMembership)
+@receiver(post_delete, sender=NodeMembership)
+def invalidate_for_change(sender, **kwargs):
+    invalidate()
+
+
+@receiver(m2m_changed, sender=Project.users.through)
+@receiver(m2m_changed, sender=Project.nodes.through)
+def invalidate_for_project_change(sender, action, **kwargs):
+    if action == "post_add":
+        invalidate()
@@ -0,0 +1,55 @@
+"""Custom Django command to delete old service node user changes."""
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from app.models import ServiceNodeUserChange, ServiceNodeUserCounter
+from app.service_node_users import COUNTER_PK
+
+
+class Command(BaseCommand):
+    help = """
+    Delete service node user changes older than --days so the change log doesn't grow without
+    bound. Syncers polling with a generation older than the deleted changes are asked to fetch the
+    full list instead.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=30,
+            help="Number of days of service node user changes to keep.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        with transaction.atomic():
+            # locking the counter waits for changes which are still being logged
+            counters = ServiceNodeUserCounter.objects.select_for_update()
+            counter, _ = counters.get_or_create(pk=COUNTER_PK)
+            pruned_generation = ServiceNodeUserChange.objects.filter(
+                created_at__lt=cutoff
+            ).aggregate(Max("generation"))["generation__max"]
+            if pruned_generation is None:
+                self.stdout.write(
+                    self.style.SUCCESS("No service node user changes to delete.")
+                )
+                return
+            deleted, _ = ServiceNodeUserChange.objects.filter(
+                generation__lte=pruned_generation
+            ).delete()
+            counter.pruned_generation = max(
+                counter.pruned_generation, pruned_generation
+            )
+            counter.save(update_fields=["pruned_generation"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {deleted} service node user change(s) up to generation "
+                f"{pruned_generation}."
+            )
+        )
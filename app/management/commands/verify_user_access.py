@@ -0,0 +1,67 @@
+"""Custom Django command to verify the materialized user access table against the live computation."""
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from app.access import (
+    get_user_access_by_vsn,
+    compute_user_access_by_vsn,
+    rebuild_user_access,
+)
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = """
+    Verify the materialized user access table against access computed directly from project memberships.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--users",
+            nargs="+",
+            type=str,
+            default=None,
+            help="Optional list of usernames to verify. If not provided, all users will be verified.",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            default=False,
+            help="If provided, rebuild the materialized access for users which do not match.",
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by("username")
+        if options["users"]:
+            users = users.filter(username__in=options["users"])
+
+        mismatched = []
+
+        for user in users:
+            expected = compute_user_access_by_vsn(user)
+            actual = get_user_access_by_vsn(user)
+            if expected == actual:
+                continue
+            mismatched.append(user)
+            self.stdout.write(
+                f"{user.username}: expected {format_access(expected)} got {format_access(actual)}"
+            )
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS("User access is up to date."))
+            return
+
+        if not options["fix"]:
+            raise CommandError(
+                f"Materialized access does not match for {len(mismatched)} user(s)."
+            )
+
+        rebuild_user_access([user.pk for user in mismatched])
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt access for {len(mismatched)} user(s).")
+        )
+
+
+def format_access(access_by_vsn):
+    return {vsn: sorted(access) for vsn, access in sorted(access_by_vsn.items())}
@@ -0,0 +1,107 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_user_access(apps, schema_editor):
+    UserMembership = apps.get_model("app", "UserMembership")
+    NodeMembership = apps.get_model("app", "NodeMembership")
+    UserAccess = apps.get_model("app", "UserAccess")
+
+    nodes_by_project = {}
+    for project_id, node_id, can_develop, can_schedule in NodeMembership.objects.values_list(
+        "project_id", "node_id", "can_develop", "can_schedule"
+    ):
+        nodes_by_project.setdefault(project_id, []).append(
+            (node_id, can_develop, can_schedule)
+        )
+
+    rows = set()
+    for (
+        user_id,
+        project_id,
+        can_develop,
+        can_schedule,
+        can_access_files,
+    ) in UserMembership.objects.values_list(
+        "user_id", "project_id", "can_develop", "can_schedule", "can_access_files"
+    ):
+        for node_id, node_can_develop, node_can_schedule in nodes_by_project.get(
+            project_id, []
+        ):
+            if can_develop and node_can_develop:
+                rows.add((user_id, node_id, "develop"))
+            if can_schedule and node_can_schedule:
+                rows.add((user_id, node_id, "schedule"))
+            if can_access_files:
+                rows.add((user_id, node_id, "files"))
+
+    UserAccess.objects.bulk_create(
+        [
+            UserAccess(user_id=user_id, node_id=node_id, access=access)
+            for user_id, node_id, access in rows
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("app", "0014_alter_node_commissioning_date"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserAccess",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "access",
+                    models.CharField(
+                        choices=[
+                            ("develop", "develop"),
+                            ("schedule", "schedule"),
+                            ("files", "files"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                (
+                    "node",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="user_access",
+                        to="app.node",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="node_access",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "user access",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="useraccess",
+            constraint=models.UniqueConstraint(
+                fields=("user", "node", "access"), name="app_useraccess_uniq"
+            ),
+        ),
+        migrations.RunPython(populate_user_access, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:08
+
+from django.db import migrations, models
+
+
+def seed_service_node_user_changes(apps, schema_editor):
+    # seed the log with every existing node user so a delta since generation 0 matches the full list
+    Node = apps.get_model("app", "Node")
+    ServiceNodeUserChange = apps.get_model("app", "ServiceNodeUserChange")
+
+    ServiceNodeUserChange.objects.bulk_create(
+        [
+            ServiceNodeUserChange(user=f"node-{mac.lower()}", kind="added", active=active)
+            for mac, active in Node.objects.exclude(mac__isnull=True)
+            .exclude(mac="")
+            .order_by("mac")
+            .values_list("mac", "is_active")
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("app", "0015_useraccess"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ServiceNodeUserChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("user", models.CharField(max_length=32)),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("added", "added"),
+                            ("changed", "changed"),
+                            ("removed", "removed"),
+                        ],
+                        max_length=16,
+                    ),
+                ),
+                ("active", models.BooleanField(default=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunPython(
+            seed_service_node_user_changes, migrations.RunPython.noop
+        ),
+    ]
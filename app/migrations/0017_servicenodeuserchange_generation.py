@@ -0,0 +1,47 @@
+# Generated by Django 4.2.23 on 2026-10-18 05:35
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def seed_generations(apps, schema_editor):
+    # existing changes keep their id as generation so syncers' cursors stay valid
+    ServiceNodeUserChange = apps.get_model("app", "ServiceNodeUserChange")
+    ServiceNodeUserCounter = apps.get_model("app", "ServiceNodeUserCounter")
+
+    ServiceNodeUserChange.objects.update(generation=F("id"))
+    ServiceNodeUserCounter.objects.create(
+        pk=1,
+        generation=ServiceNodeUserChange.objects.aggregate(Max("id"))["id__max"] or 0,
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("app", "0016_servicenodeuserchange"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ServiceNodeUserCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("generation", models.PositiveBigIntegerField(default=0)),
+                ("pruned_generation", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="servicenodeuserchange",
+            name="generation",
+            field=models.PositiveBigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(seed_generations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.23 on 2026-10-18 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("app", "0017_servicenodeuserchange_generation"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AuthorizedKeysGeneration",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("generation", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -133,3 +133,82 @@ class NodeMembership(models.Model):
     #     constraints = [
     #         models.UniqueConstraint("node", "project", name="app_nodemembership_uniq")
     #     ]
+
+
+class UserAccess(models.Model):
+    """
+    Denormalized user -> node access derived from UserMembership and NodeMembership.
+
+    Rows are rebuilt incrementally by the signal handlers in app.access and can be checked
+    against the live computation with the verify_user_access management command.
+    """
+
+    ACCESS_TYPES = ("develop", "schedule", "files")
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="node_access")
+    node = models.ForeignKey(Node, on_delete=models.CASCADE, related_name="user_access")
+    access = models.CharField(
+        max_length=16, choices=[(access, access) for access in ACCESS_TYPES]
+    )
+
+    def __str__(self):
+        return f"{self.user} | {self.node} | {self.access}"
+
+    class Meta:
+        verbose_name_plural = "user access"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "node", "access"], name="app_useraccess_uniq"
+            )
+        ]
+
+
+class AuthorizedKeysGeneration(models.Model):
+    """
+    Single row counter which is incremented whenever user keys, memberships or nodes change.
+    Rendered node authorized keys are cached per process under the current generation, so every
+    process stops serving revoked keys as soon as the change commits.
+    """
+
+    generation = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.generation)
+
+
+class ServiceNodeUserCounter(models.Model):
+    """
+    Single row counter from which each node user change allocates its generation. The row stays
+    locked until the change commits, so generations become visible in order and syncers polling
+    with ?since= never skip a change which committed late. pruned_generation is the latest
+    generation whose changes were deleted by prune_service_node_user_changes.
+    """
+
+    generation = models.PositiveBigIntegerField(default=0)
+    pruned_generation = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.generation)
+
+
+class ServiceNodeUserChange(models.Model):
+    """
+    Append-only log of changes to the node users served by ServiceNodeUsersListView. The generation
+    of the latest change is the generation of the node users list.
+    """
+
+    ADDED = "added"
+    CHANGED = "changed"
+    REMOVED = "removed"
+
+    user = models.CharField(max_length=32)
+    kind = models.CharField(
+        max_length=16,
+        choices=[(kind, kind) for kind in (ADDED, CHANGED, REMOVED)],
+    )
+    active = models.BooleanField(default=False)
+    generation = models.PositiveBigIntegerField(default=0, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user} {self.kind}"
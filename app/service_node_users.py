@@ -0,0 +1,150 @@
+"""
+Node users which should be active in services such as RabbitMQ and the upload server.
+
+Each node with a MAC address has a node user named node-<mac>. Changes to a node's MAC or active
+status are appended to ServiceNodeUserChange so syncers can poll for only what changed since the
+generation they last saw. Generations are allocated from the locked ServiceNodeUserCounter row, so
+they become visible in the order they were allocated.
+"""
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+from .models import Node, ServiceNodeUserChange, ServiceNodeUserCounter
+
+COUNTER_PK = 1
+
+
+def get_service_user(mac):
+    return f"node-{mac.lower()}" if mac else None
+
+
+def get_generation():
+    """
+    Return (generation, pruned generation) of the node user changes or (0, 0) if nothing has
+    changed yet. Changes up to the pruned generation have been deleted.
+    """
+    row = ServiceNodeUserCounter.objects.filter(pk=COUNTER_PK).values_list(
+        "generation", "pruned_generation"
+    )
+    return row.first() or (0, 0)
+
+
+def log_changes(changes):
+    """
+    Append changes, a list of unsaved ServiceNodeUserChange, as the next generation.
+    """
+    if not changes:
+        return
+    with transaction.atomic():
+        # the counter row stays locked until the changes commit
+        counters = ServiceNodeUserCounter.objects.select_for_update()
+        counter, _ = counters.get_or_create(pk=COUNTER_PK)
+        counter.generation += 1
+        counter.save(update_fields=["generation"])
+        for change in changes:
+            change.generation = counter.generation
+        ServiceNodeUserChange.objects.bulk_create(changes)
+
+
+def iter_service_node_users():
+    """
+    Yield (user, active) for every node with a MAC address.
+    """
+    queryset = (
+        Node.objects.exclude(mac__isnull=True)
+        .exclude(mac="")
+        .order_by("mac")
+        .values_list("mac", "is_active")
+    )
+    for mac, active in queryset.iterator():
+        yield get_service_user(mac), active
+
+
+def get_changes_since(generation):
+    """
+    Return the net node user changes after generation as a dict with added, changed and removed lists.
+    """
+    first_kind = {}
+    last_change = {}
+
+    for user, kind, active in (
+        ServiceNodeUserChange.objects.filter(generation__gt=generation)
+        .order_by("generation", "id")
+        .values_list("user", "kind", "active")
+    ):
+        first_kind.setdefault(user, kind)
+        last_change[user] = (kind, active)
+
+    changes = {"added": [], "changed": [], "removed": []}
+
+    for user in sorted(last_change):
+        kind, active = last_change[user]
+        added = first_kind[user] == ServiceNodeUserChange.ADDED
+        if kind == ServiceNodeUserChange.REMOVED:
+            # users which were added and removed within the window never existed for the client
+            if not added:
+                changes["removed"].append(user)
+        elif added:
+            changes["added"].append({"user": user, "active": active})
+        else:
+            changes["changed"].append({"user": user, "active": active})
+
+    return changes
+
+
+def get_node_state(node):
+    # avoid loading deferred fields just to track state
+    if "mac" not in node.__dict__ or "is_active" not in node.__dict__:
+        return None
+    return (get_service_user(node.mac), node.is_active)
+
+
+@receiver(post_init, sender=Node)
+def track_service_user_state(sender, instance, **kwargs):
+    instance._service_user_state = get_node_state(instance)
+
+
+@receiver(post_save, sender=Node)
+def log_service_user_change(sender, instance, created, **kwargs):
+    old_state = (None, None) if created else instance._service_user_state
+    new_user, active = new_state = (get_service_user(instance.mac), instance.is_active)
+
+    if old_state == new_state:
+        return
+
+    changes = []
+
+    if old_state is None:
+        # we don't know what changed, so report the current state
+        if new_user:
+            changes.append((new_user, ServiceNodeUserChange.CHANGED))
+    else:
+        old_user, _ = old_state
+        if old_user and old_user != new_user:
+            changes.append((old_user, ServiceNodeUserChange.REMOVED))
+        if new_user and old_user != new_user:
+            changes.append((new_user, ServiceNodeUserChange.ADDED))
+        elif new_user:
+            changes.append((new_user, ServiceNodeUserChange.CHANGED))
+
+    log_changes(
+        [
+            ServiceNodeUserChange(
+                user=user,
+                kind=kind,
+                active=active if kind != ServiceNodeUserChange.REMOVED else False,
+            )
+            for user, kind in changes
+        ]
+    )
+
+    instance._service_user_state = new_state
+
+
+@receiver(post_delete, sender=Node)
+def log_service_user_removal(sender, instance, **kwargs):
+    user = get_service_user(instance.mac)
+    if user:
+        log_changes(
+            [ServiceNodeUserChange(user=user, kind=ServiceNodeUserChange.REMOVED)]
+        )
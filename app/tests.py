@@ -5,7 +5,26 @@ from rest_framework.authtoken.models import Token
 from rest_framework import status
 import uuid
 from unittest.mock import patch, MagicMock
-from .models import Project, Node, UserMembership, NodeMembership
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+import json
+from .models import (
+    AuthorizedKeysGeneration,
+    Project,
+    Node,
+    UserMembership,
+    NodeMembership,
+    ServiceNodeUserChange,
+)
+from .access import get_user_access_by_vsn, compute_user_access_by_vsn
+from .service_node_users import get_generation
 from test_utils import assertDictContainsSubset
 
 User = get_user_model()
@@ -81,6 +100,115 @@ class TestNodeUsersView(TestCase):
         )
 
 
+class TestServiceNodeUsersListView(TestCase):
+    """
+    tests that the service node users feed lists node users and reports changes since a generation.
+    """
+
+    def getUsers(self, **kwargs):
+        r = self.client.get("/service-node-users", **kwargs)
+        if r.status_code == status.HTTP_200_OK and r.streaming:
+            return r, json.loads(b"".join(r.streaming_content))
+        return r, None
+
+    def testList(self):
+        Node.objects.create(vsn="W001", mac="0000AABBCCDD0001")
+        Node.objects.create(vsn="W002", mac="0000AABBCCDD0002", is_active=False)
+        Node.objects.create(vsn="W003")
+
+        r, data = self.getUsers()
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            data,
+            [
+                {"user": "node-0000aabbccdd0001", "active": True},
+                {"user": "node-0000aabbccdd0002", "active": False},
+            ],
+        )
+
+    def testConditionalRequest(self):
+        node = Node.objects.create(vsn="W001", mac="0000AABBCCDD0001")
+        r, _ = self.getUsers()
+        etag = r["ETag"]
+
+        r, _ = self.getUsers(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # changes which don't affect node users keep the generation
+        node.files_public = True
+        node.save()
+        r, _ = self.getUsers(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        node.is_active = False
+        node.save()
+        r, data = self.getUsers(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(data, [{"user": "node-0000aabbccdd0001", "active": False}])
+
+    def testChangesSince(self):
+        w001 = Node.objects.create(vsn="W001", mac="0000AABBCCDD0001")
+        w002 = Node.objects.create(vsn="W002", mac="0000AABBCCDD0002")
+        w003 = Node.objects.create(vsn="W003", mac="0000AABBCCDD0003")
+        r, _ = self.getUsers()
+        generation = int(r["X-Generation"])
+
+        w001.is_active = False
+        w001.save()
+        w002.mac = "0000AABBCCDD0022"
+        w002.save()
+        w003.delete()
+        transient = Node.objects.create(vsn="W004", mac="0000AABBCCDD0004")
+        transient.delete()
+
+        r = self.client.get(f"/service-node-users?since={generation}")
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        data = r.json()
+        self.assertEqual(data["generation"], int(r["X-Generation"]))
+        self.assertEqual(data["added"], [{"user": "node-0000aabbccdd0022", "active": True}])
+        self.assertEqual(data["changed"], [{"user": "node-0000aabbccdd0001", "active": False}])
+        self.assertEqual(data["removed"], ["node-0000aabbccdd0002", "node-0000aabbccdd0003"])
+
+        r = self.client.get(f"/service-node-users?since={data['generation']}")
+        self.assertEqual(r.json(), {"generation": data["generation"], "added": [], "changed": [], "removed": []})
+
+    def testInvalidSince(self):
+        for since in ["abc", "-1", "1000"]:
+            r = self.client.get(f"/service-node-users?since={since}")
+            self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def testGenerationPerSave(self):
+        node = Node.objects.create(vsn="W001", mac="0000AABBCCDD0001")
+        generation, _ = get_generation()
+
+        # renaming the node user removes the old user and adds the new one in one generation
+        node.mac = "0000AABBCCDD0011"
+        node.save()
+        self.assertEqual(get_generation()[0], generation + 1)
+        self.assertEqual(
+            list(ServiceNodeUserChange.objects.filter(generation__gt=generation).values_list("user", "kind")),
+            [("node-0000aabbccdd0001", "removed"), ("node-0000aabbccdd0011", "added")],
+        )
+
+    def testPrune(self):
+        Node.objects.create(vsn="W001", mac="0000AABBCCDD0001")
+        generation, _ = get_generation()
+        ServiceNodeUserChange.objects.update(created_at=timezone.now() - timedelta(days=31))
+        Node.objects.create(vsn="W002", mac="0000AABBCCDD0002")
+
+        out = StringIO()
+        call_command("prune_service_node_user_changes", "--days", "30", stdout=out)
+        self.assertIn(f"up to generation {generation}.", out.getvalue())
+        self.assertEqual(list(ServiceNodeUserChange.objects.values_list("user", flat=True)), ["node-0000aabbccdd0002"])
+
+        # syncers which polled before the pruned changes must fetch the full list
+        for since in [0, generation - 1]:
+            r = self.client.get(f"/service-node-users?since={since}")
+            self.assertEqual(r.status_code, status.HTTP_400_BAD_REQUEST)
+        r = self.client.get(f"/service-node-users?since={generation}")
+        self.assertEqual(r.json()["added"], [{"user": "node-0000aabbccdd0002", "active": True}])
+
+
 class TestUpdateSSHPublicKeysView(TestCase):
     """
     TestUpdateSSHPublicKeysView tests that the update ssh public keys renders.
@@ -896,6 +1024,257 @@ class TestProjectsView(TestCase):
         self.assertEqual(beta_data["member_count"], 1)
         self.assertEqual(beta_data["nodes"], [{"vsn": "W010", "project": "Sage"}])
 
+    def testConstantQueries(self):
+        from manifests.models import NodeData, NodeBuildProject
+
+        sage_project = NodeBuildProject.objects.create(name="Sage")
+        user = create_random_user()
+        self.client.force_login(user)
+
+        def add_nodes(project, start, stop):
+            nodes = Node.objects.bulk_create(
+                [Node(vsn=f"W{i:04d}") for i in range(start, stop)]
+            )
+            NodeMembership.objects.bulk_create(
+                [NodeMembership(project=project, node=node) for node in nodes]
+            )
+            NodeData.objects.bulk_create(
+                [NodeData(vsn=node.vsn, project=sage_project) for node in nodes]
+            )
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.get("/projects/")
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+            return len(ctx.captured_queries), r.json()
+
+        alpha = Project.objects.create(name="Alpha")
+        add_nodes(alpha, 0, 10)
+        small_count, _ = count_queries()
+
+        beta = Project.objects.create(name="Beta")
+        add_nodes(alpha, 10, 500)
+        add_nodes(beta, 500, 1000)
+        large_count, data = count_queries()
+
+        self.assertEqual(large_count, small_count)
+        self.assertEqual(sum(len(item["nodes"]) for item in data), 1000)
+        self.assertTrue(all(node["project"] == "Sage" for item in data for node in item["nodes"]))
+
+
+class TestUserAccessMaterialization(TestCase):
+    """
+    tests that the materialized user access table tracks membership changes and matches the live computation.
+    """
+
+    def setUp(self):
+        self.user = create_random_user()
+        self.project = Project.objects.create(name="Test Project")
+        self.node = Node.objects.create(vsn="W001")
+
+    def assertAccessMatchesLive(self, user):
+        self.assertEqual(get_user_access_by_vsn(user), compute_user_access_by_vsn(user))
+
+    def testMembershipChanges(self):
+        NodeMembership.objects.create(project=self.project, node=self.node, can_develop=True)
+        membership = UserMembership.objects.create(
+            project=self.project, user=self.user, can_develop=True
+        )
+        self.assertEqual(get_user_access_by_vsn(self.user), {"W001": {"develop"}})
+
+        membership.can_access_files = True
+        membership.save()
+        self.assertEqual(get_user_access_by_vsn(self.user), {"W001": {"develop", "files"}})
+
+        membership.delete()
+        self.assertEqual(get_user_access_by_vsn(self.user), {})
+
+    def testNodeMembershipChanges(self):
+        UserMembership.objects.create(
+            project=self.project, user=self.user, can_schedule=True
+        )
+        node_membership = NodeMembership.objects.create(
+            project=self.project, node=self.node, can_schedule=True
+        )
+        self.assertEqual(get_user_access_by_vsn(self.user), {"W001": {"schedule"}})
+
+        node_membership.can_schedule = False
+        node_membership.save()
+        self.assertEqual(get_user_access_by_vsn(self.user), {})
+
+    def testProjectRelatedManagers(self):
+        self.project.users.add(self.user, through_defaults={"can_access_files": True})
+        self.project.nodes.add(self.node)
+        self.assertEqual(get_user_access_by_vsn(self.user), {"W001": {"files"}})
+
+        self.project.nodes.remove(self.node)
+        self.assertEqual(get_user_access_by_vsn(self.user), {})
+
+        self.project.nodes.add(self.node)
+        self.project.users.clear()
+        self.assertEqual(get_user_access_by_vsn(self.user), {})
+
+    def testLookupIsSingleQuery(self):
+        UserMembership.objects.create(
+            project=self.project, user=self.user, can_develop=True, can_access_files=True
+        )
+        for vsn in ["W002", "W003", "W004"]:
+            NodeMembership.objects.create(
+                project=self.project, node=Node.objects.create(vsn=vsn), can_develop=True
+            )
+
+        with self.assertNumQueries(1):
+            access_by_vsn = get_user_access_by_vsn(self.user)
+
+        self.assertEqual(len(access_by_vsn), 3)
+        self.assertAccessMatchesLive(self.user)
+
+    def testVerifyCommand(self):
+        UserMembership.objects.create(
+            project=self.project, user=self.user, can_access_files=True
+        )
+        NodeMembership.objects.create(project=self.project, node=self.node)
+        call_command("verify_user_access", stdout=StringIO())
+
+        # queryset updates bypass signals and leave the materialized access stale
+        UserMembership.objects.update(can_access_files=False)
+        with self.assertRaises(CommandError):
+            call_command("verify_user_access", stdout=StringIO())
+
+        call_command("verify_user_access", "--fix", stdout=StringIO())
+        self.assertEqual(get_user_access_by_vsn(self.user), {})
+        self.assertAccessMatchesLive(self.user)
+
+
+class TestUserAccessMatrixView(TestCase):
+    """
+    tests that the bulk access matrix streams every approved user's access and supports conditional requests.
+    """
+
+    def setUp(self):
+        self.project = Project.objects.create(name="Test Project")
+        for vsn, access in [("W001", {"can_develop": True}), ("W002", {})]:
+            NodeMembership.objects.create(
+                project=self.project, node=Node.objects.create(vsn=vsn), **access
+            )
+        for username, approved in [("ada", True), ("tom", True), ("jed", False)]:
+            user = User.objects.create_user(username=username, is_approved=approved)
+            UserMembership.objects.create(
+                project=self.project, user=user, can_develop=True, can_access_files=True
+            )
+
+    def getMatrix(self, **headers):
+        return self.client.get("/users/~access", **headers)
+
+    def testNeedsAdmin(self):
+        r = self.getMatrix()
+        self.assertEqual(r.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_login(create_random_user())
+        r = self.getMatrix()
+        self.assertEqual(r.status_code, status.HTTP_403_FORBIDDEN)
+
+    def testMatrix(self):
+        self.client.force_login(create_random_admin_user())
+        r = self.getMatrix()
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r["Content-Type"], "application/x-ndjson")
+
+        lines = b"".join(r.streaming_content).decode().splitlines()
+        expected_access = [
+            {"vsn": "W001", "access": ["develop", "files"]},
+            {"vsn": "W002", "access": ["files"]},
+        ]
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [
+                {"username": "ada", "access": expected_access},
+                {"username": "tom", "access": expected_access},
+            ],
+        )
+
+        # the matrix should match each user's individual access endpoint
+        for line in lines:
+            item = json.loads(line)
+            r = self.client.get(f"/users/{item['username']}/access")
+            self.assertEqual(r.json(), item["access"])
+
+    def testConditionalRequest(self):
+        self.client.force_login(create_random_admin_user())
+        etag = self.getMatrix()["ETag"]
+
+        r = self.getMatrix(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(r["ETag"], etag)
+
+        UserMembership.objects.filter(user__username="tom").delete()
+        r = self.getMatrix(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(r["ETag"], etag)
+
+    def testNotModifiedDoesNotReadMatrix(self):
+        self.client.force_login(create_random_admin_user())
+        etag = self.getMatrix()["ETag"]
+
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.getMatrix(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+        access_queries = [q for q in ctx.captured_queries if "membership" in q["sql"] or "useraccess" in q["sql"]]
+        self.assertEqual(len(access_queries), 1)
+        self.assertNotIn("membership", access_queries[0]["sql"])
+
+    def testETagChangesWithNamesAndApproval(self):
+        self.client.force_login(create_random_admin_user())
+
+        def changes(update):
+            etag = self.getMatrix()["ETag"]
+            update()
+            r = self.getMatrix(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+            return [json.loads(line) for line in b"".join(r.streaming_content).decode().splitlines()]
+
+        def rename_user():
+            user = User.objects.get(username="tom")
+            user.username = "tim"
+            user.save()
+
+        def approve_user():
+            user = User.objects.get(username="jed")
+            user.is_approved = True
+            user.save()
+
+        def rename_node():
+            node = Node.objects.get(vsn="W002")
+            node.vsn = "W003"
+            node.save()
+
+        self.assertEqual([item["username"] for item in changes(rename_user)], ["ada", "tim"])
+        self.assertEqual([item["username"] for item in changes(approve_user)], ["ada", "jed", "tim"])
+        self.assertEqual([a["vsn"] for a in changes(rename_node)[0]["access"]], ["W001", "W003"])
+
+        # saves which don't change the matrix keep the etag
+        etag = self.getMatrix()["ETag"]
+        User.objects.get(username="ada").save()
+        Node.objects.get(vsn="W001").save()
+        self.assertEqual(self.getMatrix(HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def testConstantQueries(self):
+        admin = create_random_admin_user()
+
+        def count_queries():
+            self.client.force_login(admin)
+            with CaptureQueriesContext(connection) as ctx:
+                self.getMatrix()
+            return len(ctx.captured_queries)
+
+        before = count_queries()
+        for i in range(20):
+            user = create_random_user(is_approved=True)
+            UserMembership.objects.create(project=self.project, user=user, can_schedule=True)
+            node = Node.objects.create(vsn=f"X{i:03d}")
+            NodeMembership.objects.create(project=self.project, node=node, can_schedule=True)
+        self.assertEqual(count_queries(), before)
+
 
 class TestAuth(TestCase):
     """
@@ -1124,6 +1503,90 @@ class TestNodeAuthorizedKeysView(TestCase):
         )
 
 
+class TestNodeKeysCaching(TestCase):
+    """
+    tests that node authorized keys responses are cached, invalidated on changes and support conditional requests.
+    """
+
+    key = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIIDpsV/R93C5TfTO2kXdjOxwXNLbsowpztcUnkLH9T/4"
+    other_key = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIF8DWBuwUiNbw1OzPWQCmSQFvwVRdU29joY4YKkzvljV"
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="dev", ssh_public_keys=self.key)
+        self.project = Project.objects.create(name="DEV")
+        self.node = Node.objects.create(vsn="W123")
+        self.membership = UserMembership.objects.create(
+            user=self.user, project=self.project, can_develop=True
+        )
+        NodeMembership.objects.create(project=self.project, node=self.node, can_develop=True)
+
+    def tearDown(self):
+        cache.clear()
+
+    def testCachedResponses(self):
+        for url in ["/nodes/W123/authorized_keys", "/nodes/W123/users"]:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, status.HTTP_200_OK)
+            self.assertIn("no-cache", r["Cache-Control"])
+
+            # only the generation is looked up
+            with self.assertNumQueries(1):
+                cached = self.client.get(url)
+            self.assertEqual(cached.content, r.content)
+            self.assertEqual(cached["ETag"], r["ETag"])
+
+    def testConditionalRequest(self):
+        r = self.client.get("/nodes/W123/authorized_keys")
+        etag = r["ETag"]
+
+        r = self.client.get("/nodes/W123/authorized_keys", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(r["ETag"], etag)
+
+        self.user.ssh_public_keys = self.other_key
+        self.user.save()
+
+        r = self.client.get("/nodes/W123/authorized_keys", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(r.status_code, status.HTTP_200_OK)
+        self.assertEqual(r.content.decode(), self.other_key)
+
+    def testMembershipChangeInvalidates(self):
+        r = self.client.get("/nodes/W123/users")
+        self.assertEqual([item["user"] for item in r.json()], ["dev"])
+
+        self.membership.can_develop = False
+        self.membership.save()
+
+        r = self.client.get("/nodes/W123/users")
+        self.assertEqual(r.json(), [])
+        r = self.client.get("/nodes/W123/authorized_keys")
+        self.assertEqual(r.content, b"")
+
+    def testLoginDoesNotInvalidate(self):
+        self.client.get("/nodes/W123/authorized_keys")
+        self.user.save(update_fields=["last_login"])
+        with self.assertNumQueries(1):
+            self.client.get("/nodes/W123/authorized_keys")
+
+    def testChangesInOtherProcessesInvalidate(self):
+        self.client.get("/nodes/W123/authorized_keys")
+
+        # another process changes the keys and starts a new generation without touching this
+        # process's cache
+        User.objects.filter(pk=self.user.pk).update(ssh_public_keys=self.other_key)
+        AuthorizedKeysGeneration.objects.update(generation=F("generation") + 1)
+
+        r = self.client.get("/nodes/W123/authorized_keys")
+        self.assertEqual(r.content.decode(), self.other_key)
+
+    def testUnknownNode(self):
+        r = self.client.get("/nodes/W999/authorized_keys")
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+        r = self.client.get("/nodes/W999/users")
+        self.assertEqual(r.status_code, status.HTTP_404_NOT_FOUND)
+
+
 class TestPortalCompatibility(TestCase):
     """
     TestPortalCompatibility tests that all existing endpoints the portal depends on work as expected
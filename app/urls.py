@@ -28,6 +28,9 @@ urlpatterns = [
     path("nodes/<str:vsn>/authorized_keys", views.NodeAuthorizedKeysView.as_view()),
     path("nodes/<str:vsn>/users", views.NodeUsersView.as_view()),
     path("service-node-users", views.ServiceNodeUsersListView.as_view()),
+    path(
+        "users/~access", views.UserAccessMatrixView.as_view(), name="user-access-matrix"
+    ),
 ] + format_suffix_patterns(
     [
         # token views
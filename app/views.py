@@ -7,8 +7,11 @@ from django.http import (
     HttpResponseRedirect,
     HttpResponseBadRequest,
     Http404,
+    StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404, redirect
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.views.generic import TemplateView
 from django.views.generic.edit import FormView
 from rest_framework.request import Request
@@ -26,43 +29,18 @@ from manifests.models import NodeData
 from .serializers import UserSerializer, UserProfileSerializer, ProjectSerializer, FeedbackSerializer
 from .forms import UpdateSSHPublicKeysForm, CompleteLoginForm
 from .permissions import IsSelf, IsMatchingUsername
-from .models import Node, Project
-from collections import defaultdict
-import re
+from .models import Node, Project, NodeMembership
+from .access import (
+    get_user_access_by_vsn,
+    get_access_matrix_version,
+    iter_access_matrix,
+)
+from . import authorized_keys, service_node_users
+import json
 
 User = get_user_model()
 
 
-def get_user_access_by_vsn(user):
-    """
-    Calculate user's access permissions per VSN.
-    Returns a defaultdict mapping VSN to set of access types.
-    """
-    access_by_vsn = defaultdict(set)
-
-    # develop and schedule require both user and node membership permissions
-    for access_type in ["develop", "schedule"]:
-        vsns = user.project_set.filter(
-            **{
-                f"usermembership__can_{access_type}": True,
-                f"nodemembership__can_{access_type}": True,
-            }
-        ).values_list("nodes__vsn", flat=True)
-
-        for vsn in vsns:
-            access_by_vsn[vsn].add(access_type)
-
-    # files only requires user membership permission
-    vsns = user.project_set.filter(
-        usermembership__can_access_files=True,
-    ).values_list("nodes__vsn", flat=True)
-
-    for vsn in vsns:
-        access_by_vsn[vsn].add("files")
-
-    return access_by_vsn
-
-
 class HomeView(TemplateView):
     template_name = "index.html"
 
@@ -168,6 +146,43 @@ class UserAccessView(APIView):
         return Response(data)
 
 
+class UserAccessMatrixView(APIView):
+    """
+    This view streams the access of every approved user as newline delimited JSON, one user per line:
+
+        {"username": "someuser", "access": [{"vsn": "W001", "access": ["develop", "files"]}]}
+
+    Users without any access are omitted. Responses carry an ETag of the matrix version so pollers can
+    send If-None-Match and get a 304 when nothing changed.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def get(self, request: Request, format=None) -> HttpResponse:
+        # the version is a single aggregate query, so unchanged matrices aren't read at all
+        etag = quote_etag(f"user-access-{get_access_matrix_version()}")
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = StreamingHttpResponse(
+                self.iter_lines(), content_type="application/x-ndjson"
+            )
+        response["ETag"] = etag
+        return response
+
+    def iter_lines(self):
+        for username, access_by_vsn in iter_access_matrix():
+            yield json.dumps(
+                {
+                    "username": username,
+                    "access": [
+                        {"vsn": vsn, "access": access}
+                        for vsn, access in access_by_vsn.items()
+                    ],
+                }
+            ).encode() + b"\n"
+
+
 class UserProjectsView(APIView):
     permission_classes = [IsAdminUser | IsMatchingUsername]
 
@@ -204,6 +219,13 @@ class ProjectsView(APIView):
             .order_by("name")
         )
 
+        # Map each member node's VSN to the NodeBuildProject of its manifests NodeData in one query
+        node_projects = dict(
+            NodeData.objects.filter(
+                vsn__in=NodeMembership.objects.values("node__vsn")
+            ).values_list("vsn", "project__name")
+        )
+
         data = []
         for project in projects:
             nodes = []
@@ -212,16 +234,9 @@ class ProjectsView(APIView):
                 key=lambda m: (m.node.vsn or ""),
             ):
                 if membership.node.vsn:
-                    # Get the NodeData from manifests to access its project
-                    try:
-                        node_data = NodeData.objects.get(vsn=membership.node.vsn)
-                        node_project = node_data.project.name if node_data.project else None
-                    except NodeData.DoesNotExist:
-                        node_project = None
-
                     nodes.append({
                         "vsn": membership.node.vsn,
-                        "project": node_project,
+                        "project": node_projects.get(membership.node.vsn),
                     })
 
             data.append({
@@ -236,33 +251,10 @@ class ProjectsView(APIView):
 class NodeAuthorizedKeysView(APIView):
     permission_classes = [AllowAny]
 
-    def get(self, request: Request, vsn: str) -> Response:
-        try:
-            node = Node.objects.get(vsn=vsn)
-        except Node.DoesNotExist:
-            raise Http404
-
-        queryset = node.project_set.filter(
-            usermembership__can_develop=True,
-            nodemembership__can_develop=True,
-        )
-
+    def get(self, request: Request, vsn: str) -> HttpResponse:
         user_filter = request.query_params.get("user")
-        if user_filter:
-            queryset = queryset.filter(users__username=user_filter)
-
-        user_ssh_public_keys = queryset.values_list(
-            "users__ssh_public_keys", flat=True
-        ).distinct()
-
-        keys = []
-
-        for s in user_ssh_public_keys:
-            keys += s.splitlines()
-
-        return HttpResponse("\n".join(keys), content_type="text/plain")
-        # TODO(sean) figure out correct way to get rest framework to return plain text
-        # return Response("\n".join(keys), content_type="text/plain")
+        content, etag = authorized_keys.get_authorized_keys(vsn, user_filter)
+        return authorized_keys.make_response(request, content, etag, "text/plain")
 
 
 class NodeUsersView(APIView):
@@ -275,51 +267,72 @@ class NodeUsersView(APIView):
 
     permission_classes = [AllowAny]
 
-    # Used to filter only keys with valid type and content. This also excludes the comment to prevent accidentally
-    # leaking sensitive information about user, even if this is unlikely to happen.
-    ssh_public_key_pattern = re.compile(r"(ssh-\S+\s+\S+)")
-
-    def get(self, request: Request, vsn: str) -> Response:
-        try:
-            node = Node.objects.get(vsn=vsn)
-        except Node.DoesNotExist:
-            raise Http404
-
-        items = node.project_set.filter(
-            usermembership__can_develop=True,
-            nodemembership__can_develop=True,
-        ).values_list("users__username", "users__ssh_public_keys")
-
-        results = [
-            {
-                "user": username,
-                "ssh_public_keys": "".join(
-                    s + "\n"
-                    for s in self.ssh_public_key_pattern.findall(ssh_public_keys)
-                ),
-            }
-            for username, ssh_public_keys in items
-        ]
-
-        return Response(results)
+    def get(self, request: Request, vsn: str) -> HttpResponse:
+        content, etag = authorized_keys.get_node_users(vsn)
+        return authorized_keys.make_response(
+            request, content, etag, "application/json"
+        )
 
 
 # ServiceNodeUsersListView provides a list of "node users" which should be active in
 # services such as RabbitMQ and the upload server.
+#
+# Responses carry the current generation of the list in the X-Generation header and ETag, so syncers
+# can send If-None-Match to skip unchanged lists or pass ?since=<generation> to only get the node users
+# which were added, changed or removed after that generation. Generations older than the changes kept
+# by prune_service_node_user_changes are rejected, and syncers fetch the full list instead.
 class ServiceNodeUsersListView(APIView):
 
     permission_classes = [AllowAny]
 
-    def get(self, req: HttpRequest) -> Response:
-        data = [
-            {
-                "user": f"node-{node.mac.lower()}",
-                "active": node.is_active,
-            }
-            for node in Node.objects.all()
-            if node.mac
-        ]
-        return Response(data)
+    def get(self, req: HttpRequest) -> HttpResponse:
+        generation, pruned_generation = service_node_users.get_generation()
+
+        since = req.query_params.get("since")
+
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                return Response(
+                    {"since": "must be an integer generation"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if since < 0 or since > generation:
+                return Response(
+                    {"since": "unknown generation, fetch the full list instead"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if since < pruned_generation:
+                return Response(
+                    {"since": "pruned generation, fetch the full list instead"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            response = Response(
+                {"generation": generation, **service_node_users.get_changes_since(since)}
+            )
+            response["X-Generation"] = str(generation)
+            return response
+
+        etag = quote_etag(f"node-users-{generation}")
+
+        response = get_conditional_response(req, etag=etag)
+        if response is None:
+            response = StreamingHttpResponse(
+                stream_service_node_users(), content_type="application/json"
+            )
+        response["ETag"] = etag
+        response["X-Generation"] = str(generation)
+        return response
+
+
+def stream_service_node_users():
+    yield "["
+    for i, (user, active) in enumerate(service_node_users.iter_service_node_users()):
+        if i > 0:
+            yield ","
+        yield json.dumps({"user": user, "active": active})
+    yield "]"
 
 
 class UpdateSSHPublicKeysView(LoginRequiredMixin, FormView):
@@ -218,6 +218,34 @@ S3_SECRET_KEY = env("S3_SECRET_KEY", str, "")
 S3_BUCKET_NAME = env("S3_BUCKET_NAME", str, "")
 S3_ROOT_FOLDER = env("S3_ROOT_FOLDER", str, "")
 S3_REGION = env("S3_REGION", str, "")
+S3_SECURE = env("S3_SECURE", bool, True)
+# Connection pool settings for the process wide S3 client used by the downloads app.
+S3_CONNECT_TIMEOUT: float = env("S3_CONNECT_TIMEOUT", float, 5.0)
+S3_READ_TIMEOUT: float = env("S3_READ_TIMEOUT", float, 30.0)
+S3_POOL_MAXSIZE: int = env("S3_POOL_MAXSIZE", int, 20)
+# Seconds OSN object existence checks are cached for by the downloads app.
+S3_EXISTS_CACHE_TTL: int = env("S3_EXISTS_CACHE_TTL", int, 60)
+# If enabled, a cache miss lists the object's job/task/node prefix once instead of stating the object.
+S3_EXISTS_CACHE_WARM: bool = env("S3_EXISTS_CACHE_WARM", bool, False)
+# Prefixes with more objects than this are not cached as complete listings.
+S3_EXISTS_LISTING_LIMIT: int = env("S3_EXISTS_LISTING_LIMIT", int, 10000)
+
+# Maximum number of paths accepted by a single /downloads/batch request.
+DOWNLOADS_BATCH_MAX_PATHS: int = env("DOWNLOADS_BATCH_MAX_PATHS", int, 10000)
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "downloads": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "downloads",
+        "TIMEOUT": S3_EXISTS_CACHE_TTL,
+        "OPTIONS": {
+            "MAX_ENTRIES": env("S3_EXISTS_CACHE_MAX_ENTRIES", int, 100000),
+        },
+    },
+}
 
 PELICAN_KEY_PATH: str = env("PELICAN_KEY_PATH", str, "")
 PELICAN_ALGORITHM: str = env("PELICAN_ALGORITHM", str, "ES256")
@@ -239,3 +267,11 @@ GITHUB_REPO_OWNER = env("GITHUB_REPO_OWNER", str, "")
 GITHUB_REPO_NAME = env("GITHUB_REPO_NAME", str, "")
 
 TIME_ZONE = "UTC"
+
+# Node auth token cache configuration
+NODE_AUTH_TOKEN_CACHE_SIZE: int = env("NODE_AUTH_TOKEN_CACHE_SIZE", int, 1024)
+NODE_AUTH_TOKEN_CACHE_TTL: float = env("NODE_AUTH_TOKEN_CACHE_TTL", float, 60.0)
+
+# Seconds rendered node authorized keys may be cached for. Changes invalidate the cached bodies of
+# every process immediately, so this only bounds the memory held by rarely requested nodes.
+AUTHORIZED_KEYS_CACHE_TTL: int = env("AUTHORIZED_KEYS_CACHE_TTL", int, 60)
@@ -0,0 +1,74 @@
+"""
+Signing of the SciTokens which authorize Pelican downloads.
+
+The signing key is read and parsed once and reloaded only when the key file changes. Tokens are
+encoded directly with the claims SciToken.serialize would set, with explicit times instead of
+patching time.time, so signing is safe to use from multiple threads.
+"""
+import os
+import threading
+import time
+import uuid
+import jwt
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+
+class SigningKey:
+    """
+    Private key loaded from a PEM file, reloaded when the file's modification time or size changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.key = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        st = os.stat(self.path)
+        version = (st.st_mtime_ns, st.st_size)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    with open(self.path, "rb") as f:
+                        self.key = load_pem_private_key(f.read(), password=None)
+                    self.version = version
+        return self.key
+
+
+_signing_keys = {}
+_signing_keys_lock = threading.Lock()
+
+
+def get_signing_key(path):
+    """
+    Returns the private key at path, loading it on first use and when the file changes.
+    """
+    signing_key = _signing_keys.get(path)
+    if signing_key is None:
+        with _signing_keys_lock:
+            signing_key = _signing_keys.setdefault(path, SigningKey(path))
+    return signing_key.get()
+
+
+# Tokens are issued lag seconds in the past. This is because our use case redirects users to Pelican
+# immediately and we suspect that slight time differences between our machines and the Pelican
+# machines may cause some tokens to be flagged as invalid. Adding a slight buffer should allow more
+# tolerance between these machines. The details of the "not before" claim can be found here:
+# https://scitokens.org/technical_docs/Claims
+def sign_scitoken(claims, key, algorithm, key_id, issuer, lifetime, lag, now=None):
+    """
+    Returns a serialized SciToken with claims, issued lag seconds before now and expiring lifetime
+    seconds after now.
+    """
+    issue_time = int((time.time() if now is None else now) - lag)
+    payload = {
+        **claims,
+        "iss": issuer,
+        "exp": issue_time + lifetime + lag,
+        "iat": issue_time,
+        "nbf": issue_time,
+        "jti": str(uuid.uuid4()),
+    }
+    headers = {"kid": key_id} if key_id is not None else None
+    return jwt.encode(payload, key, algorithm=algorithm, headers=headers)
@@ -0,0 +1,18 @@
+from django.conf import settings
+from rest_framework import serializers
+
+
+class BatchDownloadsSerializer(serializers.Serializer):
+    paths = serializers.ListField(
+        child=serializers.CharField(),
+        allow_empty=False,
+        help_text="Object paths of the form job_id/task_id/node_id/timestamp_and_filename.",
+    )
+
+    def validate_paths(self, value):
+        limit = settings.DOWNLOADS_BATCH_MAX_PATHS
+        if len(value) > limit:
+            raise serializers.ValidationError(
+                f"Ensure this field has no more than {limit} elements."
+            )
+        return value
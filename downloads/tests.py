@@ -1 +1,368 @@
-from django.test import TestCase
+import jwt
+import os
+import tempfile
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from datetime import datetime, timedelta, timezone
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from minio import Minio
+from minio.error import S3Error
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+from unittest.mock import MagicMock, patch
+from app.models import Node, NodeMembership, Project, User, UserMembership
+import downloads.views
+from downloads.pelican import get_signing_key, sign_scitoken
+from downloads.signing import Presigner
+from downloads.views import (
+    Item,
+    get_bucket_location,
+    get_minio_client,
+    get_osn_presigned_url,
+    object_exists_in_osn,
+)
+
+
+@override_settings(
+    S3_ENDPOINT="s3.example.org",
+    S3_ACCESS_KEY="access",
+    S3_SECRET_KEY="secret",
+    S3_REGION="us-east-1",
+)
+class MinioClientTest(TestCase):
+    def setUp(self):
+        downloads.views._minio_client = None
+
+    def test_client_is_reused(self):
+        client = get_minio_client()
+        self.assertIs(get_minio_client(), client)
+        pool = client._http.connection_pool_kw
+        self.assertEqual(pool["maxsize"], 20)
+        self.assertEqual(pool["timeout"].connect_timeout, 5.0)
+
+    def test_new_client_after_fork(self):
+        client = get_minio_client()
+        with patch("downloads.views.os.getpid", return_value=-1):
+            forked = get_minio_client()
+        self.assertIsNot(forked, client)
+
+
+def not_found():
+    return S3Error("NoSuchKey", "not found", None, None, None, None)
+
+
+@override_settings(S3_BUCKET_NAME="bucket")
+class ObjectExistsCacheTest(TestCase):
+    def setUp(self):
+        caches["downloads"].clear()
+        self.client = MagicMock()
+        patcher = patch("downloads.views.get_minio_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_item(self, filename):
+        return Item("job", "task", "node", filename)
+
+    def test_results_are_cached(self):
+        self.assertTrue(object_exists_in_osn(self.get_item("1-a.jpg")))
+        self.assertTrue(object_exists_in_osn(self.get_item("1-a.jpg")))
+        self.assertEqual(self.client.stat_object.call_count, 1)
+
+        self.client.stat_object.side_effect = not_found()
+        self.assertFalse(object_exists_in_osn(self.get_item("2-b.jpg")))
+        self.assertFalse(object_exists_in_osn(self.get_item("2-b.jpg")))
+        self.assertEqual(self.client.stat_object.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        self.client.stat_object.side_effect = S3Error(
+            "AccessDenied", "denied", None, None, None, None
+        )
+        self.assertFalse(object_exists_in_osn(self.get_item("1-a.jpg")))
+        self.assertFalse(object_exists_in_osn(self.get_item("1-a.jpg")))
+        self.assertEqual(self.client.stat_object.call_count, 2)
+
+    @override_settings(S3_EXISTS_CACHE_WARM=True)
+    def test_prefix_listing(self):
+        self.client.list_objects.return_value = [
+            SimpleNamespace(object_name=f"node-data/job/task/node/{i}-a.jpg")
+            for i in range(3)
+        ]
+        for i in range(3):
+            self.assertTrue(object_exists_in_osn(self.get_item(f"{i}-a.jpg")))
+        self.assertFalse(object_exists_in_osn(self.get_item("9-a.jpg")))
+        self.client.list_objects.assert_called_once_with(
+            bucket_name="bucket", prefix="node-data/job/task/node/", recursive=True
+        )
+        self.client.stat_object.assert_not_called()
+
+    @override_settings(S3_EXISTS_CACHE_WARM=True, S3_EXISTS_LISTING_LIMIT=2)
+    def test_large_prefix_is_stated(self):
+        self.client.list_objects.return_value = [
+            SimpleNamespace(object_name=f"node-data/job/task/node/{i}-a.jpg")
+            for i in range(3)
+        ]
+        self.assertTrue(object_exists_in_osn(self.get_item("0-a.jpg")))
+        self.assertTrue(object_exists_in_osn(self.get_item("1-a.jpg")))
+        self.assertEqual(self.client.list_objects.call_count, 1)
+        self.assertEqual(self.client.stat_object.call_count, 2)
+
+
+class PresignerTest(TestCase):
+    def test_matches_minio(self):
+        now = datetime(2026, 10, 18, 12, 3, 4, tzinfo=timezone.utc)
+        object_name = (
+            "node-data/job~1/task a/000048b02d15bc7c/1700000000000000000-sample+x.jpg"
+        )
+        client = Minio("s3.example.org", "access/key", "secret", region="us-west-2")
+        presigner = Presigner("s3.example.org", "access/key", "secret", "us-west-2")
+        self.assertEqual(
+            presigner.presign("GET", "bucket", object_name, 60, now=now),
+            client.get_presigned_url(
+                "GET",
+                "bucket",
+                object_name,
+                expires=timedelta(seconds=60),
+                request_date=now,
+            ),
+        )
+
+    def test_default_ports_match_minio(self):
+        now = datetime(2026, 10, 18, 12, 3, 4, tzinfo=timezone.utc)
+        for endpoint, secure in [
+            ("s3.example.org:443", True),
+            ("s3.example.org:80", False),
+            ("s3.example.org:9000", True),
+            ("127.0.0.1:443", False),
+        ]:
+            client = Minio(
+                endpoint, "access", "secret", region="us-west-2", secure=secure
+            )
+            presigner = Presigner(endpoint, "access", "secret", "us-west-2", secure)
+            self.assertEqual(
+                presigner.presign("GET", "bucket", "a.jpg", 60, now=now),
+                client.get_presigned_url(
+                    "GET",
+                    "bucket",
+                    "a.jpg",
+                    expires=timedelta(seconds=60),
+                    request_date=now,
+                ),
+                endpoint,
+            )
+
+    def test_query_params_match_minio(self):
+        now = datetime(2026, 10, 18, 12, 3, 4, tzinfo=timezone.utc)
+        query_params = {"response-content-type": "text/plain", "location": ""}
+        client = Minio("s3.example.org", "access", "secret", region="us-west-2")
+        presigner = Presigner("s3.example.org", "access", "secret", "us-west-2")
+        url = presigner.presign(
+            "GET", "bucket", "a.jpg", 60, now=now, query_params=query_params
+        )
+        expected = client.get_presigned_url(
+            "GET",
+            "bucket",
+            "a.jpg",
+            expires=timedelta(seconds=60),
+            request_date=now,
+            extra_query_params=query_params,
+        )
+        # the signature covers the canonical (sorted) query, whatever the order in the URL
+        self.assertEqual(urlsplit(url).path, urlsplit(expected).path)
+        self.assertEqual(
+            parse_qs(urlsplit(url).query, keep_blank_values=True),
+            parse_qs(urlsplit(expected).query, keep_blank_values=True),
+        )
+
+    def test_signing_key_derived_once_per_day(self):
+        presigner = Presigner("s3.example.org", "access", "secret", "us-east-1")
+        key = presigner.get_signing_key("20261018")
+        with patch("downloads.signing.hmac.new") as hmac_new:
+            self.assertIs(presigner.get_signing_key("20261018"), key)
+            hmac_new.assert_not_called()
+        self.assertNotEqual(presigner.get_signing_key("20261019"), key)
+        self.assertEqual(list(presigner.signing_keys), ["20261019"])
+
+    def test_region_required(self):
+        with self.assertRaises(ValueError):
+            Presigner("s3.example.org", "access", "secret", "")
+
+    @override_settings(
+        S3_ENDPOINT="s3.example.org", S3_REGION="", S3_BUCKET_NAME="bucket"
+    )
+    def test_bucket_region_looked_up(self):
+        get_bucket_location.cache_clear()
+        self.addCleanup(get_bucket_location.cache_clear)
+        response = MagicMock(
+            content=b'<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            b"us-west-2</LocationConstraint>"
+        )
+        with patch("downloads.views.requests.get", return_value=response) as get:
+            url = get_osn_presigned_url(Item("job", "task", "node", "1-a.jpg"))
+            get_osn_presigned_url(Item("job", "task", "node", "2-a.jpg"))
+        self.assertIn("%2Fus-west-2%2Fs3%2Faws4_request", url)
+
+        # the location is looked up once with a request signed for us-east-1
+        get.assert_called_once()
+        location_url = get.call_args.args[0]
+        self.assertTrue(location_url.startswith("https://s3.example.org/bucket?"))
+        self.assertIn("%2Fus-east-1%2Fs3%2Faws4_request", location_url)
+        self.assertIn(
+            "&X-Amz-SignedHeaders=host&location=&X-Amz-Signature=", location_url
+        )
+
+        # buckets in us-east-1 have no location constraint
+        response.content = (
+            b'<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/"/>'
+        )
+        with patch("downloads.views.requests.get", return_value=response):
+            self.assertEqual(
+                get_bucket_location("s3.example.org", "other"), "us-east-1"
+            )
+
+
+class PelicanTokenTest(TestCase):
+    def write_key(self, path):
+        key = ec.generate_private_key(ec.SECP256R1())
+        with open(path, "wb") as f:
+            f.write(
+                key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.NoEncryption(),
+                )
+            )
+        return key
+
+    def test_key_reloaded_on_change(self):
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "key.pem")
+            self.write_key(path)
+            key = get_signing_key(path)
+            with patch("downloads.pelican.load_pem_private_key") as load:
+                self.assertIs(get_signing_key(path), key)
+                load.assert_not_called()
+
+            new_key = self.write_key(path)
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(
+                get_signing_key(path).private_numbers(), new_key.private_numbers()
+            )
+
+    def test_token_claims(self):
+        key = ec.generate_private_key(ec.SECP256R1())
+        token = sign_scitoken(
+            {"scope": "read:/path", "ver": "scitoken:2.0", "aud": "ANY"},
+            key=key,
+            algorithm="ES256",
+            key_id="kid1",
+            issuer="https://issuer.example.org",
+            lifetime=60,
+            lag=60,
+            now=1_000_000,
+        )
+        self.assertEqual(jwt.get_unverified_header(token)["kid"], "kid1")
+        claims = jwt.decode(
+            token,
+            key.public_key(),
+            algorithms=["ES256"],
+            audience="ANY",
+            options={"verify_exp": False, "verify_nbf": False, "verify_iat": False},
+        )
+        self.assertEqual(claims["iss"], "https://issuer.example.org")
+        self.assertEqual(claims["scope"], "read:/path")
+        self.assertEqual(claims["nbf"], 1_000_000 - 60)
+        self.assertEqual(claims["iat"], 1_000_000 - 60)
+        self.assertEqual(claims["exp"], 1_000_000 + 60)
+        self.assertIn("jti", claims)
+
+
+@override_settings(
+    S3_ENDPOINT="s3.example.org",
+    S3_ACCESS_KEY="access",
+    S3_SECRET_KEY="secret",
+    S3_REGION="us-east-1",
+    S3_BUCKET_NAME="bucket",
+)
+class BatchDownloadsTest(TestCase):
+    def setUp(self):
+        caches["downloads"].clear()
+        self.client_mock = MagicMock()
+        self.client_mock.list_objects.side_effect = (
+            lambda bucket_name, prefix, recursive: [
+                SimpleNamespace(object_name=f"{prefix}1700000000000000000-a.jpg")
+            ]
+        )
+        for patcher in [
+            patch("downloads.views.get_minio_client", return_value=self.client_mock),
+            patch(
+                "downloads.views.get_pelican_authz_url",
+                side_effect=lambda item: f"https://pelican/{item.timestamp_and_filename}",
+            ),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create(username="user")
+        self.private = Node.objects.create(vsn="W001", mac="0000000000000001")
+        self.other = Node.objects.create(vsn="W002", mac="0000000000000002")
+        project = Project.objects.create(name="project")
+        UserMembership.objects.create(
+            project=project, user=self.user, can_access_files=True
+        )
+        NodeMembership.objects.create(project=project, node=self.private)
+
+    def post(self, paths):
+        return self.client.post(
+            "/downloads/batch", {"paths": paths}, content_type="application/json"
+        )
+
+    def test_batch(self):
+        self.client.force_login(self.user)
+        paths = [
+            "job/task/0000000000000001/1700000000000000000-a.jpg",
+            "job/task/0000000000000001/1700000000000000001-b.jpg",
+            "job/task/0000000000000002/1700000000000000000-a.jpg",
+            "job/task/0000000000000009/1700000000000000000-a.jpg",
+            "not/a/path",
+        ]
+        # session, user, one node lookup and one permission check per node
+        with self.assertNumQueries(5):
+            r = self.post(paths)
+        self.assertEqual(r.status_code, 200)
+        results = r.json()["results"]
+        self.assertEqual([result["path"] for result in results], paths)
+        self.assertTrue(
+            results[0]["url"].startswith(
+                "https://s3.example.org/bucket/node-data/job/task/0000000000000001/1700000000000000000-a.jpg?"
+            )
+        )
+        self.assertEqual(results[1]["url"], "https://pelican/1700000000000000001-b.jpg")
+        self.assertEqual(results[2]["error"], "permission denied")
+        self.assertEqual(results[3]["error"], "not found")
+        self.assertEqual(results[4]["error"], "invalid path")
+        # one listing per prefix and no stats
+        self.assertEqual(self.client_mock.list_objects.call_count, 1)
+        self.client_mock.stat_object.assert_not_called()
+
+    def test_anonymous_public_files(self):
+        self.other.files_public = True
+        self.other.commissioning_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.other.save()
+        r = self.post(
+            [
+                "job/task/0000000000000002/1700000000000000000-a.jpg",
+                "job/task/0000000000000001/1700000000000000000-a.jpg",
+            ]
+        )
+        self.assertEqual(r.status_code, 200)
+        results = r.json()["results"]
+        self.assertIn("url", results[0])
+        self.assertEqual(results[1]["error"], "permission denied")
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post([]).status_code, 400)
+        r = self.client.post("/downloads/batch", {}, content_type="application/json")
+        self.assertEqual(r.status_code, 400)
+        with override_settings(DOWNLOADS_BATCH_MAX_PATHS=1):
+            self.assertEqual(self.post(["a", "b"]).status_code, 400)
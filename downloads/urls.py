@@ -1,7 +1,8 @@
 from django.urls import path
-from .views import DownloadsView
+from .views import DownloadsView, BatchDownloadsView
 
 urlpatterns = [
+    path("batch", BatchDownloadsView.as_view()),
     path(
         "<str:job_id>/<str:task_id>/<str:node_id>/<str:timestamp_and_filename>",
         DownloadsView.as_view(),
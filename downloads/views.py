@@ -6,31 +6,40 @@ from django.http import (
     HttpResponseNotFound,
 )
 from django.http.response import HttpResponseBase
+from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework import status
 from app.models import Node, Project
 from minio import Minio
 from minio.error import S3Error
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from django.conf import settings
+from django.db.models import Q
+from django.core.cache import caches
 import rest_framework.authentication
 import app.authentication
-from pathlib import Path
-from scitokens import SciToken
 from dataclasses import dataclass
+import hashlib
+import os
 import os.path
+import threading
+from functools import lru_cache
+from xml.etree import ElementTree
+import certifi
+import urllib3
 from app.models import User
 import requests
 from .authentication import BasicTokenPasswordAuthentication
+from .serializers import BatchDownloadsSerializer
+from .pelican import get_signing_key, sign_scitoken
+from .signing import Presigner, get_presigner
 from rest_framework.authentication import (
     BasicAuthentication,
     SessionAuthentication,
     TokenAuthentication,
 )
 from app.authentication import TokenAuthentication as SageTokenAuthentication
-import time
-from unittest.mock import patch
 import logging
 
 
@@ -51,16 +60,49 @@ class Item:
         return datetime.fromtimestamp(timestamp, tz=timezone.utc)
 
 
-def get_minio_client():
+def new_minio_client():
+    http_client = urllib3.PoolManager(
+        timeout=urllib3.Timeout(
+            connect=settings.S3_CONNECT_TIMEOUT, read=settings.S3_READ_TIMEOUT
+        ),
+        # connections are kept alive and reused by requests from all of the worker's threads
+        maxsize=settings.S3_POOL_MAXSIZE,
+        block=False,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(
+            total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+        ),
+    )
     return Minio(
         endpoint=settings.S3_ENDPOINT,
         access_key=settings.S3_ACCESS_KEY,
         secret_key=settings.S3_SECRET_KEY,
         region=settings.S3_REGION,
-        secure=True,
+        secure=settings.S3_SECURE,
+        http_client=http_client,
     )
 
 
+_minio_client = None
+_minio_client_pid = None
+_minio_client_lock = threading.Lock()
+
+
+def get_minio_client():
+    """
+    Returns the process wide Minio client. A new client is created after a fork, such as gunicorn
+    starting its workers, so processes never share pooled connections.
+    """
+    global _minio_client, _minio_client_pid
+    pid = os.getpid()
+    with _minio_client_lock:
+        if _minio_client is None or _minio_client_pid != pid:
+            _minio_client = new_minio_client()
+            _minio_client_pid = pid
+        return _minio_client
+
+
 def get_osn_object_name(item: Item):
     return "/".join(
         [
@@ -73,14 +115,45 @@ def get_osn_object_name(item: Item):
     )
 
 
+@lru_cache(maxsize=8)
+def get_bucket_location(endpoint, bucket_name):
+    """
+    Returns the region of bucket_name at endpoint from the GetBucketLocation API, which is signed
+    for us-east-1 whatever the bucket's region. Locations are cached for the life of the process.
+    """
+    url = Presigner(
+        endpoint,
+        settings.S3_ACCESS_KEY,
+        settings.S3_SECRET_KEY,
+        "us-east-1",
+        settings.S3_SECURE,
+    ).presign("GET", bucket_name, "", 60, query_params={"location": ""})
+    r = requests.get(
+        url,
+        timeout=(settings.S3_CONNECT_TIMEOUT, settings.S3_READ_TIMEOUT),
+        verify=os.environ.get("SSL_CERT_FILE") or certifi.where(),
+    )
+    r.raise_for_status()
+    # buckets in us-east-1 have an empty location constraint
+    return ElementTree.fromstring(r.content).text or "us-east-1"
+
+
+def get_osn_region():
+    """
+    Returns S3_REGION or, if it isn't set, the location of the OSN bucket.
+    """
+    if settings.S3_REGION:
+        return settings.S3_REGION
+    return get_bucket_location(settings.S3_ENDPOINT, settings.S3_BUCKET_NAME)
+
+
 def get_osn_presigned_url(item: Item):
-    client = get_minio_client()
     object_name = get_osn_object_name(item)
-    return client.get_presigned_url(
+    return get_presigner(get_osn_region()).presign(
         method="GET",
         bucket_name=settings.S3_BUCKET_NAME,
         object_name=object_name,
-        expires=timedelta(seconds=60),
+        expires=60,
     )
 
 
@@ -93,18 +166,82 @@ def stat_osn_object(item: Item):
     )
 
 
+def get_osn_prefix(item: Item):
+    return "/".join(["node-data", item.job_id, item.task_id, item.node_id])
+
+
+def get_exists_cache_key(object_name):
+    # object names can exceed the key length some cache backends support
+    return "osn-exists:" + hashlib.sha256(object_name.encode()).hexdigest()
+
+
+def get_listed_cache_key(prefix):
+    return "osn-listed:" + hashlib.sha256(prefix.encode()).hexdigest()
+
+
 def object_exists_in_osn(item: Item):
-    client = get_minio_client()
+    """
+    Returns whether the item exists in OSN. Results are cached for S3_EXISTS_CACHE_TTL seconds, so an
+    object uploaded after a negative result is served from OSN once the result expires.
+    """
+    cache = caches["downloads"]
     object_name = get_osn_object_name(item)
 
+    exists = cache.get(get_exists_cache_key(object_name))
+    if exists is not None:
+        return exists
+
+    listed = get_osn_listing(get_osn_prefix(item), warm=settings.S3_EXISTS_CACHE_WARM)
+    if listed is not None:
+        return object_name in listed
+
+    client = get_minio_client()
+
     try:
         client.stat_object(
             bucket_name=settings.S3_BUCKET_NAME,
             object_name=object_name,
         )
-        return True
-    except S3Error:
-        return False
+        exists = True
+    except S3Error as e:
+        if e.code not in ("NoSuchKey", "NoSuchObject", "NotFound"):
+            return False
+        exists = False
+
+    cache.set(get_exists_cache_key(object_name), exists)
+    return exists
+
+
+def get_osn_listing(prefix, warm=True):
+    """
+    Returns the set of object names under prefix from the cache or, if warm is set, from a new
+    listing. Returns None if the prefix isn't cached and not warmed or has too many objects to cache.
+    """
+    listed = caches["downloads"].get(get_listed_cache_key(prefix))
+    if listed is None and warm:
+        listed = warm_osn_prefix(prefix)
+    return listed if isinstance(listed, set) else None
+
+
+def warm_osn_prefix(prefix):
+    """
+    Lists the objects under prefix and caches their names as one entry. Returns the set of object
+    names, or False if the prefix has more than S3_EXISTS_LISTING_LIMIT objects, which is cached so
+    the prefix's objects are stated instead of listed again.
+    """
+    client = get_minio_client()
+
+    object_names = set()
+    for obj in client.list_objects(
+        bucket_name=settings.S3_BUCKET_NAME, prefix=prefix + "/", recursive=True
+    ):
+        object_names.add(obj.object_name)
+        if len(object_names) > settings.S3_EXISTS_LISTING_LIMIT:
+            object_names = False
+            break
+
+    caches["downloads"].set(get_listed_cache_key(prefix), object_names)
+    return object_names
 
 
 def get_pelican_path(item: Item):
@@ -120,60 +257,58 @@ def get_pelican_path(item: Item):
 def get_pelican_authz_url(item: Item):
     path = get_pelican_path(item)
 
-    key = Path(settings.PELICAN_KEY_PATH).read_bytes()
-
-    token = SciToken(
-        key=key,
-        algorithm=settings.PELICAN_ALGORITHM,
-        key_id=settings.PELICAN_KEY_ID,
-    )
     # See the Scitoken reference for more info on these fields:
     # https://scitokens.org/technical_docs/Claims
-    token["sub"] = "test"
-    token["aud"] = "ANY"
-    token["ver"] = "scitoken:2.0"
-    token["scope"] = f"read:{path}"
-
-    authz = serialize_scitoken_with_lag(
-        token,
+    claims = {
+        "sub": "test",
+        "aud": "ANY",
+        "ver": "scitoken:2.0",
+        "scope": f"read:{path}",
+    }
+
+    authz = sign_scitoken(
+        claims,
+        key=get_signing_key(settings.PELICAN_KEY_PATH),
+        algorithm=settings.PELICAN_ALGORITHM,
+        key_id=settings.PELICAN_KEY_ID,
         issuer=settings.PELICAN_ISSUER,
         lifetime=settings.PELICAN_LIFETIME,
         lag=60,
-    ).decode()
+    )
 
     return f"{settings.PELICAN_ROOT_URL}{path}?authz={authz}"
 
 
-# serialize_scitoken_with_lag is a **hack** to get around not being able to override the "not before"
-# claim in the scitokens library. The details of this claim can be found here:
-# https://scitokens.org/technical_docs/Claims
-#
-# As a reference, the scitokens library simply uses time.time to set the "not before" claim:
-# https://github.com/scitokens/scitokens/blob/3f6400e87a76c7c25cbb4e4e6bc35f6b120c22f1/src/scitokens/scitokens.py#L142
-#
-# The reason we want this is that our use case redirects users to Pelican immediately and we suspect that slight
-# time differences between our machines and the Pelican machines may cause some tokens to be flagged as invalid.
-#
-# Adding a slight buffer should allow more tolerence between these machines.
-def serialize_scitoken_with_lag(token, issuer, lifetime, lag):
-    current_time = time.time()
-
-    def lag_time():
-        return current_time - lag
-
-    with patch("time.time", lag_time):
-        return token.serialize(
-            issuer=issuer,
-            lifetime=lifetime + lag,
-        )
-
-
 def get_redirect_url(item: Item):
     if object_exists_in_osn(item):
         return get_osn_presigned_url(item)
     return get_pelican_authz_url(item)
 
 
+def parse_item(path: str):
+    """
+    Returns the Item for a job_id/task_id/node_id/timestamp_and_filename path or None if the path
+    isn't valid.
+    """
+    parts = path.strip("/").split("/")
+    if len(parts) != 4 or not all(parts):
+        return None
+    item = Item(*parts)
+    try:
+        item.timestamp()
+    except (ValueError, OverflowError, OSError):
+        return None
+    return item
+
+
+def is_file_public(node: Node, item: Item) -> bool:
+    return (
+        node.files_public
+        and node.commissioning_date is not None
+        and item.timestamp() >= node.commissioning_date
+    )
+
+
 def has_object_permission(user: User, node: Node) -> bool:
     return Project.objects.filter(
         usermembership__user=user,
@@ -224,11 +359,7 @@ class DownloadsView(APIView):
         # TODO(sean) See if there's a cleaner way to do this. We currently compute here as we use this both in the
         # method handler and in get_permissions to allow DRF to dynamically turn on / off authentication checks for
         # public files.
-        self.file_is_public = (
-            self.node.files_public
-            and self.node.commissioning_date is not None
-            and item.timestamp() >= self.node.commissioning_date
-        )
+        self.file_is_public = is_file_public(self.node, item)
 
         return super().dispatch(request, *args, **kwargs)
 
@@ -319,3 +450,95 @@ class DownloadsView(APIView):
             f"{datetime.now(timezone.utc).isoformat()} file download denied: username={username} path={request.path} is_public={self.file_is_public}"
         )
         return HttpResponse("Permission denied", status=status.HTTP_403_FORBIDDEN)
+
+
+class BatchDownloadsView(APIView):
+    """
+    Returns the download URLs for a list of object paths in one response. Permissions are checked
+    once per node and OSN existence with one listing per job/task/node prefix, so bulk downloads
+    don't need a request, permission query and object stat per file.
+
+    Each result has either a url or an error of "invalid path", "not found" or "permission denied",
+    in the order of the requested paths.
+    """
+
+    # Basic auth with a token is included as with DownloadsView, as batches are made by scripts.
+    authentication_classes = [
+        BasicTokenPasswordAuthentication,
+        BasicAuthentication,
+        SessionAuthentication,
+        TokenAuthentication,
+        SageTokenAuthentication,
+    ]
+    permission_classes = [AllowAny]
+
+    def post(self, request: HttpRequest, format=None):
+        serializer = BatchDownloadsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        paths = serializer.validated_data["paths"]
+
+        items = {path: parse_item(path) for path in paths}
+        node_ids = {item.node_id.lower() for item in items.values() if item is not None}
+        nodes = self.get_nodes(node_ids)
+
+        can_access = {}
+        listings = {}
+        results = []
+        allowed = 0
+
+        for path in paths:
+            item = items[path]
+            if item is None:
+                results.append({"path": path, "error": "invalid path"})
+                continue
+
+            node = nodes.get(item.node_id.lower())
+            if node is None:
+                results.append({"path": path, "error": "not found"})
+                continue
+
+            if not is_file_public(node, item):
+                if node.pk not in can_access:
+                    can_access[node.pk] = (
+                        request.user.is_authenticated
+                        and has_object_permission(request.user, node)
+                    )
+                if not can_access[node.pk]:
+                    results.append({"path": path, "error": "permission denied"})
+                    continue
+
+            prefix = get_osn_prefix(item)
+            if prefix not in listings:
+                listings[prefix] = get_osn_listing(prefix)
+            listed = listings[prefix]
+            if listed is not None:
+                exists = get_osn_object_name(item) in listed
+            else:
+                exists = object_exists_in_osn(item)
+
+            if exists:
+                url = get_osn_presigned_url(item)
+            else:
+                url = get_pelican_authz_url(item)
+            results.append({"path": path, "url": url})
+            allowed += 1
+
+        username = (
+            request.user.username if request.user.is_authenticated else "anonymous"
+        )
+        logger.info(
+            f"{datetime.now(timezone.utc).isoformat()} batch file download: username={username} allowed={allowed} denied={len(paths) - allowed}"
+        )
+
+        return Response({"results": results})
+
+    def get_nodes(self, node_ids):
+        """
+        Returns a dict mapping lowercase node ids to nodes with a single query.
+        """
+        if not node_ids:
+            return {}
+        q = Q()
+        for node_id in node_ids:
+            q |= Q(mac__iexact=node_id)
+        return {node.mac.lower(): node for node in Node.objects.filter(q)}
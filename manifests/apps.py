@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class manifestsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "manifests"
+
+    def ready(self):
+        # register signal handlers which rebuild the precomputed manifest documents and track
+        # the manifests revision
+        from . import documents, revisions
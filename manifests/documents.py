@@ -0,0 +1,448 @@
+"""
+Precomputed per node manifest documents.
+
+Serializing a manifest walks about a dozen relations per node, so the rendered ManifestSerializer
+output is stored in ManifestDocument and rebuilt whenever a row which appears in a node's manifest
+changes. /manifests/ is then served by concatenating the stored documents. Each document stores
+the DOCUMENT_VERSION it was rendered with, so documents rendered before a deploy which changes the
+serializer output are treated as missing and rebuilt when first requested.
+
+Rebuilds happen immediately unless they run inside batch_rebuild(), which collects the affected
+nodes and rebuilds each of them once on exit. Queryset update() calls on the manifests models send
+pre_update and post_update, which rebuild the updated rows' nodes like saves do. Raw SQL and
+updates which bypass ManifestQuerySet must call schedule_rebuild themselves.
+"""
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from itertools import islice
+from django.db import connections, router, transaction
+from django.db.models import Case, F, Q, When
+from django.db.models.signals import (
+    post_init,
+    pre_save,
+    post_save,
+    pre_delete,
+    post_delete,
+    m2m_changed,
+)
+from django.dispatch import receiver
+from .signals import pre_update, post_update
+from rest_framework.renderers import JSONRenderer
+from .models import (
+    NodeData,
+    NodeBuildProject,
+    Tag,
+    Label,
+    Capability,
+    Modem,
+    Compute,
+    ComputeHardware,
+    ComputeSensor,
+    NodeSensor,
+    SensorHardware,
+    Resource,
+    ResourceHardware,
+    LorawanDevice,
+    LorawanConnection,
+    ManifestChange,
+    ManifestChangeCounter,
+    ManifestDocument,
+)
+from .serializers import ManifestSerializer, prefetch_active_lorawan_connections
+
+# increment whenever a change to ManifestSerializer or its nested serializers changes the rendered
+# manifests, so stored documents rendered by the previous version are rebuilt
+DOCUMENT_VERSION = 1
+
+CHANGE_COUNTER_PK = 1
+
+# prefetch lookups needed by each ManifestSerializer field
+MANIFEST_PREFETCH_FIELDS = {
+    "project": ["project"],
+    "modem": ["modem"],
+    "tags": ["tags"],
+    "computes": ["compute_set__hardware__capabilities"],
+    "sensors": [
+        "nodesensor_set__hardware__capabilities",
+        "nodesensor_set__labels",
+        "compute_set__computesensor_set__scope",
+        "compute_set__computesensor_set__hardware__capabilities",
+        "compute_set__computesensor_set__labels",
+    ],
+    "resources": ["resource_set__hardware__capabilities"],
+    "lorawanconnections": [prefetch_active_lorawan_connections()],
+}
+
+# lookups from NodeData to each model which appears in its manifest
+NODE_LOOKUPS = {
+    NodeData: ["pk"],
+    NodeBuildProject: ["project"],
+    Tag: ["tags"],
+    Modem: ["modem"],
+    Compute: ["compute"],
+    ComputeHardware: ["compute__hardware"],
+    ComputeSensor: ["compute__computesensor"],
+    NodeSensor: ["nodesensor"],
+    SensorHardware: [
+        "nodesensor__hardware",
+        "compute__computesensor__hardware",
+        "lorawanconnections__lorawan_device__hardware",
+    ],
+    Resource: ["resource"],
+    ResourceHardware: ["resource__hardware"],
+    LorawanDevice: ["lorawanconnections__lorawan_device"],
+    LorawanConnection: ["lorawanconnections"],
+    Capability: [
+        "compute__hardware__capabilities",
+        "nodesensor__hardware__capabilities",
+        "compute__computesensor__hardware__capabilities",
+        "resource__hardware__capabilities",
+        "lorawanconnections__lorawan_device__hardware__capabilities",
+    ],
+    Label: ["nodesensor__labels", "compute__computesensor__labels"],
+}
+
+logger = logging.getLogger(__name__)
+
+renderer = JSONRenderer()
+
+_batch = threading.local()
+
+
+def get_manifest_queryset():
+    lookups = []
+    for field_lookups in MANIFEST_PREFETCH_FIELDS.values():
+        lookups += field_lookups
+    return NodeData.objects.prefetch_related(*lookups)
+
+
+def render_manifest(node):
+    """
+    Returns the manifest for node rendered exactly as the JSON API would render it.
+    """
+    return renderer.render(ManifestSerializer(node).data)
+
+
+def rebuild_manifest_documents(node_ids=None):
+    """
+    Rebuild the manifest documents for the given node ids, or all nodes if node_ids is None.
+    Documents of nodes which no longer exist are removed.
+    """
+    if node_ids is not None:
+        node_ids = set(node_ids)
+        if not node_ids:
+            return
+
+    nodes = get_manifest_queryset()
+    if node_ids is not None:
+        nodes = nodes.filter(pk__in=node_ids)
+
+    documents = {}
+    vsns = {}
+
+    for node in nodes:
+        vsns[node.pk] = node.vsn
+        # a node with incomplete data should not block saving the change which affected it. it
+        # is left without a document and rendered on request instead.
+        try:
+            documents[node.pk] = render_manifest(node).decode()
+        except Exception:
+            logger.exception("failed to render manifest document for %s", node.vsn)
+
+    with transaction.atomic():
+        stored = ManifestDocument.objects.all()
+        if node_ids is not None:
+            stored = stored.filter(node_id__in=node_ids)
+        previous = {}
+        versions = {}
+        for node_id, document, version in stored.values_list(
+            "node_id", "document", "version"
+        ):
+            previous[node_id] = document
+            versions[node_id] = version
+        stored.exclude(node_id__in=documents.keys()).delete()
+        # concurrent rebuilds, such as the first requests for nodes without documents, may store
+        # the same documents, so existing rows are updated instead of conflicting
+        ManifestDocument.objects.bulk_create(
+            [
+                ManifestDocument(
+                    node_id=node_id, document=document, version=DOCUMENT_VERSION
+                )
+                for node_id, document in documents.items()
+                if document != previous.get(node_id)
+                or versions.get(node_id) != DOCUMENT_VERSION
+            ],
+            update_conflicts=True,
+            update_fields=["document", "version", "updated_at"],
+            **get_unique_fields(ManifestDocument, ["node"]),
+        )
+        changes = get_changes(previous, documents, vsns)
+        if changes:
+            revision = allocate_change_revision()
+            for change in changes:
+                change.revision = revision
+            ManifestChange.objects.bulk_create(changes)
+
+
+def get_unique_fields(model, fields):
+    """
+    Returns the unique_fields argument for bulk_create with update_conflicts, which MySQL doesn't
+    accept as it updates on conflicts with any unique index.
+    """
+    if connections[
+        router.db_for_write(model)
+    ].features.supports_update_conflicts_with_target:
+        return {"unique_fields": fields}
+    return {}
+
+
+def get_changes(previous, documents, vsns):
+    """
+    Returns the ManifestChange rows for replacing the previous documents with documents. vsns
+    maps the id of every existing node to its vsn. Removals come first so a vsn which moved to
+    another node within the same rebuild ends up changed. Nodes whose stored document is the same
+    as before, including nodes which still fail to render, are not changed.
+    """
+    changes = []
+
+    for node_id, document in previous.items():
+        # the document is the only record of the vsn of deleted or renamed nodes
+        vsn = json.loads(document)["vsn"]
+        if vsns.get(node_id) != vsn:
+            changes.append(ManifestChange(vsn=vsn, removed=True))
+
+    for node_id, vsn in sorted(vsns.items(), key=lambda item: item[1]):
+        if documents.get(node_id) != previous.get(node_id):
+            changes.append(ManifestChange(vsn=vsn))
+
+    return changes
+
+
+def current_document():
+    """
+    Returns an expression for a node's stored document, or None if it has none of the current
+    DOCUMENT_VERSION.
+    """
+    return Case(
+        When(
+            manifest_document__version=DOCUMENT_VERSION,
+            then=F("manifest_document__document"),
+        )
+    )
+
+
+def get_manifest_documents(nodes):
+    """
+    Returns a list of (vsn, rendered manifest) for the nodes queryset, ordered by vsn. Nodes without
+    a current stored document are rendered and stored.
+    """
+    return fill_missing_documents(
+        list(nodes.order_by("vsn").values_list("pk", "vsn", current_document()))
+    )
+
+
+def iter_manifest_documents(nodes, chunk_size=100):
+    """
+    Like get_manifest_documents but only holds chunk_size documents in memory at a time.
+    """
+    rows = (
+        nodes.order_by("vsn")
+        .values_list("pk", "vsn", current_document())
+        .iterator(chunk_size=chunk_size)
+    )
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield from fill_missing_documents(chunk)
+
+
+def fill_missing_documents(rows):
+    """
+    Takes a list of (pk, vsn, document or None) rows and returns a list of (vsn, rendered manifest).
+    """
+    missing = [pk for pk, _, document in rows if document is None]
+    if missing:
+        rebuild_manifest_documents(missing)
+        documents = dict(
+            ManifestDocument.objects.filter(node_id__in=missing).values_list(
+                "node_id", "document"
+            )
+        )
+        rows = [
+            (pk, vsn, document if document is not None else documents.get(pk))
+            for pk, vsn, document in rows
+        ]
+
+    return [
+        (
+            vsn,
+            document.encode()
+            if document is not None
+            else render_manifest(get_manifest_queryset().get(pk=pk)),
+        )
+        for pk, vsn, document in rows
+    ]
+
+
+def allocate_change_revision():
+    """
+    Returns the revision for the changes of a rebuild. Must be called within the rebuild's
+    transaction, as the counter row stays locked until it commits so later rebuilds get later
+    revisions only once the earlier changes are visible.
+    """
+    counter, _ = ManifestChangeCounter.objects.select_for_update().get_or_create(
+        pk=CHANGE_COUNTER_PK
+    )
+    counter.revision += 1
+    counter.save(update_fields=["revision"])
+    return counter.revision
+
+
+def get_change_revision():
+    """
+    Returns (revision, pruned revision) of the manifest changes, or (0, 0) if nothing has changed
+    yet. Changes up to the pruned revision have been deleted.
+    """
+    row = ManifestChangeCounter.objects.filter(pk=CHANGE_COUNTER_PK).values_list(
+        "revision", "pruned_revision"
+    )
+    return row.first() or (0, 0)
+
+
+def get_changes_since(since, revision):
+    """
+    Returns the sorted lists of (changed, removed) vsns for changes after since up to revision.
+    The latest change of each vsn wins.
+    """
+    removed_by_vsn = dict(
+        ManifestChange.objects.filter(revision__gt=since, revision__lte=revision)
+        .order_by("revision", "id")
+        .values_list("vsn", "removed")
+    )
+    changed = sorted(vsn for vsn, removed in removed_by_vsn.items() if not removed)
+    removed = sorted(vsn for vsn, removed in removed_by_vsn.items() if removed)
+    return changed, removed
+
+
+def get_node_ids(model, pks):
+    """
+    Returns the ids of nodes whose manifest includes any of the model rows with pks.
+    """
+    q = Q()
+    for lookup in NODE_LOOKUPS[model]:
+        q |= Q(pk__in=NodeData.objects.filter(**{f"{lookup}__in": pks}).values("pk"))
+    return set(NodeData.objects.filter(q).values_list("pk", flat=True))
+
+
+def schedule_rebuild(node_ids):
+    pending = getattr(_batch, "pending", None)
+    if pending is not None:
+        pending.update(node_ids)
+    else:
+        rebuild_manifest_documents(node_ids)
+
+
+@contextmanager
+def batch_rebuild():
+    """
+    Defers rebuilds scheduled within the block and rebuilds each affected node once on exit.
+    """
+    if getattr(_batch, "pending", None) is not None:
+        yield
+        return
+    _batch.pending = set()
+    try:
+        yield
+    finally:
+        node_ids, _batch.pending = _batch.pending, None
+        rebuild_manifest_documents(node_ids)
+
+
+# fields which attach a row to the node whose manifest includes it. saving a row with a changed
+# value moves it, so the manifest of the node it was moved from changes too.
+NODE_FIELDS = {
+    Modem: "node_id",
+    Compute: "node_id",
+    ComputeSensor: "scope_id",
+    NodeSensor: "node_id",
+    Resource: "node_id",
+    LorawanConnection: "node_id",
+}
+
+
+def track_node_field(sender, instance, **kwargs):
+    # avoid loading deferred fields just to track them
+    instance._manifest_node_field = instance.__dict__.get(NODE_FIELDS[sender])
+
+
+# rows moved to another node are no longer related to the old node after the save, so the old
+# node is found beforehand, as for deletes
+def collect_for_save(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding:
+        return
+    old = getattr(instance, "_manifest_node_field", None)
+    if old is None or old != getattr(instance, NODE_FIELDS[sender]):
+        instance._manifest_node_ids = get_node_ids(sender, [instance.pk])
+
+
+def rebuild_for_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    node_ids = get_node_ids(sender, [instance.pk])
+    node_ids |= instance.__dict__.pop("_manifest_node_ids", set())
+    schedule_rebuild(node_ids)
+    if sender in NODE_FIELDS:
+        track_node_field(sender, instance)
+
+
+# related rows are gone after the delete, so affected nodes are found beforehand
+def collect_for_delete(sender, instance, **kwargs):
+    instance._manifest_node_ids = get_node_ids(sender, [instance.pk])
+
+
+def rebuild_for_delete(sender, instance, **kwargs):
+    schedule_rebuild(instance.__dict__.pop("_manifest_node_ids", ()))
+
+
+# updates may move rows to other nodes, so their nodes are found beforehand too
+def collect_for_update(sender, pks, state, **kwargs):
+    state["manifest_node_ids"] = get_node_ids(sender, pks)
+
+
+def rebuild_for_update(sender, pks, state, **kwargs):
+    schedule_rebuild(get_node_ids(sender, pks) | state.pop("manifest_node_ids", set()))
+
+
+# handlers are connected per model, as handlers for any sender would prevent fast deletes everywhere
+for model in NODE_LOOKUPS:
+    post_save.connect(rebuild_for_save, sender=model)
+    pre_delete.connect(collect_for_delete, sender=model)
+    post_delete.connect(rebuild_for_delete, sender=model)
+    post_update.connect(rebuild_for_update, sender=model)
+
+for model in NODE_FIELDS:
+    post_init.connect(track_node_field, sender=model)
+    pre_save.connect(collect_for_save, sender=model)
+    pre_update.connect(collect_for_update, sender=model)
+
+
+@receiver(m2m_changed, sender=NodeData.tags.through)
+@receiver(m2m_changed, sender=ComputeHardware.capabilities.through)
+@receiver(m2m_changed, sender=SensorHardware.capabilities.through)
+@receiver(m2m_changed, sender=ResourceHardware.capabilities.through)
+@receiver(m2m_changed, sender=NodeSensor.labels.through)
+@receiver(m2m_changed, sender=ComputeSensor.labels.through)
+def rebuild_for_m2m_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action == "pre_clear":
+        # pk_set is not provided when clearing, so find the related nodes before they're removed
+        instance._manifest_node_ids = get_node_ids(type(instance), [instance.pk])
+    elif action == "post_clear":
+        schedule_rebuild(instance.__dict__.pop("_manifest_node_ids", ()))
+    elif action in ("post_add", "post_remove"):
+        if reverse:
+            schedule_rebuild(get_node_ids(model, pk_set))
+        else:
+            schedule_rebuild(get_node_ids(type(instance), [instance.pk]))
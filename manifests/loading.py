@@ -0,0 +1,468 @@
+"""
+Loading of scraped node manifests into the manifests models.
+
+A scraped manifest.json is first turned into a plan: plain data describing the node, its modem,
+computes, compute sensors and resources, with hardware referred to by name. Building a plan doesn't
+touch the database. Plans are then applied either one node at a time with apply_plan, or in batches
+with apply_plans_bulk, which replaces the per row get_or_create / update_or_create round trips with a
+few bulk reads and writes.
+
+read_plan doesn't touch the database either, so it can run in worker processes.
+"""
+import json
+from collections import Counter
+from pathlib import Path
+from django.db import transaction
+from django.utils import timezone
+from app.models import Node
+from .documents import batch_rebuild, schedule_rebuild
+from .models import (
+    NodeData,
+    Modem,
+    Compute,
+    ComputeHardware,
+    ComputeSensor,
+    LoadedManifest,
+    SensorHardware,
+    Resource,
+    ResourceHardware,
+)
+from .revisions import batch_revision, bump_revision
+import manifests.management.commands.mappers.compute_mappers as cm
+import manifests.management.commands.mappers.sensor_mappers as sm
+import manifests.management.commands.mappers.resource_mappers as rm
+
+MODEM_FIELDS = ["imei", "imsi", "iccid", "carrier"]
+COMPUTE_FIELDS = ["name", "zone", "is_active", "hardware_id"]
+COMPUTE_SENSOR_FIELDS = ["hardware_id", "is_active"]
+RESOURCE_FIELDS = ["hardware_id"]
+
+
+def read_plan(vsn, path):
+    """
+    Returns the plan for the scraped manifest.json at path.
+
+    Raises ValueError if the file isn't valid JSON.
+    """
+    return build_plan(vsn, json.loads(Path(path).read_text()))
+
+
+def build_plan(vsn, data):
+    """
+    Returns the plan for loading the scraped manifest data of vsn.
+
+    Devices whose hostname matches no compute alias or whose hardware can't be determined are listed
+    in the plan's unmatched (hostname, reason) pairs; the latter are left out of the plan.
+    """
+    computes = {}
+    resources = {}
+    serials_seen = []
+    unmatched = []
+
+    for _, dev in data.get("devices", {}).items():
+        serials_seen.append(dev.get("serial"))
+
+        if str(dev.get("reachable", "no")).lower() == "no":
+            continue  # Skip unreachable devices
+
+        serial = dev.get("serial")
+        hostname = dev.get("Static hostname", "")
+        alias, matched = cm.get_alias_matcher().resolve(hostname, dev)
+        if not matched:
+            unmatched.append((hostname, f"no alias matched, loaded as {alias}"))
+
+        try:
+            hardware = cm.Get_hardware_name_for_alias(alias, dev)
+        except ValueError as e:
+            # the rest of the node can still be loaded, so the device is only reported
+            unmatched.append((hostname, f"skipped: {e}"))
+            continue
+
+        compute = computes.setdefault(serial, {"serial_no": serial, "sensors": {}})
+        compute["name"] = alias
+        compute["zone"] = dev.get("k8s", {}).get("labels", {}).get("zone")
+        compute["hardware"] = hardware
+
+        for mapper in sm.COMPUTE_SENSOR_MAPPERS:
+            for name in mapper["sensor_names"](dev):
+                compute["sensors"][name] = mapper["hardware_name"](name)
+
+        for mapper in rm.RESOURCE_MAPPERS:
+            for name in mapper["resouce_names"](dev):
+                resources[name] = mapper["hardware_name"](name)
+
+    return {
+        "vsn": vsn,
+        "name": data.get("node_id"),
+        "modem": get_modem_plan(data),
+        "computes": list(computes.values()),
+        "resources": resources,
+        "serials_seen": serials_seen,
+        "unmatched": unmatched,
+    }
+
+
+def get_modem_plan(data):
+    modem = data.get("network", {}).get("modem", {}).get("3gpp", {})
+    if not modem:
+        return None
+
+    sim = data.get("network", {}).get("sim", {}).get("properties", {})
+    if not sim:
+        return None
+
+    return {
+        "imei": modem.get("imei"),
+        "imsi": sim.get("imsi"),
+        "iccid": sim.get("iccid"),
+        "carrier": modem.get("operator_id", ""),
+    }
+
+
+class HardwareRegistry:
+    """
+    Run scoped cache of ComputeHardware, SensorHardware and ResourceHardware by name. All hardware
+    is loaded once on first use; hardware missing for a set of plans is created with one bulk insert
+    per model when the plans are prepared.
+    """
+
+    models = [ComputeHardware, SensorHardware, ResourceHardware]
+
+    def __init__(self):
+        self.hardware = None
+
+    def load(self):
+        if self.hardware is None:
+            self.hardware = {
+                model: first_by_key(model.objects.all(), lambda h: h.hardware)
+                for model in self.models
+            }
+
+    def prepare(self, plans):
+        """
+        Creates the hardware used by plans which doesn't exist yet. Returns a Counter of
+        (model name, "created").
+        """
+        self.load()
+        summary = Counter()
+        names = {
+            ComputeHardware: {c["hardware"] for p in plans for c in p["computes"]},
+            SensorHardware: {
+                h for p in plans for c in p["computes"] for h in c["sensors"].values()
+            },
+            ResourceHardware: {h for p in plans for h in p["resources"].values()},
+        }
+        for model, model_names in names.items():
+            missing_names = sorted(model_names - self.hardware[model].keys())
+            if missing_names:
+                model.objects.bulk_create(
+                    [model(hardware=name) for name in missing_names]
+                )
+                # bulk_create doesn't set primary keys on databases such as MySQL, so the new rows
+                # are read back
+                created = model.objects.filter(hardware__in=missing_names)
+                self.hardware[model].update(first_by_key(created, lambda h: h.hardware))
+            summary[(model.__name__, "created")] += len(missing_names)
+        return summary
+
+    def get(self, model, name):
+        """
+        Returns the model hardware named name. The plans using it must have been prepared.
+        """
+        return self.hardware[model][name]
+
+
+def apply_plan(plan, registry=None):
+    """
+    Applies a single plan row by row. Returns the NodeData for the plan. The node's manifest
+    document is rebuilt and the revision bumped once after all of its rows are synced.
+    """
+    with batch_rebuild(), batch_revision():
+        return _apply_plan(plan, registry)
+
+
+def _apply_plan(plan, registry):
+    if registry is None:
+        registry = HardwareRegistry()
+    registry.prepare([plan])
+
+    node, _ = NodeData.objects.get_or_create(vsn=plan["vsn"])
+    app_node, _ = Node.objects.get_or_create(vsn=plan["vsn"])
+
+    # Update name (~node ID) for both the app and manifest node models, if exists in manifest.
+    if plan["name"] is not None:
+        node.name = plan["name"]
+        node.save()
+        app_node.mac = plan["name"]
+        app_node.save()
+
+    if plan["modem"] is not None:
+        Modem.objects.update_or_create(node=node, defaults=plan["modem"])
+
+    for c in plan["computes"]:
+        compute, _ = Compute.objects.update_or_create(
+            node=node,
+            serial_no=c["serial_no"],
+            defaults={
+                "name": c["name"],
+                "zone": c["zone"],
+                "is_active": True,
+                "hardware": registry.get(ComputeHardware, c["hardware"]),
+            },
+        )
+        for name, hardware in c["sensors"].items():
+            ComputeSensor.objects.update_or_create(
+                scope=compute,
+                name=name,
+                defaults={
+                    "hardware": registry.get(SensorHardware, hardware),
+                    "is_active": True,
+                },
+            )
+
+    for name, hardware in plan["resources"].items():
+        Resource.objects.update_or_create(
+            node=node,
+            name=name,
+            defaults={"hardware": registry.get(ResourceHardware, hardware)},
+        )
+
+    return node
+
+
+def apply_plans_bulk(plans, registry=None):
+    """
+    Applies plans in a single transaction using a fixed number of queries per model, independent of
+    the number of plans. Returns a Counter of (model name, "created" | "updated" | "unchanged").
+
+    Bulk writes don't send signals, so the manifest documents and revision are updated here. App
+    nodes are still saved one by one as their signals issue auth tokens and track node users.
+    """
+    summary = Counter()
+    changed_node_ids = set()
+
+    with transaction.atomic(), batch_rebuild(), batch_revision():
+        if registry is None:
+            registry = HardwareRegistry()
+        summary += registry.prepare(plans)
+
+        existing_nodes = NodeData.objects.in_bulk(
+            [p["vsn"] for p in plans], field_name="vsn"
+        )
+        nodes, changed = bulk_upsert(
+            NodeData,
+            existing_nodes,
+            {
+                p["vsn"]: {
+                    "vsn": p["vsn"],
+                    "name": get_node_name(p, existing_nodes.get(p["vsn"])),
+                }
+                for p in plans
+            },
+            ["name"],
+            summary,
+            reload=lambda vsns: NodeData.objects.in_bulk(vsns, field_name="vsn"),
+        )
+        changed_node_ids.update(node.pk for node in changed)
+
+        sync_app_nodes(plans, summary)
+
+        node_ids = [node.pk for node in nodes.values()]
+
+        _, changed = bulk_upsert(
+            Modem,
+            {m.node_id: m for m in Modem.objects.filter(node_id__in=node_ids)},
+            {
+                nodes[p["vsn"]].pk: {"node_id": nodes[p["vsn"]].pk, **p["modem"]}
+                for p in plans
+                if p["modem"] is not None
+            },
+            MODEM_FIELDS,
+            summary,
+        )
+        changed_node_ids.update(m.node_id for m in changed)
+
+        computes, changed = bulk_upsert(
+            Compute,
+            first_by_key(
+                Compute.objects.filter(node_id__in=node_ids),
+                lambda c: (c.node_id, c.serial_no),
+            ),
+            {
+                (nodes[p["vsn"]].pk, c["serial_no"]): {
+                    "node_id": nodes[p["vsn"]].pk,
+                    "serial_no": c["serial_no"],
+                    "name": c["name"],
+                    "zone": c["zone"],
+                    "is_active": True,
+                    "hardware_id": registry.get(ComputeHardware, c["hardware"]).pk,
+                }
+                for p in plans
+                for c in p["computes"]
+            },
+            COMPUTE_FIELDS,
+            summary,
+            reload=lambda keys: first_by_key(
+                Compute.objects.filter(node_id__in={node_id for node_id, _ in keys}),
+                lambda c: (c.node_id, c.serial_no),
+            ),
+        )
+        changed_node_ids.update(c.node_id for c in changed)
+
+        compute_ids = [c.pk for c in computes.values()]
+        node_id_by_compute_id = {c.pk: c.node_id for c in computes.values()}
+
+        _, changed = bulk_upsert(
+            ComputeSensor,
+            first_by_key(
+                ComputeSensor.objects.filter(scope_id__in=compute_ids),
+                lambda s: (s.scope_id, s.name),
+            ),
+            {
+                (scope_id, name): {
+                    "scope_id": scope_id,
+                    "name": name,
+                    "hardware_id": registry.get(SensorHardware, hardware).pk,
+                    "is_active": True,
+                }
+                for p in plans
+                for c in p["computes"]
+                for scope_id in [computes[(nodes[p["vsn"]].pk, c["serial_no"])].pk]
+                for name, hardware in c["sensors"].items()
+            },
+            COMPUTE_SENSOR_FIELDS,
+            summary,
+        )
+        changed_node_ids.update(node_id_by_compute_id[s.scope_id] for s in changed)
+
+        _, changed = bulk_upsert(
+            Resource,
+            first_by_key(
+                Resource.objects.filter(node_id__in=node_ids),
+                lambda r: (r.node_id, r.name),
+            ),
+            {
+                (nodes[p["vsn"]].pk, name): {
+                    "node_id": nodes[p["vsn"]].pk,
+                    "name": name,
+                    "hardware_id": registry.get(ResourceHardware, hardware).pk,
+                }
+                for p in plans
+                for name, hardware in p["resources"].items()
+            },
+            RESOURCE_FIELDS,
+            summary,
+        )
+        changed_node_ids.update(r.node_id for r in changed)
+
+        schedule_rebuild(changed_node_ids)
+        if any(n for (_, action), n in summary.items() if action != "unchanged"):
+            bump_revision()
+
+    return summary
+
+
+def get_loaded_hashes(vsns):
+    """
+    Returns a dict mapping vsn to the SHA-256 of the manifest last loaded for it. Nodes which have
+    since been deleted are left out so their manifests are loaded again.
+    """
+    return dict(
+        LoadedManifest.objects.filter(vsn__in=vsns)
+        .filter(vsn__in=NodeData.objects.values("vsn"))
+        .values_list("vsn", "sha256")
+    )
+
+
+def record_loaded(plans):
+    """
+    Stores the SHA-256 of the manifest each of the plans was read from. Plans with unmatched
+    devices are left out, so their manifests are loaded again once the mappers or hardware catch
+    up with them.
+    """
+    plans = [p for p in plans if not p["unmatched"]]
+    if not plans:
+        return
+    now = timezone.now()
+    bulk_upsert(
+        LoadedManifest,
+        LoadedManifest.objects.in_bulk([p["vsn"] for p in plans], field_name="vsn"),
+        {
+            p["vsn"]: {"vsn": p["vsn"], "sha256": p["sha256"], "loaded_at": now}
+            for p in plans
+        },
+        ["sha256", "loaded_at"],
+        Counter(),
+    )
+
+
+def get_node_name(plan, node):
+    if plan["name"] is not None:
+        return plan["name"]
+    return node.name if node is not None else ""
+
+
+def sync_app_nodes(plans, summary):
+    existing = Node.objects.in_bulk([p["vsn"] for p in plans], field_name="vsn")
+
+    for p in plans:
+        app_node = existing.get(p["vsn"])
+        if app_node is None:
+            Node.objects.create(vsn=p["vsn"], mac=p["name"])
+            summary[("Node", "created")] += 1
+        elif p["name"] is not None and app_node.mac != p["name"]:
+            app_node.mac = p["name"]
+            app_node.save()
+            summary[("Node", "updated")] += 1
+        else:
+            summary[("Node", "unchanged")] += 1
+
+
+def first_by_key(queryset, key):
+    """
+    Returns a dict mapping key(obj) to the first obj in queryset with that key.
+    """
+    result = {}
+    for obj in queryset.order_by("pk"):
+        result.setdefault(key(obj), obj)
+    return result
+
+
+def bulk_upsert(model, existing, wanted, fields, summary, reload=None):
+    """
+    Creates the wanted rows missing from existing and updates the existing rows whose fields differ.
+    Both existing and wanted are keyed the same way; wanted maps keys to the field values of the row.
+    Returns (rows by key for every wanted key, list of created and updated rows).
+
+    bulk_create doesn't set primary keys on databases such as MySQL. If the created rows' primary
+    keys are needed, reload must return the rows for a list of keys, keyed the same way.
+    """
+    rows = {}
+    created = {}
+    updated = []
+
+    for key, values in wanted.items():
+        obj = existing.get(key)
+        if obj is None:
+            obj = model(**values)
+            created[key] = obj
+        elif any(getattr(obj, f) != values[f] for f in fields):
+            for f in fields:
+                setattr(obj, f, values[f])
+            updated.append(obj)
+        rows[key] = obj
+
+    model.objects.bulk_create(list(created.values()))
+    if updated:
+        model.objects.bulk_update(updated, fields)
+
+    if reload is not None and any(obj.pk is None for obj in created.values()):
+        reloaded = reload(list(created))
+        created = {key: reloaded[key] for key in created}
+        rows.update(created)
+
+    summary[(model.__name__, "created")] += len(created)
+    summary[(model.__name__, "updated")] += len(updated)
+    summary[(model.__name__, "unchanged")] += len(rows) - len(created) - len(updated)
+
+    return rows, list(created.values()) + updated
@@ -0,0 +1,37 @@
+"""Custom Django command to build the precomputed manifest documents of nodes which have none."""
+
+from django.core.management.base import BaseCommand
+from manifests.documents import DOCUMENT_VERSION, rebuild_manifest_documents
+from manifests.models import NodeData
+
+
+class Command(BaseCommand):
+    help = """
+    Build the precomputed manifest documents of nodes which have none or only one rendered by an
+    older DOCUMENT_VERSION, so they aren't rendered by the first requests for them. Run after
+    deploying.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            default=False,
+            help="If provided, rebuild the documents of all nodes, not only missing ones.",
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            rebuild_manifest_documents()
+            self.stdout.write(self.style.SUCCESS("Rebuilt all manifest documents."))
+            return
+
+        node_ids = list(
+            NodeData.objects.exclude(
+                manifest_document__version=DOCUMENT_VERSION
+            ).values_list("pk", flat=True)
+        )
+        rebuild_manifest_documents(node_ids)
+        self.stdout.write(
+            self.style.SUCCESS(f"Built manifest documents for {len(node_ids)} node(s).")
+        )
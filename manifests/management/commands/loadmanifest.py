@@ -2,16 +2,31 @@
 
 import os
 from pathlib import Path
-import subprocess
+import asyncio
+import hashlib
 import json
+import queue
+import signal
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import islice
+import django
 from environ import Env
 from django.core.management.base import BaseCommand
-from manifests.models import NodeData, Modem, Compute, ComputeSensor, Resource
-from app.models import Node
-import manifests.management.commands.mappers.compute_mappers as cm
-import manifests.management.commands.mappers.sensor_mappers as sm
-import manifests.management.commands.mappers.resource_mappers as rm
+from django.db import DatabaseError, connections, transaction
+from manifests.models import Compute
+from manifests.documents import batch_rebuild
+from manifests.loading import (
+    HardwareRegistry,
+    read_plan,
+    apply_plan,
+    apply_plans_bulk,
+    get_loaded_hashes,
+    record_loaded,
+)
+from manifests.revisions import batch_revision
 
 
 class Command(BaseCommand):
@@ -20,6 +35,7 @@ class Command(BaseCommand):
     SSH and scraping tools for nodes must be set up and working.
     """
     env = Env()
+    log_lock = threading.Lock()
 
     def handle(self, *args, **options):
         """
@@ -35,10 +51,22 @@ class Command(BaseCommand):
         # Scrape nodes and load manifests
         os.chdir(self.REPO_DIR)
 
+        ready = vsns
         if not options["no_scrape"]:
-            self.scrape_nodes(vsns)
+            ready = self.scrape_nodes(
+                vsns,
+                options["concurrency"],
+                options["node_timeout"],
+                options["timeout"],
+            )
 
-        self.load_manifests(vsns)
+        self.load_manifests(
+            vsns,
+            options["batch_size"],
+            options["workers"],
+            options["force"],
+            ready=ready,
+        )
 
         self.log("Manifest loading process completed.")
 
@@ -47,7 +75,9 @@ class Command(BaseCommand):
         Log messages.
         """
         timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-        self.stdout.write(f"{timestamp} [INVENTORY_TOOLS]: {message}")
+        # scrapes log from their own thread
+        with self.log_lock:
+            self.stdout.write(f"{timestamp} [INVENTORY_TOOLS]: {message}")
 
     def add_arguments(self, parser):
         """
@@ -73,6 +103,42 @@ class Command(BaseCommand):
             default=False,
             help="If provided, will use existing manifest data and will not scrape nodes.",
         )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Number of nodes to scrape at the same time.",
+        )
+        parser.add_argument(
+            "--node-timeout",
+            type=float,
+            default=300,
+            help="Seconds after which a single node's scrape is stopped.",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=None,
+            help="Optional seconds after which all remaining scrapes are stopped.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=None,
+            help="If provided, load manifests in batches of this many nodes using bulk upserts.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes used to read and map manifests.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            default=False,
+            help="If provided, will load manifests even if unchanged since they were last loaded.",
+        )
 
     def set_constants(self, options):
         """
@@ -81,38 +147,6 @@ class Command(BaseCommand):
         self.REPO_DIR = Path(options["repo"])
         self.DATA_DIR = Path(self.REPO_DIR, "data")
 
-    def run_subprocess(self, cmd, cwd=None, input_data=None, shell=False):
-        """
-        Run subprocess command and stream output using logging.
-
-        Args:
-            cmd (list): Command to run as a list of arguments.
-            cwd (str): Working directory for the command.
-            input_data (str): Input data to write to stdin.
-            shell (bool): Whether to run the command in a shell.
-        """
-        process = subprocess.Popen(
-            cmd,
-            cwd=cwd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            stdin=subprocess.PIPE if input_data else None,
-            text=True,
-            shell=shell,
-            env=os.environ.copy(),
-        )
-
-        if input_data:
-            process.stdin.write(input_data)
-            process.stdin.close()
-
-        for line in process.stdout:
-            self.log(line.rstrip())
-
-        return_code = process.wait()
-        if return_code != 0:
-            self.log(f"Command '{' '.join(cmd)}' exited with return code {return_code}")
-
     def get_vsns(self, options):
         """
         Get VSNs from the database or use provided list.
@@ -128,116 +162,220 @@ class Command(BaseCommand):
             ]
             return vsns
 
-    def scrape_nodes(self, vsns):
+    def scrape_nodes(self, vsns, concurrency=4, node_timeout=None, timeout=None):
         """
-        Scrape node data using the scrape-nodes script.
+        Scrape node data using the scrape-nodes script, running up to concurrency scrapes at a time.
+
+        Yields each VSN as soon as its scrape has finished, failed or timed out so its manifest can
+        be loaded while other nodes are still being scraped. VSNs not scraped before the overall
+        timeout are yielded at the end.
         """
+        finished = queue.Queue()
+
+        def run():
+            try:
+                asyncio.run(
+                    self.scrape_all(vsns, finished, concurrency, node_timeout, timeout)
+                )
+            except Exception as e:
+                self.log(f"Error running scrape-nodes: {e!r}")
+            finally:
+                finished.put(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        seen = set()
+        for vsn in iter(finished.get, None):
+            seen.add(vsn)
+            yield vsn
+        thread.join()
+
+        # nodes which weren't scraped may still have a manifest from an earlier run
+        for vsn in vsns:
+            if vsn not in seen:
+                yield vsn
+
+    async def scrape_all(self, vsns, finished, concurrency, node_timeout, timeout):
         script = Path(self.REPO_DIR, "scrape-nodes")
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = [
+            asyncio.create_task(
+                self.scrape_node(script, vsn, semaphore, node_timeout, finished)
+            )
+            for vsn in vsns
+        ]
         try:
-            self.run_subprocess(
-                ["xargs", "-n1", "-P4", str(script)], input_data="\n".join(vsns)
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        except asyncio.TimeoutError:
+            self.log(f"Scraping timed out after {timeout}s.")
+
+    async def scrape_node(self, script, vsn, semaphore, node_timeout, finished):
+        async with semaphore:
+            process = await asyncio.create_subprocess_exec(
+                str(script),
+                vsn,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                env=os.environ.copy(),
+                # own process group so a hung scrape's ssh children are stopped with it
+                start_new_session=True,
             )
-        except subprocess.CalledProcessError as e:
-            self.log(f"Error running scrape-nodes: {e}")
+            try:
+                return_code = await asyncio.wait_for(
+                    self.stream_output(vsn, process), node_timeout
+                )
+                if return_code != 0:
+                    self.log(f"Scraping {vsn} exited with return code {return_code}")
+            except asyncio.TimeoutError:
+                self.log(f"Scraping {vsn} timed out after {node_timeout}s.")
+            finally:
+                # also reached when the overall timeout cancels the scrape
+                if process.returncode is None:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    await process.wait()
+        finished.put(vsn)
+
+    async def stream_output(self, vsn, process):
+        async for line in process.stdout:
+            self.log(f"{vsn}: {line.decode(errors='replace').rstrip()}")
+        return await process.wait()
+
+    def load_manifests(self, vsns, batch_size=None, workers=1, force=False, ready=None):
+        """
+        Load manifests into the database. ready optionally yields vsns in the order their manifests
+        are ready to be loaded.
+        """
+        plans = self.read_plans(vsns, workers, force, ready)
+        registry = HardwareRegistry()
+        self.unmatched = defaultdict(list)
+
+        if batch_size:
+            self.load_manifests_bulk(plans, batch_size, registry)
+        else:
+            self.load_manifests_serial(plans, registry)
+
+        self.log_unmatched()
 
-    def load_manifests(self, vsns):
+    def load_manifests_serial(self, plans, registry):
         """
-        Load manifests into the database.
+        Load manifests into the database one node at a time, each in its own transaction.
         """
-        for vsn in vsns:
-            manifest_path = Path(self.DATA_DIR, vsn, "manifest.json")
-            if not manifest_path.exists():
-                self.log(f"Missing manifest.json for {vsn}, skipping.")
+        for plan in plans:
+            vsn = plan["vsn"]
+            try:
+                # new hardware is created outside the node's transaction so the registry never
+                # caches rows which were rolled back
+                registry.prepare([plan])
+                # rebuild the node's manifest document and bump the revision once after all of
+                # its rows are synced
+                with batch_rebuild(), batch_revision(), transaction.atomic():
+                    node = apply_plan(plan, registry)
+                    record_loaded([plan])
+                    # TODO Review whether we want to automatically deactivate computes.
+                    # self._deactivate_missing_computes(node, plan["serials_seen"])
+            except DatabaseError as e:
+                self.log(f"Failed to save manifest for {vsn}, skipping: {e}")
                 continue
-            scraped = json.loads(manifest_path.read_text())
-            node, _ = NodeData.objects.get_or_create(vsn=vsn)
-            # update node and app-node
-            self._sync_node_record(node, scraped)
-            # update related models
-            self._sync_modem(node, scraped)
-            serials = self._sync_computes(node, scraped)
-            # TODO Review whether we want to automatically deactivate computes.
-            # self._deactivate_missing_computes(node, serials)
             self.log(f"Loaded manifest for {vsn}.")
 
-    def _sync_node_record(self, node, data):
-        """Sync base NodeData fields and app Node mac."""
-        app_node, _ = Node.objects.get_or_create(vsn=node.vsn)
-        # Update name (~node ID) for both the app and manifest node models, if exists in manifest.
-        name = data.get("node_id")
-        if name is not None:
-            node.name = name
-            node.save()
-            app_node.mac = node.name
-            app_node.save()
-
-    def _sync_modem(self, node, data):
-        """Create or update Modem from manifest"""
-        modem = data.get("network", {}).get("modem", {}).get("3gpp", {})
-        if not modem:
-            return
-
-        sim = data.get("network", {}).get("sim", {}).get("properties", {})
-        if not sim:
-            return
-
-        Modem.objects.update_or_create(
-            node=node,
-            defaults={
-                "imei": modem.get("imei"),
-                "imsi": sim.get("imsi"),
-                "iccid": sim.get("iccid"),
-                "carrier": modem.get("operator_id", ""),
-            },
-        )
+    def load_manifests_bulk(self, plans, batch_size, registry):
+        """
+        Load manifests into the database in batches of bulk upserts, each in its own transaction.
+        """
+        summary = Counter()
+
+        while batch := list(islice(plans, batch_size)):
+            vsns = ", ".join(p["vsn"] for p in batch)
+            try:
+                # as in the serial load, new hardware is created outside the batch's transaction
+                summary += registry.prepare(batch)
+                with batch_rebuild(), batch_revision(), transaction.atomic():
+                    summary += apply_plans_bulk(batch, registry)
+                    record_loaded(batch)
+            except DatabaseError as e:
+                self.log(f"Failed to save manifests for {vsns}, skipping: {e}")
+                continue
+            self.log(f"Loaded manifests for {vsns}.")
 
-    def _sync_computes(self, node, data):
-        """Upsert Compute, ComputeSensor, and Resource entries; return seen serials."""
-        serials_seen = []
-        for _, dev in data.get("devices", {}).items():
-            serial = dev.get("serial")
-            serials_seen.append(serial)
-
-            if str(dev.get("reachable", "no")).lower() == "no":
-                continue  # Skip unreachable devices
-
-            hostname = dev.get("Static hostname", "")
-            alias = cm.Resolve_compute_alias(hostname, dev)
-            hardware = cm.Get_hardware_for_alias(alias, dev)
-
-            compute_defaults = {
-                "name": alias,
-                "zone": dev.get("k8s", {}).get("labels", {}).get("zone"),
-                "is_active": True,
-                "hardware": hardware,
-            }
-
-            compute, _ = Compute.objects.update_or_create(
-                node=node, serial_no=serial, defaults=compute_defaults
-            )
+        for (model, action), count in sorted(summary.items()):
+            self.log(f"{model}: {count} {action}")
 
-            self._sync_compute_sensors(compute, dev)
-            self._sync_node_resources(node, dev)
+    def log_unmatched(self):
+        """
+        Log the devices of all loaded manifests which couldn't be mapped, grouped by reason.
+        """
+        for reason, devices in sorted(self.unmatched.items()):
+            self.log(
+                f"Unmatched devices ({reason}): {len(devices)}: {', '.join(devices)}"
+            )
 
-        return serials_seen
+    def read_plans(self, vsns, workers=1, force=False, ready=None):
+        """
+        Yield the load plans for the scraped manifests of vsns, in the order ready yields them if
+        given. Manifests are read and mapped by a pool of worker processes if workers > 1.
+        Missing or invalid manifests are logged and skipped, as are manifests which haven't
+        changed since they were last loaded unless force is set.
+        """
+        loaded_hashes = {} if force else get_loaded_hashes(vsns)
+        hashes = {}
+
+        def get_paths():
+            for vsn in ready if ready is not None else vsns:
+                manifest_path = Path(self.DATA_DIR, vsn, "manifest.json")
+                if not manifest_path.exists():
+                    self.log(f"Missing manifest.json for {vsn}, skipping.")
+                    continue
+                hashes[vsn] = hashlib.sha256(manifest_path.read_bytes()).hexdigest()
+                if loaded_hashes.get(vsn) == hashes[vsn]:
+                    self.log(f"Unchanged manifest.json for {vsn}, skipping.")
+                    continue
+                yield vsn, manifest_path
+
+        for plan in self.iter_plans(get_paths(), workers):
+            plan["sha256"] = hashes[plan["vsn"]]
+            for hostname, reason in plan["unmatched"]:
+                self.unmatched[reason].append(f"{plan['vsn']}/{hostname}")
+            yield plan
+
+    def iter_plans(self, paths, workers):
+        """
+        Yield the load plans for an iterable of (vsn, manifest path), in order.
+        """
+        if workers > 1:
+            # forked workers must not share the parent's database connections
+            connections.close_all()
+            with ProcessPoolExecutor(
+                max_workers=workers, initializer=django.setup
+            ) as pool:
+                futures = deque()
+                for vsn, path in paths:
+                    futures.append((vsn, pool.submit(read_plan, vsn, path)))
+                    # load finished plans while paths are still arriving
+                    while futures and futures[0][1].done():
+                        yield from self.get_plans(*futures.popleft())
+                while futures:
+                    yield from self.get_plans(*futures.popleft())
+        else:
+            for vsn, path in paths:
+                plan = self.get_plan(vsn, read_plan, vsn, path)
+                if plan is not None:
+                    yield plan
 
-    def _sync_compute_sensors(self, comp, dev):
-        """Upsert sensors for a Compute using abstracted mappings."""
-        for mapper in sm.COMPUTE_SENSOR_MAPPERS:
-            for name in mapper["sensor_names"](dev):
-                hw = mapper["resolve_hardware"](name)
-                ComputeSensor.objects.update_or_create(
-                    scope=comp, name=name, defaults={"hardware": hw, "is_active": True}
-                )
+    def get_plans(self, vsn, future):
+        plan = self.get_plan(vsn, future.result)
+        if plan is not None:
+            yield plan
 
-    def _sync_node_resources(self, node, dev):
-        """Upsert resources for a node using abstracted mappings."""
-        for mapper in rm.RESOURCE_MAPPERS:
-            for name in mapper["resouce_names"](dev):
-                hw = mapper["resolve_hardware"](name)
-                Resource.objects.update_or_create(
-                    node=node, name=name, defaults={"hardware": hw}
-                )
+    def get_plan(self, vsn, func, *args):
+        """
+        Return func(*args) or None if it fails, so one corrupt manifest doesn't stop the run.
+        """
+        try:
+            return func(*args)
+        except Exception as e:
+            self.log(f"Failed to read manifest for {vsn}, skipping: {e!r}")
+            return None
 
     def _deactivate_missing_computes(self, node, saw):
         """Mark computes not in manifest as inactive"""
@@ -1,4 +1,6 @@
-from manifests.models import ComputeHardware
+import re
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
 
 # NOTE: add your compute mappers here
 # example: "nxcore": {"pattern": "nxcore", "hardware": "xavieragx", "condition": lambda d: d.get("model", "") == "NVIDIA Jetson AGX Orin"},
@@ -30,23 +32,76 @@ COMPUTE_ALIAS_MAP = {
 DEFAULT_COMPUTE_ALIAS = "custom"
 
 
+class ComputeAliasMatcher:
+    """
+    Resolves hostnames to compute aliases with a single compiled regex instead of scanning the alias
+    map per device. Aliases are still tried in map order and the first one whose pattern is in the
+    hostname and whose condition holds wins.
+    """
+
+    def __init__(self, alias_map, default):
+        self.default = default
+        # aliases for each distinct pattern, in map order
+        self.aliases = {}
+        for alias, config in alias_map.items():
+            self.aliases.setdefault(config["pattern"], []).append(alias)
+        self.patterns = list(self.aliases)
+        self.order = {alias: i for i, alias in enumerate(alias_map)}
+        self.conditions = {
+            alias: config.get("condition") for alias, config in alias_map.items()
+        }
+        # one optional lookahead per pattern, so a single match finds every pattern in the hostname
+        self.regex = re.compile(
+            "".join(
+                f"(?=.*?(?P<p{i}>{re.escape(pattern)}))?"
+                for i, pattern in enumerate(self.patterns)
+            ),
+            re.DOTALL,
+        )
+
+    def resolve(self, hostname, device):
+        """
+        Returns (alias, matched), where matched is False if hostname matched no alias and the
+        default alias was used.
+        """
+        found = self.regex.match(hostname)
+        candidates = sorted(
+            (
+                alias
+                for i, pattern in enumerate(self.patterns)
+                if found.group(f"p{i}") is not None
+                for alias in self.aliases[pattern]
+            ),
+            key=self.order.get,
+        )
+        for alias in candidates:
+            condition = self.conditions[alias]
+            if condition is None or condition(device):
+                return alias, True
+        return self.default, False
+
+
+@lru_cache(maxsize=None)
+def get_alias_matcher():
+    return ComputeAliasMatcher(COMPUTE_ALIAS_MAP, DEFAULT_COMPUTE_ALIAS)
+
+
 def Resolve_compute_alias(hostname, device):
-    for alias, config in COMPUTE_ALIAS_MAP.items():
-        if config["pattern"] in hostname and config.get("condition", lambda d: True)(
-            device
-        ):
-            return alias
-    return DEFAULT_COMPUTE_ALIAS
+    return get_alias_matcher().resolve(hostname, device)[0]
 
 
-def Get_hardware_for_alias(alias, dev):
+def Get_hardware_name_for_alias(alias, dev):
     hardware_name = COMPUTE_ALIAS_MAP.get(alias, {}).get("hardware")
 
     model = dev.get("model", "")
-    memory_gb = parse_memory(dev["k8s"]["resources"]["memory"]["capacity"]) / 1024**3
 
     if "Raspberry Pi" in model:
-        if memory_gb < 6:
+        memory = (
+            dev.get("k8s", {}).get("resources", {}).get("memory", {}).get("capacity")
+        )
+        if memory is None:
+            raise ValueError("missing memory capacity for Raspberry Pi")
+        if parse_memory(memory) / 1024**3 < 6:
             hardware_name = "rpi-4gb"
         else:
             hardware_name = "rpi-8gb"
@@ -54,11 +109,51 @@ def Get_hardware_for_alias(alias, dev):
     if hardware_name is None:
         raise ValueError("unable to determined hardware model")
 
-    return ComputeHardware.objects.get_or_create(hardware=hardware_name)[0]
+    return hardware_name
+
+
+# multipliers of the Kubernetes resource quantity suffixes
+MEMORY_SUFFIXES = {
+    "Ki": 1024,
+    "Mi": 1024**2,
+    "Gi": 1024**3,
+    "Ti": 1024**4,
+    "Pi": 1024**5,
+    "Ei": 1024**6,
+    "n": Decimal("1e-9"),
+    "u": Decimal("1e-6"),
+    "m": Decimal("1e-3"),
+    "": 1,
+    "k": 10**3,
+    "M": 10**6,
+    "G": 10**9,
+    "T": 10**12,
+    "P": 10**15,
+    "E": 10**18,
+}
+
+QUANTITY_PATTERN = re.compile(
+    r"^(?P<number>[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))"
+    r"(?:(?P<exponent>[eE][+-]?[0-9]+)|(?P<suffix>"
+    + "|".join(sorted(MEMORY_SUFFIXES, key=len, reverse=True))
+    + r"))$"
+)
 
 
 def parse_memory(s: str) -> int:
-    """Parse string of memory with units suffix into interger memory in bytes."""
-    if s.endswith("Ki"):
-        return int(s.removesuffix("Ki")) * 1024
-    raise ValueError(f"unsupported memory string {s}")
+    """
+    Parse a Kubernetes resource quantity, such as 7433228Ki, 8Gi, 8G or 1e9, into integer memory in
+    bytes. Fractional bytes are rounded up, as Kubernetes does.
+    """
+    match = QUANTITY_PATTERN.match(s.strip())
+    if match is None:
+        raise ValueError(f"unsupported memory string {s}")
+    try:
+        number = Decimal(match["number"])
+        if match["exponent"] is not None:
+            number *= Decimal(f"1{match['exponent']}")
+        else:
+            number *= MEMORY_SUFFIXES[match["suffix"]]
+    except InvalidOperation:
+        raise ValueError(f"unsupported memory string {s}")
+    return int(number.to_integral_value(rounding="ROUND_CEILING"))
@@ -0,0 +1,50 @@
+"""Custom Django command to delete old manifest changes."""
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from manifests.documents import CHANGE_COUNTER_PK
+from manifests.models import ManifestChange, ManifestChangeCounter
+
+
+class Command(BaseCommand):
+    help = """
+    Delete manifest changes older than --days so the change log doesn't grow without bound.
+    Clients polling /manifests/changes/ with a revision older than the deleted changes are asked to
+    fetch all manifests again.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=30,
+            help="Number of days of manifest changes to keep.",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        with transaction.atomic():
+            # locking the counter waits for rebuilds which are still adding changes
+            counters = ManifestChangeCounter.objects.select_for_update()
+            counter, _ = counters.get_or_create(pk=CHANGE_COUNTER_PK)
+            pruned_revision = ManifestChange.objects.filter(
+                created_at__lt=cutoff
+            ).aggregate(Max("revision"))["revision__max"]
+            if pruned_revision is None:
+                self.stdout.write(self.style.SUCCESS("No manifest changes to delete."))
+                return
+            deleted, _ = ManifestChange.objects.filter(
+                revision__lte=pruned_revision
+            ).delete()
+            counter.pruned_revision = max(counter.pruned_revision, pruned_revision)
+            counter.save(update_fields=["pruned_revision"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Deleted {deleted} manifest change(s) up to revision {pruned_revision}."
+            )
+        )
@@ -0,0 +1,68 @@
+"""Custom Django command to verify the precomputed manifest documents against the live serializer."""
+
+from django.core.management.base import BaseCommand, CommandError
+from manifests.documents import (
+    DOCUMENT_VERSION,
+    get_manifest_queryset,
+    render_manifest,
+    rebuild_manifest_documents,
+)
+from manifests.models import ManifestDocument
+
+
+class Command(BaseCommand):
+    help = """
+    Verify the precomputed manifest documents against manifests rendered directly from the database.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--vsns",
+            nargs="+",
+            type=str,
+            default=None,
+            help="Optional list of VSNs to verify. If not provided, all nodes will be verified.",
+        )
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            default=False,
+            help="If provided, rebuild the documents for nodes which do not match.",
+        )
+
+    def handle(self, *args, **options):
+        nodes = get_manifest_queryset().order_by("vsn")
+        if options["vsns"]:
+            nodes = nodes.filter(vsn__in=options["vsns"])
+
+        documents = dict(
+            ManifestDocument.objects.filter(
+                node__in=nodes.prefetch_related(None), version=DOCUMENT_VERSION
+            ).values_list("node_id", "document")
+        )
+
+        mismatched = []
+
+        for node in nodes:
+            expected = render_manifest(node).decode()
+            actual = documents.get(node.pk)
+            if expected == actual:
+                continue
+            mismatched.append(node)
+            self.stdout.write(
+                f"{node.vsn}: {'missing document' if actual is None else 'stale document'}"
+            )
+
+        if not mismatched:
+            self.stdout.write(self.style.SUCCESS("Manifest documents are up to date."))
+            return
+
+        if not options["fix"]:
+            raise CommandError(
+                f"Manifest documents do not match for {len(mismatched)} node(s)."
+            )
+
+        rebuild_manifest_documents([node.pk for node in mismatched])
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt documents for {len(mismatched)} node(s).")
+        )
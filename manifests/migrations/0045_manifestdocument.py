@@ -0,0 +1,31 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("manifests", "0044_alter_nodedata_phase"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ManifestDocument",
+            fields=[
+                (
+                    "node",
+                    models.OneToOneField(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="manifest_document",
+                        serialize=False,
+                        to="manifests.nodedata",
+                    ),
+                ),
+                ("document", models.TextField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
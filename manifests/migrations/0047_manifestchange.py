@@ -0,0 +1,29 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("manifests", "0046_manifestrevision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ManifestChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("vsn", models.CharField(max_length=10, verbose_name="VSN")),
+                ("removed", models.BooleanField(default=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
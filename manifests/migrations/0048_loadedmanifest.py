@@ -0,0 +1,32 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("manifests", "0047_manifestchange"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LoadedManifest",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "vsn",
+                    models.CharField(max_length=10, unique=True, verbose_name="VSN"),
+                ),
+                ("sha256", models.CharField(max_length=64, verbose_name="SHA-256")),
+                ("loaded_at", models.DateTimeField()),
+            ],
+        ),
+    ]
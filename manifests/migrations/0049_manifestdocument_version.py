@@ -0,0 +1,17 @@
+# Generated by Django 4.2.23 on 2026-10-18 05:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("manifests", "0048_loadedmanifest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="manifestdocument",
+            name="version",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
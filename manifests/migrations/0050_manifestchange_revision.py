@@ -0,0 +1,46 @@
+# Generated by Django 4.2.23 on 2026-10-18 05:32
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def seed_change_revisions(apps, schema_editor):
+    # existing changes keep their id as revision so clients' cursors stay valid
+    ManifestChange = apps.get_model("manifests", "ManifestChange")
+    ManifestChangeCounter = apps.get_model("manifests", "ManifestChangeCounter")
+
+    ManifestChange.objects.update(revision=F("id"))
+    ManifestChangeCounter.objects.create(
+        pk=1, revision=ManifestChange.objects.aggregate(Max("id"))["id__max"] or 0
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("manifests", "0049_manifestdocument_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ManifestChangeCounter",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.PositiveBigIntegerField(default=0)),
+                ("pruned_revision", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="manifestchange",
+            name="revision",
+            field=models.PositiveBigIntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(seed_change_revisions, migrations.RunPython.noop),
+    ]
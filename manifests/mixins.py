@@ -0,0 +1,121 @@
+import hashlib
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer
+from .revisions import get_revision
+
+
+class SparseFieldsMixin:
+    """
+    Allows clients to only request some fields using ?fields=a,b,c. Order of operations:
+    1) Parse and validate the requested fields against the serializer's fields
+    2) Only apply the prefetch lookups needed by the requested fields
+        - prefetch_fields maps serializer field names to the prefetch lookups they need
+        - get_queryset() should apply get_prefetch_lookups() instead of hardcoding prefetches
+    3) Pass the requested fields to the serializer, which must accept a fields argument
+       (see manifests.serializers.SparseFieldsSerializerMixin)
+    """
+
+    fields_query_param = "fields"
+    prefetch_fields = {}
+
+    def get_requested_fields(self):
+        """
+        Returns the list of requested fields or None if all fields should be included. Fields are
+        parsed once per request, as streamed lists serialize each item separately.
+        """
+        if not hasattr(self, "_requested_fields"):
+            self._requested_fields = self.parse_requested_fields()
+        return self._requested_fields
+
+    def parse_requested_fields(self):
+        value = self.request.query_params.get(self.fields_query_param)
+        if not value:
+            return None
+
+        fields = [name.strip() for name in value.split(",") if name.strip()]
+
+        unknown = set(fields) - set(self.get_serializer_class()().fields)
+        if unknown:
+            raise ValidationError(
+                {
+                    self.fields_query_param: [
+                        f"Unknown fields: {', '.join(sorted(unknown))}"
+                    ]
+                }
+            )
+
+        return fields
+
+    def get_prefetch_lookups(self):
+        fields = self.get_requested_fields()
+        lookups = []
+        for name, field_lookups in self.prefetch_fields.items():
+            if fields is not None and name not in fields:
+                continue
+            for lookup in field_lookups:
+                if lookup not in lookups:
+                    lookups.append(lookup)
+        return lookups
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault("fields", self.get_requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+
+class RevisionConditionalMixin:
+    """
+    Adds ETag and Last-Modified headers derived from the manifests revision to list and retrieve
+    responses and answers matching conditional requests with 304 before any serialization.
+
+    The ETag covers the revision, the full path and the negotiated media type, so it changes
+    whenever any manifests data changes. The browsable API is excluded as its pages vary by user.
+    """
+
+    def get_conditional_headers(self):
+        """
+        Returns (etag, last_modified) for the current request or None if it is not cacheable.
+        """
+        request = self.request
+        if isinstance(request.accepted_renderer, BrowsableAPIRenderer):
+            return None
+        revision, updated_at = get_revision()
+        key = f"{revision}:{request.get_full_path()}:{request.accepted_media_type}"
+        etag = quote_etag(hashlib.sha256(key.encode()).hexdigest())
+        # http dates have a resolution of seconds
+        last_modified = int(updated_at.timestamp()) if updated_at is not None else None
+        return etag, last_modified
+
+    def get_not_modified_response(self):
+        """
+        Returns a 304 response if the client already has the current representation, otherwise None.
+        """
+        self.conditional_headers = self.get_conditional_headers()
+        if self.conditional_headers is None:
+            return None
+        etag, last_modified = self.conditional_headers
+        return get_conditional_response(
+            self.request._request, etag=etag, last_modified=last_modified
+        )
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        headers = getattr(self, "conditional_headers", None)
+        if headers is not None and response.status_code in (200, 304):
+            etag, last_modified = headers
+            response["ETag"] = etag
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified)
+            patch_vary_headers(response, ["Accept"])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.get_not_modified_response() or super().list(
+            request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.get_not_modified_response() or super().retrieve(
+            request, *args, **kwargs
+        )
@@ -3,6 +3,24 @@ from django.core.validators import RegexValidator
 from django.core.exceptions import ValidationError
 from node_auth.contrib.auth.models import AbstractNode
 from address.models import AddressField
+from .signals import pre_update, post_update
+
+
+class ManifestQuerySet(models.QuerySet):
+    """
+    QuerySet whose update() sends pre_update and post_update, so derived data such as the manifest
+    documents and revision is kept up to date as it is for saves.
+    """
+
+    def update(self, **kwargs):
+        pks = list(self.values_list("pk", flat=True))
+        if not pks:
+            return 0
+        state = {}
+        pre_update.send(sender=self.model, pks=pks, state=state)
+        rows = super().update(**kwargs)
+        post_update.send(sender=self.model, pks=pks, state=state)
+        return rows
 
 
 class NodePhase(models.TextChoices):
@@ -20,6 +38,8 @@ class NodeType(models.TextChoices):
 
 
 class NodeData(AbstractNode):
+    objects = ManifestQuerySet.as_manager()
+
     name = models.CharField("Node ID", max_length=30, blank=True)
     site_id = models.ForeignKey(
         "Site",
@@ -86,6 +106,8 @@ ModemSIMs = [
 
 
 class Modem(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     node = models.OneToOneField(
         NodeData, blank=True, null=True, on_delete=models.SET_NULL
     )
@@ -130,6 +152,8 @@ class Modem(models.Model):
 
 
 class AbstractHardware(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     hardware = models.CharField(max_length=100)
     hw_model = models.CharField(
         max_length=30,
@@ -178,6 +202,8 @@ class SensorHardware(AbstractHardware):
 
 
 class Capability(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     capability = models.CharField(max_length=30)
 
     def __str__(self):
@@ -188,6 +214,8 @@ class Capability(models.Model):
 
 
 class Compute(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     ZONE_CHOICES = (
         ("core", "core"),
         ("agent", "agent"),
@@ -219,6 +247,8 @@ class Compute(models.Model):
 
 
 class AbstractSensor(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     hardware = models.ForeignKey(
         SensorHardware, on_delete=models.CASCADE, blank=True, null=True
     )
@@ -256,12 +286,16 @@ class ComputeSensor(AbstractSensor):
 
 
 class Resource(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     node = models.ForeignKey(NodeData, on_delete=models.CASCADE, blank=True)
     hardware = models.ForeignKey(ResourceHardware, on_delete=models.CASCADE, blank=True)
     name = models.CharField(max_length=30, blank=True)
 
 
 class Tag(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     tag = models.CharField(max_length=30, unique=True)
 
     def __str__(self):
@@ -272,6 +306,8 @@ class Tag(models.Model):
 
 
 class Label(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     label = models.CharField(max_length=30, unique=True)
 
     def __str__(self):
@@ -284,6 +320,8 @@ class Label(models.Model):
 # NOTE NodeBuildProject is used to refer to the organization which owns a node (Sage, DAWN, VTO)
 # as opposed to the permissions based groups we use in app's models.
 class NodeBuildProject(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Node Build Projects"
 
@@ -294,6 +332,8 @@ class NodeBuildProject(models.Model):
 
 
 class NodeBuild(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Node Builds"
 
@@ -410,6 +450,8 @@ class LorawanDevice(AbstractSensor):
 
 
 class LorawanConnection(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     CONNECTION_CHOICES = (("OTAA", "OTAA"), ("ABP", "ABP"))
 
     node = models.ForeignKey(
@@ -455,6 +497,8 @@ class LorawanConnection(models.Model):
 
 
 class LorawanKeys(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     lorawan_connection = models.OneToOneField(
         LorawanConnection,
         on_delete=models.CASCADE,
@@ -483,6 +527,8 @@ class LorawanKeys(models.Model):
 
 
 class NodeBuildProjectFocus(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Node Build Project Focuses"
 
@@ -493,6 +539,8 @@ class NodeBuildProjectFocus(models.Model):
 
 
 class NodeBuildProjectPartner(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     class Meta:
         verbose_name_plural = "Node Build Project Partners"
 
@@ -503,6 +551,8 @@ class NodeBuildProjectPartner(models.Model):
 
 
 class Site(models.Model):
+    objects = ManifestQuerySet.as_manager()
+
     id = models.CharField(
         "Site ID", max_length=6, null=False, blank=False, unique=True, primary_key=True
     )
@@ -513,3 +563,88 @@ class Site(models.Model):
 
     def __str__(self):
         return self.id
+
+
+class ManifestDocument(models.Model):
+    """
+    Precomputed ManifestSerializer output for a node, stored as rendered JSON.
+
+    Documents are rebuilt incrementally by the signal handlers in manifests.documents and can be
+    checked against the live serializer with the verify_manifest_documents management command.
+    The node relation has no database constraint so documents can be rebuilt while a node's
+    related rows are being cascade deleted; documents of deleted nodes are removed by the handlers.
+    Documents whose version is not manifests.documents.DOCUMENT_VERSION were rendered by an older
+    serializer and are treated as missing.
+    """
+
+    node = models.OneToOneField(
+        NodeData,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        primary_key=True,
+        related_name="manifest_document",
+    )
+    document = models.TextField()
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.node_id)
+
+
+class ManifestRevision(models.Model):
+    """
+    Single row counter which is incremented whenever a manifests model changes. It is maintained
+    by the signal handlers in manifests.revisions and drives the ETag and Last-Modified headers of
+    the manifests endpoints.
+    """
+
+    revision = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return str(self.revision)
+
+
+class ManifestChangeCounter(models.Model):
+    """
+    Single row counter from which each rebuild of the manifest documents allocates the revision of
+    its changes. The row stays locked until the rebuild commits, so revisions become visible in
+    order and clients polling /manifests/changes/ never skip a change which committed late.
+    pruned_revision is the latest revision whose changes were deleted by prune_manifest_changes.
+    """
+
+    revision = models.PositiveBigIntegerField(default=0)
+    pruned_revision = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.revision)
+
+
+class ManifestChange(models.Model):
+    """
+    Append-only log of changes to the manifest documents. The revision of the latest change is the
+    revision clients pass to /manifests/changes/?since= to get the manifests which changed after it.
+    """
+
+    vsn = models.CharField("VSN", max_length=10)
+    removed = models.BooleanField(default=False)
+    revision = models.PositiveBigIntegerField(default=0, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.vsn} {'removed' if self.removed else 'changed'}"
+
+
+class LoadedManifest(models.Model):
+    """
+    SHA-256 of the scraped manifest.json last loaded for a node by the loadmanifest command, which
+    skips manifests whose content hasn't changed since.
+    """
+
+    vsn = models.CharField("VSN", max_length=10, unique=True)
+    sha256 = models.CharField("SHA-256", max_length=64)
+    loaded_at = models.DateTimeField()
+
+    def __str__(self):
+        return self.vsn
@@ -0,0 +1,37 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OptInCursorPagination(CursorPagination):
+    """
+    Cursor pagination which is only used when a client asks for it by passing the cursor or page_size
+    query parameter, so existing clients keep getting the full list.
+
+    Views may set cursor_ordering to key the cursor on something other than vsn. Unlike the DRF
+    default, orderings may follow relations, for example node__vsn.
+    """
+
+    ordering = "vsn"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def is_requested(self, request):
+        params = request.query_params
+        return self.cursor_query_param in params or self.page_size_query_param in params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, "cursor_ordering", self.ordering)
+        if isinstance(ordering, str):
+            return (ordering,)
+        return tuple(ordering)
+
+    def _get_position_from_instance(self, instance, ordering):
+        value = instance
+        for attr in ordering[0].lstrip("-").split("__"):
+            value = value[attr] if isinstance(value, dict) else getattr(value, attr)
+        return None if value is None else str(value)
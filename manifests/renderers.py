@@ -0,0 +1,20 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class NDJSONRenderer(JSONRenderer):
+    """
+    Renders lists as newline delimited JSON, one item per line. Other data is rendered as a
+    single line.
+    """
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if not isinstance(data, list):
+            data = [data]
+        return b"".join(
+            super(NDJSONRenderer, self).render(item) + b"\n" for item in data
+        )
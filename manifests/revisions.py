@@ -0,0 +1,102 @@
+"""
+Revision counter for the manifests models.
+
+Every save, delete or many-to-many change of a manifests model increments the single
+ManifestRevision row. Views use the revision to answer conditional requests with a single query,
+before any of the prefetching and serialization a full response needs. Queryset update() calls
+bump the revision through the post_update signal of ManifestQuerySet.
+
+Bumps happen immediately unless they run inside batch_revision(), which bumps the revision once on
+exit instead, as batch_rebuild() does for the manifest documents.
+"""
+import threading
+from contextlib import contextmanager
+from django.apps import apps
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils import timezone
+from .signals import post_update
+from .models import (
+    LoadedManifest,
+    ManifestChange,
+    ManifestChangeCounter,
+    ManifestDocument,
+    ManifestRevision,
+)
+
+REVISION_PK = 1
+
+# derived or bookkeeping models whose changes don't alter any response
+UNTRACKED_MODELS = {
+    LoadedManifest,
+    ManifestChange,
+    ManifestChangeCounter,
+    ManifestDocument,
+    ManifestRevision,
+}
+
+_batch = threading.local()
+
+
+def get_revision():
+    """
+    Returns (revision, updated_at) or (0, None) if nothing has changed yet.
+    """
+    row = ManifestRevision.objects.filter(pk=REVISION_PK).values_list(
+        "revision", "updated_at"
+    )
+    return row.first() or (0, None)
+
+
+def bump_revision():
+    if getattr(_batch, "pending", None) is not None:
+        _batch.pending = True
+        return
+
+    now = timezone.now()
+    updated = ManifestRevision.objects.filter(pk=REVISION_PK).update(
+        revision=F("revision") + 1, updated_at=now
+    )
+    if not updated:
+        ManifestRevision.objects.get_or_create(
+            pk=REVISION_PK, defaults={"revision": 1, "updated_at": now}
+        )
+
+
+@contextmanager
+def batch_revision():
+    """
+    Defers revision bumps within the block and bumps the revision once on exit if any were deferred.
+    """
+    if getattr(_batch, "pending", None) is not None:
+        yield
+        return
+    _batch.pending = False
+    try:
+        yield
+    finally:
+        pending, _batch.pending = _batch.pending, None
+        if pending:
+            bump_revision()
+
+
+def bump_revision_for_change(sender, **kwargs):
+    bump_revision()
+
+
+def bump_revision_for_m2m_change(sender, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        bump_revision()
+
+
+# handlers are connected per model, as handlers for any sender would prevent fast deletes everywhere
+for model in apps.get_app_config("manifests").get_models(include_auto_created=True):
+    if model in UNTRACKED_MODELS:
+        continue
+    if model._meta.auto_created:
+        # many-to-many through tables only change through the related managers
+        m2m_changed.connect(bump_revision_for_m2m_change, sender=model)
+    else:
+        post_save.connect(bump_revision_for_change, sender=model)
+        post_delete.connect(bump_revision_for_change, sender=model)
+        post_update.connect(bump_revision_for_change, sender=model)
@@ -1,45 +1,90 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from rest_framework.relations import SlugRelatedField
 
 from .models import *
 
 
-class SensorViewSerializer(serializers.ModelSerializer):
+class SparseFieldsSerializerMixin:
+    """
+    Accepts an optional fields argument listing the only fields which should be serialized.
+    """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+def prefetch_active_lorawan_connections():
+    """
+    Prefetch a node's active lorawan connections, with their devices and hardware, into
+    active_lorawanconnections as consumed by ManifestSerializer and NodesSerializer.
+    """
+    return Prefetch(
+        "lorawanconnections",
+        queryset=LorawanConnection.objects.filter(is_active=True)
+        .select_related("lorawan_device__hardware")
+        .prefetch_related("lorawan_device__hardware__capabilities")
+        .order_by("pk"),
+        to_attr="active_lorawanconnections",
+    )
+
+
+def get_active_lorawan_connections(node):
+    """
+    Returns the node's active lorawan connections, falling back to a query when they were not
+    prefetched using prefetch_active_lorawan_connections.
+    """
+    try:
+        return node.active_lorawanconnections
+    except AttributeError:
+        return node.lorawanconnections.filter(is_active=True)
+
+
+class SensorViewSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     # replace capabilities IDs by their names
     capabilities = serializers.SlugRelatedField(
         many=True, read_only=True, slug_field="capability", required=False
     )
     vsns = serializers.SerializerMethodField()
 
+    def get_query_param_set(self, name):
+        """
+        Returns the lowercase set of comma separated values for query param name, or None if not given.
+        Parsed once and reused for every serialized object.
+        """
+        cache = self.__dict__.setdefault("_query_param_sets", {})
+        if name not in cache:
+            value = self.context["request"].query_params.get(name)
+            cache[name] = {v.lower() for v in value.split(",")} if value else None
+        return cache[name]
+
     def get_vsns(self, obj):
         compute_sensors = obj.computesensor_set.all()
         node_sensors = obj.nodesensor_set.all()
         lorawan_sensors = obj.lorawandevice_set.all()
-        lorawan_connections = [ld.lorawanconnections.filter(is_active=True) for ld in lorawan_sensors]
+        # active_lorawanconnections is prefetched by SensorHardwareViewSet
+        lorawan_connections = [ld.active_lorawanconnections for ld in lorawan_sensors]
         nodes = (
             [s.scope.node for s in compute_sensors]
             + [s.node for s in node_sensors]
             + [lc[0].node for lc in lorawan_connections if lc]
         )
 
-        project = self.context["request"].query_params.get("project")
-        if project:
-            projects = project.split(",")
+        projects = self.get_query_param_set("project")
+        if projects:
             nodes = [
                 node
                 for node in nodes
-                if node.project
-                and node.project.name.lower() in (p.lower() for p in projects)
+                if node.project and node.project.name.lower() in projects
             ]
 
-        phase = self.context["request"].query_params.get("phase")
-        if phase:
-            phases = phase.split(",")
+        phases = self.get_query_param_set("phase")
+        if phases:
             nodes = [
-                node
-                for node in nodes
-                if node.phase
-                and node.phase.lower() in (p.lower() for p in phases)
+                node for node in nodes if node.phase and node.phase.lower() in phases
             ]
 
         vsns = sorted(set([node.vsn for node in nodes]))
@@ -208,7 +253,7 @@ class LorawanKeysSerializer(serializers.ModelSerializer):
         return super().update(instance, self.get_lookup_records(validated_data))
 
 
-class ManifestSerializer(serializers.ModelSerializer):
+class ManifestSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     project = serializers.CharField(source="project.name", allow_null=True)
     modem = ModemSerializer()
     computes = serializers.SerializerMethodField("get_computes")
@@ -238,7 +283,7 @@ class ManifestSerializer(serializers.ModelSerializer):
         return [serialize_resource(r) for r in obj.resource_set.all()]
 
     def get_lorawan_connections(self, obj: NodeData):
-        return [serialize_lorawan_connections(l) for l in obj.lorawanconnections.filter(is_active=True)]
+        return [serialize_lorawan_connections(l) for l in get_active_lorawan_connections(obj)]
 
     class Meta:
         model = NodeData
@@ -333,7 +378,7 @@ def serialize_lorawan_connections(l):
     }
 
 
-class ComputeSerializer(serializers.ModelSerializer):
+class ComputeSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     node = serializers.CharField(source="node.vsn")
     hardware = serializers.CharField(source="hardware.hardware")
 
@@ -381,7 +426,7 @@ class NodeBuildSerializer(serializers.ModelSerializer):
         ]
 
 
-class NodesSerializer(serializers.ModelSerializer):
+class NodesSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     computes = serializers.SerializerMethodField("get_computes")
     sensors = serializers.SerializerMethodField("get_sensors")
     modem_model = serializers.SerializerMethodField("get_modem_model")
@@ -480,7 +525,7 @@ class NodesSerializer(serializers.ModelSerializer):
                 results.append(self.serialize_common_sensor(s))
 
         # add all lorawan sensors
-        for s in obj.lorawanconnections.filter(is_active=True):
+        for s in get_active_lorawan_connections(obj):
             results.append(self.serialize_common_sensor(s.lorawan_device))
 
         return results
@@ -0,0 +1,11 @@
+"""
+Signals sent by queryset update() calls on the manifests models.
+
+update() sends no save signals, so ManifestQuerySet sends pre_update and post_update with the
+primary keys of the updated rows instead. Receivers can keep whatever they collect before the
+update in the state dict, which is passed to both signals.
+"""
+from django.dispatch import Signal
+
+pre_update = Signal()
+post_update = Signal()
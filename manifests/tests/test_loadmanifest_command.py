@@ -6,7 +6,7 @@ import subprocess
 from io import StringIO
 from django.test import TestCase
 from django.core.management import call_command
-from manifests.models import NodeData, Modem, Compute, ComputeSensor, ComputeHardware, Resource
+from manifests.models import NodeData, Modem, Compute, ComputeSensor, ComputeHardware, Resource, LoadedManifest
 from app.models import Node as AppNode
 from manifests.models import SensorHardware
 from unittest.mock import patch, MagicMock
@@ -349,4 +349,305 @@ class LoadManifestCommandTestCase(TestCase):
         # run command
         call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', vsn3)
         # no Compute should be created for unreachable device
-        self.assertFalse(Compute.objects.filter(node__vsn=vsn3).exists())
\ No newline at end of file
+        self.assertFalse(Compute.objects.filter(node__vsn=vsn3).exists())
+
+    def get_rows(self):
+        return {
+            "nodes": list(NodeData.objects.order_by("vsn").values_list("vsn", "name")),
+            "app_nodes": list(AppNode.objects.order_by("vsn").values_list("vsn", "mac")),
+            "modems": list(Modem.objects.order_by("node__vsn").values_list("node__vsn", "imei", "imsi", "iccid", "carrier")),
+            "computes": list(Compute.objects.order_by("node__vsn", "serial_no").values_list("node__vsn", "serial_no", "name", "zone", "is_active", "hardware__hardware")),
+            "sensors": list(ComputeSensor.objects.order_by("scope__serial_no", "name").values_list("scope__serial_no", "name", "hardware__hardware", "is_active")),
+            "resources": list(Resource.objects.order_by("node__vsn", "name").values_list("node__vsn", "name", "hardware__hardware")),
+        }
+
+    def test_batch_size_matches_serial_load(self):
+        """Ensure bulk loading creates the same rows as loading one node at a time."""
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn)
+        expected = self.get_rows()
+
+        NodeData.objects.all().delete()
+        Modem.objects.all().delete()
+        AppNode.objects.all().delete()
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, '--batch-size', '10', stdout=out)
+        self.assertEqual(self.get_rows(), expected)
+        self.assertIn("Compute: 1 created", out.getvalue())
+
+        # manifest document is rebuilt for the new rows
+        r = self.client.get(f"/manifests/{self.vsn}/")
+        self.assertEqual(r.json()["computes"][0]["name"], "nxcore")
+
+        # loading again changes nothing
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, '--batch-size', '10', '--force', stdout=out)
+        self.assertEqual(self.get_rows(), expected)
+        self.assertIn("Compute: 1 unchanged", out.getvalue())
+        self.assertNotIn("updated", out.getvalue())
+
+    def test_batch_size_without_bulk_insert_returning(self):
+        """Ensure bulk loading works on databases which don't return bulk inserted rows, like MySQL."""
+        from django.db import connection
+
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn)
+        expected = self.get_rows()
+
+        NodeData.objects.all().delete()
+        Modem.objects.all().delete()
+        AppNode.objects.all().delete()
+
+        out = StringIO()
+        with patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, '--batch-size', '10', stdout=out)
+        self.assertIn(f"Loaded manifests for {self.vsn}.", out.getvalue())
+        self.assertEqual(self.get_rows(), expected)
+
+    def test_batch_size_skips_failed_batches(self):
+        """Ensure a batch which fails to save is skipped without stopping the following batches."""
+        src = os.path.join(self.tmpdir, 'data', self.vsn)
+        for vsn in ['V2', 'V3']:
+            shutil.copytree(src, os.path.join(self.tmpdir, 'data', vsn))
+        # V3 keeps V1's node id and modem imei, which must be unique
+        with open(os.path.join(self.tmpdir, 'data', 'V2', 'manifest.json')) as f:
+            manifest = json.load(f)
+        manifest["node_id"] = "MAC222"
+        manifest["network"]["modem"]["3gpp"]["imei"] = "222"
+        manifest["devices"]["dev1"]["serial"] = "SERIAL2"
+        with open(os.path.join(self.tmpdir, 'data', 'V2', 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, 'V3', 'V2', '--batch-size', '1', stdout=out)
+        self.assertIn("Failed to save manifests for V3, skipping", out.getvalue())
+        self.assertIn("Loaded manifests for V2.", out.getvalue())
+        self.assertEqual(sorted(NodeData.objects.values_list("vsn", flat=True)), [self.vsn, 'V2'])
+        self.assertTrue(Compute.objects.filter(node__vsn='V2', serial_no='SERIAL2').exists())
+
+    def test_batch_size_reports_unmatched_devices(self):
+        """Ensure devices which can't be mapped are reported without stopping the rest of the batch."""
+        bad_dir = os.path.join(self.tmpdir, 'data', 'BAD')
+        os.makedirs(bad_dir)
+        manifest = {
+            "node_id": "MACBAD",
+            "devices": {
+                "dev1": {
+                    "reachable": "yes",
+                    "serial": "SERIALBAD",
+                    "Static hostname": "ws-rpi",
+                    "model": "unknown",
+                    "k8s": {"resources": {"memory": {"capacity": "1Ki"}}},
+                }
+            },
+        }
+        with open(os.path.join(bad_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', 'BAD', self.vsn, '--batch-size', '10', stdout=out)
+        self.assertIn("Unmatched devices (skipped: unable to determined hardware model): 1: BAD/ws-rpi", out.getvalue())
+        self.assertEqual(NodeData.objects.get(vsn='BAD').name, 'MACBAD')
+        self.assertFalse(Compute.objects.filter(node__vsn='BAD').exists())
+        self.assertTrue(Compute.objects.filter(node__vsn=self.vsn).exists())
+
+    def test_apply_plans_bulk_queries(self):
+        """Ensure the number of bulk queries doesn't grow with the number of nodes."""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from manifests.loading import apply_plans_bulk
+
+        def get_plans(vsns):
+            return [
+                {
+                    "vsn": vsn,
+                    "name": None,
+                    "modem": None,
+                    "computes": [
+                        {"serial_no": f"{vsn}-1", "name": "nxcore", "zone": "core", "hardware": "xaviernx", "sensors": {"sensor1": "sensor1"}},
+                    ],
+                    "resources": {"switch": "switch"},
+                    "serials_seen": [f"{vsn}-1"],
+                }
+                for vsn in vsns
+            ]
+
+        def count_queries(plans):
+            with CaptureQueriesContext(connection) as ctx:
+                apply_plans_bulk(plans)
+            # app nodes are created one by one so their signals issue auth tokens and invalidate the
+            # cached authorized keys
+            per_node = ["app_node", "node_auth_token", "app_authorizedkeysgeneration"]
+            return len([q for q in ctx.captured_queries if not any(table in q["sql"] for table in per_node)])
+
+        # hardware and the revision row are created by the first load
+        apply_plans_bulk(get_plans(["N0"]))
+        self.assertEqual(
+            count_queries(get_plans(["N1", "N2"])),
+            count_queries(get_plans(["N3", "N4", "N5", "N6", "N7", "N8"])),
+        )
+
+    def test_revision_bumped_once_per_load(self):
+        """Ensure loading a node bumps the manifest revision once rather than once per saved row."""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from manifests.revisions import get_revision
+
+        for options in [[], ['--batch-size', '10']]:
+            NodeData.objects.all().delete()
+            Modem.objects.all().delete()
+            revision, _ = get_revision()
+            with CaptureQueriesContext(connection) as ctx:
+                call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, '--force', *options, stdout=StringIO())
+            self.assertEqual(get_revision()[0], revision + 1, options)
+            self.assertEqual(len([q for q in ctx.captured_queries if "manifestrevision" in q["sql"]]), 1, options)
+
+    def test_workers_skip_corrupt_manifests(self):
+        """Ensure manifests read by worker processes load and a corrupt one is skipped."""
+        bad_dir = os.path.join(self.tmpdir, 'data', 'BAD')
+        os.makedirs(bad_dir)
+        with open(os.path.join(bad_dir, 'manifest.json'), 'w') as f:
+            f.write('{"node_id": ')
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', 'BAD', self.vsn, '--workers', '2', stdout=out)
+        self.assertIn("Failed to read manifest for BAD", out.getvalue())
+        self.assertIn(f"Loaded manifest for {self.vsn}.", out.getvalue())
+        self.assertFalse(NodeData.objects.filter(vsn='BAD').exists())
+        comp = Compute.objects.get(node__vsn=self.vsn, serial_no='SERIAL1')
+        self.assertEqual(comp.name, 'nxcore')
+
+    def test_unchanged_manifests_skipped(self):
+        """Ensure manifests which haven't changed since the last load are skipped unless forced."""
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn)
+        Compute.objects.filter(node__vsn=self.vsn).update(name='renamed')
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, stdout=out)
+        self.assertIn(f"Unchanged manifest.json for {self.vsn}, skipping.", out.getvalue())
+        self.assertEqual(Compute.objects.get(serial_no='SERIAL1').name, 'renamed')
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, '--force', stdout=out)
+        self.assertIn(f"Loaded manifest for {self.vsn}.", out.getvalue())
+        self.assertEqual(Compute.objects.get(serial_no='SERIAL1').name, 'nxcore')
+
+        # a changed manifest is loaded again
+        path = os.path.join(self.tmpdir, 'data', self.vsn, 'manifest.json')
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest["node_id"] = "MAC456"
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, '--batch-size', '10', stdout=StringIO())
+        self.assertEqual(NodeData.objects.get(vsn=self.vsn).name, 'MAC456')
+
+    def test_scrape_timeouts(self):
+        """Ensure a hung scrape is stopped without holding up the other nodes."""
+        script = os.path.join(self.tmpdir, 'scrape-nodes')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\necho "scraping $1"\nif [ "$1" = SLOW ]; then sleep 30; fi\n')
+        os.chmod(script, 0o755)
+
+        out = StringIO()
+        call_command('loadmanifest', '--repo', self.tmpdir, '--vsns', 'SLOW', self.vsn, '--node-timeout', '1', stdout=out)
+        output = out.getvalue()
+        self.assertIn(f"{self.vsn}: scraping {self.vsn}", output)
+        self.assertIn("Scraping SLOW timed out after 1.0s.", output)
+        self.assertIn(f"Loaded manifest for {self.vsn}.", output)
+        # the finished node is loaded before the hung scrape is stopped
+        self.assertLess(output.index(f"Loaded manifest for {self.vsn}."), output.index("Scraping SLOW timed out"))
+
+        out = StringIO()
+        call_command('loadmanifest', '--repo', self.tmpdir, '--vsns', 'SLOW', '--timeout', '1', stdout=out)
+        self.assertIn("Scraping timed out after 1.0s.", out.getvalue())
+        self.assertIn("Missing manifest.json for SLOW, skipping.", out.getvalue())
+
+    def test_hardware_resolved_from_registry(self):
+        """Ensure hardware is loaded once per run instead of looked up per device and sensor."""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        src = os.path.join(self.tmpdir, 'data', self.vsn)
+        for vsn in ['V4', 'V5']:
+            shutil.copytree(src, os.path.join(self.tmpdir, 'data', vsn))
+        with open(os.path.join(self.tmpdir, 'data', 'V5', 'manifest.json')) as f:
+            manifest = json.load(f)
+        manifest["node_id"] = "MAC555"
+        manifest["network"] = {}
+        manifest["devices"]["dev1"]["serial"] = "SERIAL5"
+        manifest["devices"]["dev1"]["iio_devices"] = ["sensor5"]
+        with open(os.path.join(self.tmpdir, 'data', 'V5', 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', 'V4', 'V5', stdout=StringIO())
+
+        hardware_lookups = [q for q in ctx.captured_queries if 'hardware"."hardware" =' in q["sql"]]
+        self.assertEqual(hardware_lookups, [])
+        self.assertEqual(ComputeSensor.objects.get(scope__serial_no='SERIAL5', name='sensor5').hardware.hardware, 'sensor5')
+        self.assertEqual(SensorHardware.objects.filter(hardware='sensor5').count(), 1)
+
+    def test_new_hardware_without_bulk_insert_returning(self):
+        """Ensure new hardware can be used on databases which don't return bulk inserted rows, like MySQL."""
+        from django.db import connection
+
+        path = os.path.join(self.tmpdir, 'data', self.vsn, 'manifest.json')
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest["devices"]["dev1"]["iio_devices"] = ["sensor6"]
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+
+        out = StringIO()
+        with patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, stdout=out)
+        self.assertIn(f"Loaded manifest for {self.vsn}.", out.getvalue())
+        self.assertEqual(ComputeSensor.objects.get(scope__serial_no='SERIAL1', name='sensor6').hardware.hardware, 'sensor6')
+
+    def test_parse_memory(self):
+        """Ensure all Kubernetes quantity suffixes are understood."""
+        from manifests.management.commands.mappers.compute_mappers import parse_memory
+
+        cases = {
+            "7433228Ki": 7433228 * 1024,
+            "8Gi": 8 * 1024**3,
+            "1.5Mi": 1572864,
+            "8G": 8 * 10**9,
+            "512M": 512 * 10**6,
+            "1e9": 10**9,
+            "1E3": 1000,
+            "100": 100,
+            "500m": 1,
+        }
+        for s, expected in cases.items():
+            self.assertEqual(parse_memory(s), expected, s)
+        for s in ["", "abc", "8GB", "Ki"]:
+            with self.assertRaises(ValueError, msg=s):
+                parse_memory(s)
+
+    def test_unmatched_hostnames_reported(self):
+        """Ensure hostnames matching no alias are loaded as custom and reported in aggregate."""
+        from manifests.management.commands.mappers.compute_mappers import Resolve_compute_alias
+
+        self.assertEqual(Resolve_compute_alias("ws-rpi-1", {"lora_gws": ["gw"]}), "rpi.lorawan")
+        self.assertEqual(Resolve_compute_alias("ws-rpi-1", {}), "rpi")
+        self.assertEqual(Resolve_compute_alias("mystery", {}), "custom")
+
+        path = os.path.join(self.tmpdir, 'data', self.vsn, 'manifest.json')
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest["devices"]["dev2"] = dict(manifest["devices"]["dev1"], serial="SERIAL2", **{"Static hostname": "mystery"})
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+
+        out = StringIO()
+        call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, stdout=out)
+        self.assertIn(f"Unmatched devices (no alias matched, loaded as custom): 1: {self.vsn}/mystery", out.getvalue())
+        self.assertEqual(Compute.objects.get(serial_no='SERIAL2').name, 'custom')
+
+        # manifests with unmatched devices are loaded again, as the mappers may handle them by then
+        for options in [[], ['--batch-size', '10']]:
+            out = StringIO()
+            call_command('loadmanifest', "--no-scrape", '--repo', self.tmpdir, '--vsns', self.vsn, *options, stdout=out)
+            self.assertNotIn("Unchanged manifest.json", out.getvalue())
+            self.assertFalse(LoadedManifest.objects.filter(vsn=self.vsn).exists())
@@ -1,9 +1,14 @@
+import json
+from unittest.mock import patch
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from manifests.models import *
 from address.models import *
 from pytest import mark
 from ManifestHelp_fx import *
 from test_utils import assertDictContainsSubset
+from manifests.views import ManifestViewSet
 
 
 class ManifestInitialTest(TestCase):
@@ -332,6 +337,182 @@ class ManifestTest(TestCase):
         manifest = r.json()
         self.assertEqual(len(manifest["lorawanconnections"]), 0)
 
+class ManifestPaginationTest(TestCase):
+    def setUp(self):
+        for i in range(5):
+            node = NodeData.objects.create(vsn=f"W{i:03d}", name=f"node{i}", phase="Deployed")
+            ComputeHardware.objects.create(hardware=f"h{i}")
+            Compute.objects.create(
+                node=node, hardware=ComputeHardware.objects.get(hardware=f"h{i}"), name="nxcore"
+            )
+
+    def test_unpaginated_by_default(self):
+        r = self.client.get("/manifests/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([item["vsn"] for item in r.json()], [f"W{i:03d}" for i in range(5)])
+
+    def test_cursor_pagination(self):
+        for url in ["/manifests/", "/api/v-beta/nodes/", "/computes/"]:
+            vsns = []
+            next_url = f"{url}?page_size=2"
+            while next_url:
+                r = self.client.get(next_url)
+                self.assertEqual(r.status_code, 200)
+                data = r.json()
+                self.assertLessEqual(len(data["results"]), 2)
+                vsns += [item.get("vsn", item.get("node")) for item in data["results"]]
+                next_url = data["next"]
+            self.assertEqual(vsns, [f"W{i:03d}" for i in range(5)], url)
+
+        # filtered sensor listings are also paginated
+        r = self.client.get("/sensors/?page_size=2&phase=Deployed")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["results"], [])
+
+    def test_sparse_fields(self):
+        r = self.client.get("/manifests/?fields=vsn,phase")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()[0], {"vsn": "W000", "phase": "Deployed"})
+
+        r = self.client.get("/api/v-beta/nodes/W001/?fields=vsn,computes")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(set(r.json()), {"vsn", "computes"})
+
+    def test_sparse_fields_skip_prefetches(self):
+        with CaptureQueriesContext(connection) as full:
+            self.client.get("/api/v-beta/nodes/")
+        with CaptureQueriesContext(connection) as sparse:
+            self.client.get("/api/v-beta/nodes/?fields=vsn,phase")
+        # revision lookup and nodes
+        self.assertEqual(len(sparse), 2)
+        self.assertLess(len(sparse), len(full))
+
+    def test_unknown_fields(self):
+        for url in ["/manifests/", "/api/v-beta/nodes/", "/computes/", "/sensors/"]:
+            r = self.client.get(f"{url}?fields=vsn,password")
+            self.assertEqual(r.status_code, 400, url)
+            self.assertIn("password", r.json()["fields"][0])
+
+
+class ManifestQueryCountTest(TestCase):
+    def setUp(self):
+        self.compute_hardware = ComputeHardware.objects.create(hardware="nx1")
+        self.sensor_hardware = SensorHardware.objects.create(hardware="bme280")
+        self.lorawan_hardware = SensorHardware.objects.create(hardware="lorawan_1")
+        capability = Capability.objects.create(capability="gpu")
+        for hardware in [self.compute_hardware, self.sensor_hardware, self.lorawan_hardware]:
+            hardware.capabilities.add(capability)
+
+    def create_nodes(self, start, end):
+        for i in range(start, end):
+            node = NodeData.objects.create(vsn=f"W{i:03d}", name=f"node{i}")
+            compute = Compute.objects.create(
+                node=node, hardware=self.compute_hardware, name="nxcore"
+            )
+            ComputeSensor.objects.create(scope=compute, hardware=self.sensor_hardware, name="bme280")
+            NodeSensor.objects.create(node=node, hardware=self.sensor_hardware, name="bme280")
+            for j in range(2):
+                device = LorawanDevice.objects.create(
+                    deveui=f"{i:08x}{j:08x}", name=f"device{j}", hardware=self.lorawan_hardware
+                )
+                LorawanConnection.objects.create(
+                    node=node, lorawan_device=device, connection_type="OTAA", is_active=j == 0
+                )
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        return len(ctx), r.json()
+
+    def test_constant_queries(self):
+        for url in ["/manifests/", "/api/v-beta/nodes/"]:
+            NodeData.objects.all().delete()
+            LorawanDevice.objects.all().delete()
+
+            self.create_nodes(0, 2)
+            small, _ = self.count_queries(url)
+
+            self.create_nodes(2, 20)
+            large, items = self.count_queries(url)
+
+            self.assertEqual(small, large, url)
+            self.assertEqual(len(items), 20)
+
+        # only active connections are included
+        _, items = self.count_queries("/manifests/")
+        self.assertEqual(
+            [lc["lorawandevice"]["name"] for lc in items[0]["lorawanconnections"]],
+            ["device0"],
+        )
+        _, items = self.count_queries("/api/v-beta/nodes/")
+        self.assertEqual(len(items[0]["sensors"]), 3)
+        self.assertEqual(items[0]["sensors"][2]["capabilities"], ["gpu"])
+
+
+class ManifestStreamingTest(TestCase):
+    def setUp(self):
+        for i in range(5):
+            NodeData.objects.create(vsn=f"W{i:03d}", name=f"node{i}", phase="Deployed")
+
+    def test_stream_json(self):
+        r = self.client.get("/manifests/")
+        self.assertFalse(r.streaming)
+
+        for url in ["/manifests/?stream=1", "/manifests/?stream=1&fields=vsn,phase"]:
+            r_stream = self.client.get(url)
+            self.assertEqual(r_stream.status_code, 200)
+            self.assertTrue(r_stream.streaming)
+            self.assertEqual(r_stream["Content-Type"], "application/json")
+            content = b"".join(r_stream.streaming_content)
+            self.assertEqual([item["vsn"] for item in json.loads(content)], [f"W{i:03d}" for i in range(5)])
+
+        r_stream = self.client.get("/manifests/?stream=1")
+        self.assertEqual(b"".join(r_stream.streaming_content), r.content)
+
+    def test_stream_ndjson(self):
+        for r in [
+            self.client.get("/manifests/", HTTP_ACCEPT="application/x-ndjson"),
+            self.client.get("/manifests/?format=ndjson"),
+        ]:
+            self.assertEqual(r.status_code, 200)
+            self.assertTrue(r.streaming)
+            self.assertEqual(r["Content-Type"], "application/x-ndjson")
+            lines = b"".join(r.streaming_content).splitlines()
+            self.assertEqual([json.loads(line)["vsn"] for line in lines], [f"W{i:03d}" for i in range(5)])
+
+        r = self.client.get("/manifests/W001/", HTTP_ACCEPT="application/x-ndjson")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.content)["vsn"], "W001")
+
+        r = self.client.get("/manifests/?page_size=2", HTTP_ACCEPT="application/x-ndjson")
+        self.assertFalse(r.streaming)
+        self.assertEqual(len(r.content.splitlines()), 1)
+
+    def test_stream_chunks(self):
+        with patch.object(ManifestViewSet, "stream_chunk_size", 2):
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.get("/manifests/?stream=1&fields=vsn,tags")
+                items = json.loads(b"".join(r.streaming_content))
+        self.assertEqual(len(items), 5)
+        # tags are prefetched once for each of the 3 chunks
+        self.assertEqual(
+            len([q for q in ctx.captured_queries if "manifests_tag" in q["sql"]]), 3
+        )
+
+    def test_stream_fields_parsed_once(self):
+        with patch.object(
+            ManifestViewSet,
+            "parse_requested_fields",
+            autospec=True,
+            side_effect=ManifestViewSet.parse_requested_fields,
+        ) as parse:
+            r = self.client.get("/manifests/?stream=1&fields=vsn,tags")
+            items = json.loads(b"".join(r.streaming_content))
+        self.assertEqual(len(items), 5)
+        self.assertEqual(parse.call_count, 1)
+
+
 class NodeBuildsTest(TestCase):
     def test_list(self):
         project = NodeBuildProject.objects.create(name="Test")
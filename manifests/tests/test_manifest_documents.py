@@ -0,0 +1,384 @@
+import json
+from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from unittest.mock import patch
+from manifests.documents import (
+    DOCUMENT_VERSION,
+    batch_rebuild,
+    get_manifest_queryset,
+    rebuild_manifest_documents,
+    render_manifest,
+)
+from manifests.models import *
+from manifests.serializers import ManifestSerializer
+
+
+class ManifestDocumentTest(TestCase):
+    def setUp(self):
+        self.node = NodeData.objects.create(vsn="W001", name="node1")
+        self.other = NodeData.objects.create(vsn="W002", name="node2")
+        self.hardware = ComputeHardware.objects.create(hardware="nx1", hw_model="NX")
+        self.compute = Compute.objects.create(
+            node=self.node, hardware=self.hardware, name="nxcore"
+        )
+
+    def get_document(self, node):
+        return json.loads(ManifestDocument.objects.get(node=node).document)
+
+    def assertDocumentsUpToDate(self):
+        for node in get_manifest_queryset():
+            self.assertEqual(
+                ManifestDocument.objects.get(node=node).document,
+                render_manifest(node).decode(),
+                node.vsn,
+            )
+
+    def test_served_from_documents(self):
+        with CaptureQueriesContext(connection) as ctx:
+            r = self.client.get("/manifests/")
+        self.assertEqual(r.status_code, 200)
+        # revision lookup and documents
+        self.assertEqual(len(ctx), 2)
+        self.assertEqual([item["vsn"] for item in r.json()], ["W001", "W002"])
+
+        # documents are rendered exactly as the serializer would render them
+        r_sparse = self.client.get(
+            "/manifests/?fields=" + ",".join(ManifestSerializer.Meta.fields)
+        )
+        self.assertEqual(r.content, r_sparse.content)
+
+        r = self.client.get("/manifests/W001/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["computes"][0]["name"], "nxcore")
+
+        r = self.client.get("/manifests/W003/")
+        self.assertEqual(r.status_code, 404)
+
+    def test_related_changes(self):
+        sensor_hardware = SensorHardware.objects.create(
+            hardware="bme680", hw_model="BME680"
+        )
+        sensor = ComputeSensor.objects.create(
+            scope=self.compute, hardware=sensor_hardware, name="bme680"
+        )
+        self.assertEqual(self.get_document(self.node)["sensors"][0]["name"], "bme680")
+
+        capability = Capability.objects.create(capability="gpu")
+        self.hardware.capabilities.add(capability)
+        self.assertEqual(
+            self.get_document(self.node)["computes"][0]["hardware"]["capabilities"],
+            ["gpu"],
+        )
+
+        capability.capability = "cuda"
+        capability.save()
+        self.assertEqual(
+            self.get_document(self.node)["computes"][0]["hardware"]["capabilities"],
+            ["cuda"],
+        )
+
+        label = Label.objects.create(label="outdoor")
+        label.computesensor_set.add(sensor)
+        self.assertEqual(
+            self.get_document(self.node)["sensors"][0]["labels"], ["outdoor"]
+        )
+        label.computesensor_set.clear()
+        self.assertEqual(self.get_document(self.node)["sensors"][0]["labels"], [])
+
+        tag = Tag.objects.create(tag="t1")
+        self.other.tags.add(tag)
+        self.assertEqual(self.get_document(self.other)["tags"], ["t1"])
+        tag.delete()
+        self.assertEqual(self.get_document(self.other)["tags"], [])
+
+        project = NodeBuildProject.objects.create(name="SAGE")
+        self.node.project = project
+        self.node.save()
+        project.name = "Sage"
+        project.save()
+        self.assertEqual(self.get_document(self.node)["project"], "Sage")
+
+        self.hardware.delete()
+        self.assertEqual(self.get_document(self.node)["computes"], [])
+        self.assertEqual(self.get_document(self.node)["sensors"], [])
+
+        self.assertDocumentsUpToDate()
+
+    def test_moved_rows(self):
+        modem = Modem.objects.create(node=self.node, imei="111")
+        sensor_hardware = SensorHardware.objects.create(hardware="bme680")
+        other_compute = Compute.objects.create(
+            node=self.other, hardware=self.hardware, name="rpi"
+        )
+        sensor = ComputeSensor.objects.create(
+            scope=self.compute, hardware=sensor_hardware, name="bme680"
+        )
+        resource = Resource.objects.create(
+            node=self.node,
+            hardware=ResourceHardware.objects.create(hardware="switch"),
+            name="switch",
+        )
+        since = ManifestChange.objects.order_by("-id").values_list("id", flat=True)[0]
+
+        sensor.scope = other_compute
+        sensor.save()
+        self.assertEqual(self.get_document(self.node)["sensors"], [])
+
+        for row in [modem, self.compute, resource]:
+            row.node = self.other
+            row.save()
+
+        # rows loaded without the node field are moved too
+        resource = Resource.objects.only("name").get(pk=resource.pk)
+        resource.node = self.node
+        resource.save()
+
+        r = self.client.get(f"/manifests/{self.node.vsn}/")
+        self.assertIsNone(r.json()["modem"])
+        self.assertEqual(r.json()["computes"], [])
+        self.assertEqual([r["name"] for r in r.json()["resources"]], ["switch"])
+        self.assertEqual(
+            sorted(c["name"] for c in self.get_document(self.other)["computes"]),
+            ["nxcore", "rpi"],
+        )
+        self.assertEqual(
+            set(
+                ManifestChange.objects.filter(id__gt=since).values_list(
+                    "vsn", flat=True
+                )
+            ),
+            {"W001", "W002"},
+        )
+        self.assertDocumentsUpToDate()
+
+    def test_queryset_updates(self):
+        revision = self.client.get("/manifests/")["ETag"]
+        Compute.objects.filter(pk=self.compute.pk).update(name="rpi")
+        self.assertEqual(self.get_document(self.node)["computes"][0]["name"], "rpi")
+        self.assertNotEqual(self.client.get("/manifests/")["ETag"], revision)
+
+        # rows moved by an update are removed from the old node's document
+        Compute.objects.filter(node=self.node).update(node=self.other)
+        self.assertEqual(self.get_document(self.node)["computes"], [])
+        self.assertEqual(self.get_document(self.other)["computes"][0]["name"], "rpi")
+
+        # updates matching no rows send no signals
+        with CaptureQueriesContext(connection) as ctx:
+            Compute.objects.filter(node=self.node).update(name="nx")
+        self.assertEqual(len(ctx), 1)
+        self.assertDocumentsUpToDate()
+
+    def test_node_delete(self):
+        self.node.delete()
+        self.assertFalse(ManifestDocument.objects.filter(node_id=self.node.pk).exists())
+        self.assertEqual(ManifestDocument.objects.count(), 1)
+
+    def test_batch_rebuild(self):
+        with CaptureQueriesContext(connection) as ctx:
+            with batch_rebuild():
+                for i in range(5):
+                    Resource.objects.create(
+                        node=self.node,
+                        hardware=ResourceHardware.objects.create(hardware=f"r{i}"),
+                        name=f"r{i}",
+                    )
+                # documents are only rebuilt on exit
+                self.assertEqual(self.get_document(self.node)["resources"], [])
+        self.assertEqual(len(self.get_document(self.node)["resources"]), 5)
+        self.assertLess(
+            len([q for q in ctx.captured_queries if "manifestdocument" in q["sql"]]), 5
+        )
+
+    def test_missing_documents_are_built(self):
+        ManifestDocument.objects.all().delete()
+        r = self.client.get("/manifests/")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json()), 2)
+        self.assertEqual(ManifestDocument.objects.count(), 2)
+
+    def test_outdated_documents_are_rebuilt(self):
+        changes = ManifestChange.objects.count()
+        # documents rendered by an older serializer
+        ManifestDocument.objects.filter(node=self.node).update(
+            document=json.dumps({"vsn": "W001"}), version=DOCUMENT_VERSION - 1
+        )
+        r = self.client.get("/manifests/W001/")
+        self.assertEqual(r.json()["computes"][0]["name"], "nxcore")
+        self.assertEqual(
+            ManifestDocument.objects.get(node=self.node).version, DOCUMENT_VERSION
+        )
+        self.assertDocumentsUpToDate()
+        self.assertEqual(ManifestChange.objects.count(), changes + 1)
+
+        # documents whose content is unchanged by a new version are not changes
+        with patch("manifests.documents.DOCUMENT_VERSION", DOCUMENT_VERSION + 1):
+            r = self.client.get("/manifests/")
+            self.assertEqual(len(r.json()), 2)
+            self.assertEqual(
+                set(ManifestDocument.objects.values_list("version", flat=True)),
+                {DOCUMENT_VERSION + 1},
+            )
+        self.assertEqual(ManifestChange.objects.count(), changes + 1)
+
+    def test_build_command(self):
+        ManifestDocument.objects.filter(node=self.other).delete()
+        out = StringIO()
+        call_command("build_manifest_documents", stdout=out)
+        self.assertIn("Built manifest documents for 1 node(s).", out.getvalue())
+        self.assertDocumentsUpToDate()
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get("/manifests/")
+        # revision lookup and documents
+        self.assertEqual(len(ctx), 2)
+
+    def test_failed_renders_are_changed_once(self):
+        revision = ManifestChange.objects.count()
+        with patch("manifests.documents.render_manifest", side_effect=ValueError):
+            rebuild_manifest_documents([self.node.pk])
+            self.assertFalse(ManifestDocument.objects.filter(node=self.node).exists())
+            self.assertEqual(ManifestChange.objects.count(), revision + 1)
+
+            # the node is still left without a document, which isn't another change
+            rebuild_manifest_documents([self.node.pk])
+            self.assertEqual(ManifestChange.objects.count(), revision + 1)
+
+        # unchanged documents aren't changes either
+        rebuild_manifest_documents()
+        self.assertEqual(ManifestChange.objects.count(), revision + 2)
+        rebuild_manifest_documents()
+        self.assertEqual(ManifestChange.objects.count(), revision + 2)
+
+    def test_verify_command(self):
+        out = StringIO()
+        call_command("verify_manifest_documents", stdout=out)
+        self.assertIn("up to date", out.getvalue())
+
+        Compute.objects.filter(pk=self.compute.pk).update(name="rpi")
+        self.assertEqual(self.get_document(self.node)["computes"][0]["name"], "rpi")
+
+        # documents changed outside of the signal handlers drift
+        document = self.get_document(self.node)
+        document["computes"][0]["name"] = "nxcore"
+        ManifestDocument.objects.filter(node=self.node).update(
+            document=json.dumps(document)
+        )
+
+        with self.assertRaises(CommandError):
+            call_command("verify_manifest_documents", stdout=StringIO())
+
+        out = StringIO()
+        call_command("verify_manifest_documents", "--fix", stdout=out)
+        self.assertIn("W001: stale document", out.getvalue())
+        self.assertEqual(self.get_document(self.node)["computes"][0]["name"], "rpi")
+
+
+class ManifestChangesTest(TestCase):
+    def setUp(self):
+        self.hardware = ComputeHardware.objects.create(hardware="nx1")
+        for vsn in ["W001", "W002", "W003"]:
+            NodeData.objects.create(vsn=vsn, name=vsn.lower())
+
+    def get_changes(self, since):
+        r = self.client.get(f"/manifests/changes/?since={since}")
+        self.assertEqual(r.status_code, 200)
+        data = r.json()
+        self.assertEqual(r["X-Revision"], str(data["revision"]))
+        return data
+
+    def test_changes(self):
+        data = self.get_changes(0)
+        self.assertEqual([m["vsn"] for m in data["changed"]], ["W001", "W002", "W003"])
+        self.assertEqual(data["removed"], [])
+        revision = data["revision"]
+
+        self.assertEqual(
+            self.get_changes(revision),
+            {"revision": revision, "changed": [], "removed": []},
+        )
+
+        node = NodeData.objects.get(vsn="W002")
+        Compute.objects.create(node=node, hardware=self.hardware, name="nxcore")
+        NodeData.objects.get(vsn="W003").delete()
+        NodeData.objects.create(vsn="W004")
+
+        data = self.get_changes(revision)
+        self.assertEqual([m["vsn"] for m in data["changed"]], ["W002", "W004"])
+        self.assertEqual(data["changed"][0]["computes"][0]["name"], "nxcore")
+        self.assertEqual(data["removed"], ["W003"])
+        revision = data["revision"]
+
+        # saves which don't change the document are not logged
+        NodeData.objects.get(vsn="W001").save()
+        self.assertEqual(self.get_changes(revision)["changed"], [])
+
+        # renaming a node removes the old vsn
+        node.vsn = "W005"
+        node.save()
+        data = self.get_changes(revision)
+        self.assertEqual([m["vsn"] for m in data["changed"]], ["W005"])
+        self.assertEqual(data["removed"], ["W002"])
+
+    def test_invalid_since(self):
+        revision = self.get_changes(0)["revision"]
+        for since in ["", "abc", "-1", str(revision + 1)]:
+            r = self.client.get(f"/manifests/changes/?since={since}")
+            self.assertEqual(r.status_code, 400, since)
+            self.assertIn("since", r.json())
+
+        r = self.client.get("/manifests/changes/")
+        self.assertEqual(r.status_code, 400)
+
+    def test_poll_queries(self):
+        revision = self.get_changes(0)["revision"]
+        NodeData.objects.create(vsn="W004")
+        with CaptureQueriesContext(connection) as ctx:
+            self.get_changes(revision)
+        # revision, changes and documents
+        self.assertEqual(len(ctx), 3)
+
+    def test_changes_of_a_rebuild_share_a_revision(self):
+        revision = self.get_changes(0)["revision"]
+        with batch_rebuild():
+            NodeData.objects.create(vsn="W004")
+            NodeData.objects.get(vsn="W001").delete()
+        self.assertEqual(
+            list(
+                ManifestChange.objects.filter(revision__gt=revision).values_list(
+                    "revision", "vsn", "removed"
+                )
+            ),
+            [(revision + 1, "W001", True), (revision + 1, "W004", False)],
+        )
+        self.assertEqual(self.get_changes(revision)["revision"], revision + 1)
+
+    def test_prune_command(self):
+        revision = self.get_changes(0)["revision"]
+        ManifestChange.objects.update(created_at=timezone.now() - timedelta(days=31))
+        NodeData.objects.create(vsn="W004")
+
+        out = StringIO()
+        call_command("prune_manifest_changes", "--days", "30", stdout=out)
+        self.assertIn(f"up to revision {revision}.", out.getvalue())
+        self.assertEqual(
+            list(ManifestChange.objects.values_list("vsn", flat=True)), ["W004"]
+        )
+
+        # clients which polled before the pruned changes must fetch everything again
+        r = self.client.get(f"/manifests/changes/?since={revision - 1}")
+        self.assertEqual(r.status_code, 400)
+        self.assertIn("pruned", r.json()["since"])
+        self.assertEqual(
+            [m["vsn"] for m in self.get_changes(revision)["changed"]], ["W004"]
+        )
+        self.assertEqual(len(self.get_changes(0)["changed"]), 4)
+
+        out = StringIO()
+        call_command("prune_manifest_changes", stdout=out)
+        self.assertIn("No manifest changes to delete.", out.getvalue())
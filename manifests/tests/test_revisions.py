@@ -0,0 +1,76 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from manifests.models import *
+from manifests.revisions import get_revision
+
+
+class ConditionalRequestsTest(TestCase):
+    urls = [
+        "/manifests/",
+        "/manifests/W001/",
+        "/api/v-beta/nodes/",
+        "/api/v-beta/nodes/W001/",
+        "/sensors/",
+        "/node-builds/",
+    ]
+
+    def setUp(self):
+        self.node = NodeData.objects.create(vsn="W001", name="node1")
+        NodeBuild.objects.create(vsn="W001")
+        SensorHardware.objects.create(hardware="bme680", hw_model="BME680")
+
+    def test_not_modified(self):
+        for url in self.urls:
+            r = self.client.get(url)
+            self.assertEqual(r.status_code, 200, url)
+            etag = r["ETag"]
+            self.assertTrue(etag.startswith('"'), url)
+            self.assertIn("Last-Modified", r)
+
+            # hits only look up the revision
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(r.status_code, 304, url)
+            self.assertEqual(r.content, b"")
+            self.assertEqual(r["ETag"], etag)
+            self.assertEqual(len(ctx), 1, url)
+
+            r = self.client.get(url, HTTP_IF_MODIFIED_SINCE=r["Last-Modified"])
+            self.assertEqual(r.status_code, 304, url)
+
+    def test_etag_varies(self):
+        etag = self.client.get("/manifests/")["ETag"]
+        self.assertNotEqual(self.client.get("/manifests/?project=sage")["ETag"], etag)
+        self.assertNotEqual(self.client.get("/api/v-beta/nodes/")["ETag"], etag)
+
+        # browsable api pages are not cached
+        r = self.client.get("/manifests/", HTTP_ACCEPT="text/html")
+        self.assertNotIn("ETag", r)
+
+    def test_changes_invalidate(self):
+        changes = [
+            lambda: Compute.objects.create(
+                node=self.node,
+                hardware=ComputeHardware.objects.create(hardware="nx1"),
+                name="nxcore",
+            ),
+            lambda: self.node.tags.add(Tag.objects.create(tag="t1")),
+            lambda: self.node.tags.clear(),
+            lambda: NodeBuild.objects.filter(vsn="W001").delete(),
+            lambda: SensorHardware.objects.filter(hardware="bme680").delete(),
+        ]
+
+        for change in changes:
+            etags = {url: self.client.get(url)["ETag"] for url in self.urls}
+            revision, _ = get_revision()
+            change()
+            self.assertGreater(get_revision()[0], revision)
+            for url, etag in etags.items():
+                r = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(r.status_code, 200, url)
+
+    def test_untracked_changes(self):
+        revision = get_revision()
+        ManifestDocument.objects.all().delete()
+        self.assertEqual(get_revision(), revision)
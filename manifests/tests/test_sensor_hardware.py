@@ -1,4 +1,6 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from manifests.models import *
 from node_auth import get_node_token_model, get_node_model, get_node_token_keyword
 from django.contrib.auth import get_user_model
@@ -167,6 +169,39 @@ class SensorHardwareViewsTest(TestCase):
         item = r.json()
         self.assertEqual(len(item["vsns"]), 0)
 
+    def test_lorawan_constant_queries(self):
+        """Test the number of queries for listing sensors doesn't grow with lorawan devices"""
+        project = NodeBuildProject.objects.create(name="ProjA")
+        node = NodeData.objects.create(
+            vsn="A123", name="A_name", project=project, phase="Deployed"
+        )
+        hardware = SensorHardware.objects.create(hardware="lorawan_temp", hw_model="temp")
+
+        def create_devices(start, end):
+            for i in range(start, end):
+                ld = LorawanDevice.objects.create(deveui=f"{i:016x}", hardware=hardware)
+                LorawanConnection.objects.create(
+                    node=node, connection_type="OTAA", lorawan_device=ld
+                )
+
+        def count_queries(url):
+            with CaptureQueriesContext(connection) as ctx:
+                r = self.client.get(url)
+            self.assertEqual(r.status_code, 200)
+            return len(ctx)
+
+        urls = ["/sensors/", "/sensors/?project=proja&phase=deployed"]
+
+        create_devices(0, 2)
+        small = [count_queries(url) for url in urls]
+
+        create_devices(2, 50)
+        self.assertEqual([count_queries(url) for url in urls], small)
+
+        r = self.client.get("/sensors/lorawan_temp/?project=proja")
+        self.assertEqual(r.json()["vsns"], ["A123"])
+
+
 class SensorHardwareNodeCRUDViewSetTest(TestCase):
     def setUp(self):
         # Create an admin user
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import *
-from django.http import Http404
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.core.exceptions import ObjectDoesNotExist
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAdminUser
 from rest_framework.viewsets import ReadOnlyModelViewSet, ModelViewSet
 from .models import *
@@ -13,9 +14,12 @@ from .serializers import (
     LorawanConnectionSerializer,
     LorawanKeysSerializer,
     SensorHardwareCRUDSerializer,
-    NodesSerializer
+    NodesSerializer,
+    prefetch_active_lorawan_connections,
 )
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework import status
 from django.db import IntegrityError
 from node_auth.mixins import NodeAuthMixin, NodeOwnedObjectsMixin
@@ -23,32 +27,31 @@ from app.authentication import TokenAuthentication as UserTokenAuthentication
 from rest_framework.serializers import ValidationError
 from django_filters.rest_framework import DjangoFilterBackend
 from django_filters import FilterSet, CharFilter
-from django.db.models import Q
+from django.db.models import Q, Prefetch
+from .documents import (
+    MANIFEST_PREFETCH_FIELDS,
+    get_change_revision,
+    get_changes_since,
+    get_manifest_documents,
+    iter_manifest_documents,
+)
+from .mixins import SparseFieldsMixin, RevisionConditionalMixin
+from .pagination import OptInCursorPagination
+from .renderers import NDJSONRenderer
 
 
-class ManifestViewSet(ReadOnlyModelViewSet):
+class ManifestViewSet(RevisionConditionalMixin, SparseFieldsMixin, ReadOnlyModelViewSet):
+    queryset = NodeData.objects.all().order_by("vsn")
     serializer_class = ManifestSerializer
     lookup_field = "vsn"
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = OptInCursorPagination
+    prefetch_fields = MANIFEST_PREFETCH_FIELDS
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer]
+    stream_chunk_size = 100
 
     def get_queryset(self):
-        queryset = (
-            NodeData.objects.all()
-            .prefetch_related(
-                "project",
-                "modem",
-                "compute_set__hardware__capabilities",
-                "nodesensor_set__hardware__capabilities",
-                "nodesensor_set__labels",
-                "compute_set__computesensor_set__scope",
-                "compute_set__computesensor_set__hardware__capabilities",
-                "compute_set__computesensor_set__labels",
-                "resource_set__hardware__capabilities",
-                "lorawanconnections__lorawan_device__hardware__capabilities",
-                "tags",
-            )
-            .order_by("vsn")
-        )
+        queryset = super().get_queryset().prefetch_related(*self.get_prefetch_lookups())
 
         project = self.request.query_params.get("project")
         if project:
@@ -56,40 +59,193 @@ class ManifestViewSet(ReadOnlyModelViewSet):
 
         return queryset
 
+    def use_documents(self):
+        """
+        Full JSON manifests are served from the precomputed documents. Field selection,
+        pagination and the browsable API go through the serializer.
+        """
+        return (
+            isinstance(self.request.accepted_renderer, JSONRenderer)
+            and self.get_requested_fields() is None
+            and not self.paginator.is_requested(self.request)
+        )
 
-class ComputeViewSet(ReadOnlyModelViewSet):
-    queryset = (
-        Compute.objects.all()
-        .prefetch_related(
-            "hardware",
-            "node",
+    def use_streaming(self):
+        """
+        Lists are streamed when requested as ndjson or with ?stream=1, so memory use doesn't grow
+        with the number of nodes. Paginated lists are already bounded and are not streamed.
+        """
+        request = self.request
+        return (
+            isinstance(request.accepted_renderer, JSONRenderer)
+            and not self.paginator.is_requested(request)
+            and (
+                isinstance(request.accepted_renderer, NDJSONRenderer)
+                or request.query_params.get("stream") in ("1", "true")
+            )
         )
-        .order_by("node__vsn")
-    )
+
+    def iter_rendered(self):
+        """
+        Yields each node's rendered manifest, loading stream_chunk_size nodes at a time.
+        """
+        queryset = self.get_queryset()
+
+        if self.get_requested_fields() is None:
+            documents = iter_manifest_documents(
+                queryset.prefetch_related(None), chunk_size=self.stream_chunk_size
+            )
+            for _, document in documents:
+                yield document
+            return
+
+        # prefetches are applied per chunk when iterating with a chunk_size
+        for node in queryset.iterator(chunk_size=self.stream_chunk_size):
+            yield JSONRenderer().render(self.get_serializer(node).data)
+
+    def stream_list(self):
+        if isinstance(self.request.accepted_renderer, NDJSONRenderer):
+            for item in self.iter_rendered():
+                yield item + b"\n"
+            return
+
+        yield b"["
+        for i, item in enumerate(self.iter_rendered()):
+            yield item if i == 0 else b"," + item
+        yield b"]"
+
+    def list(self, request, *args, **kwargs):
+        streaming = self.use_streaming()
+        if not (streaming or self.use_documents()):
+            return super().list(request, *args, **kwargs)
+        not_modified = self.get_not_modified_response()
+        if not_modified is not None:
+            return not_modified
+        if streaming:
+            return StreamingHttpResponse(
+                self.stream_list(), content_type=request.accepted_renderer.media_type
+            )
+        documents = get_manifest_documents(self.get_queryset().prefetch_related(None))
+        content = b"[" + b",".join(document for _, document in documents) + b"]"
+        return HttpResponse(content, content_type="application/json")
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.use_documents():
+            return super().retrieve(request, *args, **kwargs)
+        not_modified = self.get_not_modified_response()
+        if not_modified is not None:
+            return not_modified
+        documents = get_manifest_documents(
+            self.get_queryset().prefetch_related(None).filter(vsn=kwargs["vsn"])
+        )
+        if not documents:
+            raise Http404
+        content = documents[0][1]
+        if isinstance(request.accepted_renderer, NDJSONRenderer):
+            content += b"\n"
+        return HttpResponse(content, content_type=request.accepted_renderer.media_type)
+
+    @action(detail=False)
+    def changes(self, request):
+        """
+        Returns the manifests which changed and the vsns which were removed after the revision
+        given by ?since=. Clients start with since=0, which returns every manifest, and then pass
+        the returned revision on their next poll. Clients whose revision is older than the pruned
+        changes must start over with since=0.
+        """
+        revision, pruned_revision = get_change_revision()
+
+        try:
+            since = int(request.query_params["since"])
+        except KeyError:
+            return Response(
+                {"since": "this parameter is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        except ValueError:
+            return Response(
+                {"since": "must be an integer revision"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if since < 0 or since > revision:
+            return Response(
+                {"since": "unknown revision, use since=0 to fetch all manifests"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if 0 < since < pruned_revision:
+            return Response(
+                {"since": "revision has been pruned, use since=0 to fetch all manifests"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if since == 0:
+            nodes, removed = NodeData.objects.all(), []
+        else:
+            changed, removed = get_changes_since(since, revision)
+            nodes = NodeData.objects.filter(vsn__in=changed)
+
+        documents = get_manifest_documents(nodes)
+
+        content = b"".join(
+            [
+                b'{"revision":%d,"changed":[' % revision,
+                b",".join(document for _, document in documents),
+                b'],"removed":',
+                JSONRenderer().render(removed),
+                b"}",
+            ]
+        )
+        response = HttpResponse(content, content_type="application/json")
+        response["X-Revision"] = str(revision)
+        return response
+
+
+class ComputeViewSet(SparseFieldsMixin, ReadOnlyModelViewSet):
+    queryset = Compute.objects.all().order_by("node__vsn")
     serializer_class = ComputeSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = OptInCursorPagination
+    cursor_ordering = ("node__vsn", "name")
+    prefetch_fields = {
+        "node": ["node"],
+        "hardware": ["hardware"],
+    }
 
+    def get_queryset(self):
+        return super().get_queryset().prefetch_related(*self.get_prefetch_lookups())
 
-class SensorHardwareViewSet(ReadOnlyModelViewSet):
-    queryset = (
-        SensorHardware.objects.all()
-        .prefetch_related(
-            "nodesensor_set__node",
-            "computesensor_set__scope__node",
-            "capabilities",
-            "lorawandevice_set__lorawanconnections__node",
-        )
-        .order_by("hardware")
-    )
+
+class SensorHardwareViewSet(
+    RevisionConditionalMixin, SparseFieldsMixin, ReadOnlyModelViewSet
+):
+    queryset = SensorHardware.objects.all().order_by("hardware")
     serializer_class = SensorViewSerializer
     lookup_field = "hardware"
     permission_classes = [IsAuthenticatedOrReadOnly]
+    pagination_class = OptInCursorPagination
+    cursor_ordering = "hardware"
+    prefetch_fields = {
+        "capabilities": ["capabilities"],
+        "vsns": [
+            "nodesensor_set__node",
+            "computesensor_set__scope__node",
+            Prefetch(
+                "lorawandevice_set__lorawanconnections",
+                queryset=LorawanConnection.objects.filter(is_active=True)
+                .select_related("node__project")
+                .order_by("pk"),
+                to_attr="active_lorawanconnections",
+            ),
+        ],
+    }
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        if self.request.query_params.get("project"):
+        queryset = super().get_queryset().prefetch_related(*self.get_prefetch_lookups())
+        fields = self.get_requested_fields()
+        if self.request.query_params.get("project") and (
+            fields is None or "vsns" in fields
+        ):
             queryset = queryset.prefetch_related(
-                "lorawandevice_set__lorawanconnections__node__project",
                 "computesensor_set__scope__node__project",
                 "nodesensor_set__node__project",
             )
@@ -100,8 +256,13 @@ class SensorHardwareViewSet(ReadOnlyModelViewSet):
 
         # if filtering, ignore sensors which aren't connected to nodes
         q = request.query_params
-        if q.get("project") or q.get("phase"):
-            res.data = filter(lambda o: len(o["vsns"]), res.data)
+        fields = self.get_requested_fields()
+        if (q.get("project") or q.get("phase")) and (fields is None or "vsns" in fields):
+            # paginated responses wrap the items in results
+            if isinstance(res.data, dict):
+                res.data["results"] = [o for o in res.data["results"] if len(o["vsns"])]
+            else:
+                res.data = [o for o in res.data if len(o["vsns"])]
 
         return res
 
@@ -117,7 +278,7 @@ class SensorHardwareViewSet_CRUD(NodeAuthMixin, ModelViewSet):
     authentication_classes = (NodeAuthMixin.authentication_classes[0],UserTokenAuthentication)
     permission_classes = (NodeAuthMixin.permission_classes[0]|IsAdminUser,)    
 
-class NodeBuildViewSet(ReadOnlyModelViewSet):
+class NodeBuildViewSet(RevisionConditionalMixin, ReadOnlyModelViewSet):
     queryset = (
         NodeBuild.objects.all()
         .prefetch_related(
@@ -237,22 +398,28 @@ class NodesFilter(FilterSet):
         model = NodeData
         fields = ['project__name', 'phase']
 
-class NodesViewSet(ReadOnlyModelViewSet):
-    queryset = (
-        NodeData.objects.all()
-        .prefetch_related(
-            "modem",
-            "lorawanconnections__lorawan_device__hardware__capabilities",
-            "compute_set__hardware__capabilities",
-            "nodesensor_set__hardware__capabilities",
-            "compute_set__computesensor_set__hardware__capabilities",
-            "project",
-        )
-        .order_by("vsn")
-    )
+class NodesViewSet(RevisionConditionalMixin, SparseFieldsMixin, ReadOnlyModelViewSet):
+    queryset = NodeData.objects.all().order_by("vsn")
     lookup_field = "vsn"
     serializer_class = NodesSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_class = NodesFilter
+    pagination_class = OptInCursorPagination
+    prefetch_fields = {
+        "project": ["project"],
+        "modem_sim": ["modem"],
+        "modem_model": ["modem"],
+        "modem_carrier": ["modem"],
+        "computes": ["compute_set__hardware__capabilities"],
+        "sensors": [
+            prefetch_active_lorawan_connections(),
+            "compute_set__hardware__capabilities",
+            "nodesensor_set__hardware__capabilities",
+            "compute_set__computesensor_set__hardware__capabilities",
+        ],
+    }
+
+    def get_queryset(self):
+        return super().get_queryset().prefetch_related(*self.get_prefetch_lookups())
     
\ No newline at end of file
@@ -6,6 +6,7 @@ from django.utils.translation import gettext_lazy as _
 from rest_framework import HTTP_HEADER_ENCODING, exceptions
 from .models import Token
 from node_auth import get_node_token_keyword, get_node_token_model
+from node_auth.cache import get_request_token
 
 def get_authorization_header(request):
     """
@@ -72,13 +73,11 @@ class TokenAuthentication(BaseAuthentication):
             )
             raise exceptions.AuthenticationFailed(msg)
 
-        return self.authenticate_credentials(token)
+        return self.authenticate_credentials(token, request)
 
-    def authenticate_credentials(self, key):
-        model = self.model
-        try:
-            token = model.objects.select_related("node").get(key=key)
-        except model.DoesNotExist:
+    def authenticate_credentials(self, key, request=None):
+        token = get_request_token(request, key, self.model)
+        if token is None:
             raise exceptions.AuthenticationFailed(_("Invalid token."))
 
         if not token.node.is_active: 
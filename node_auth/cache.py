@@ -0,0 +1,138 @@
+"""
+In-process cache of node auth tokens, shared by the DRF authenticator and the node middleware.
+
+Entries are bounded in number and expire after a TTL. Tokens and nodes are evicted through
+post_save / post_delete signals (see node_auth.models), but those only fire in the process that
+made the change, so the TTL bounds how long other workers can keep serving a stale entry.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from node_auth import get_node_token_model
+
+
+class TokenCache:
+    """
+    Bounded, TTL-evicting map of token key -> Token (with its node already loaded).
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, token)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the cached Token for key or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, token = entry
+            if expires_at <= self.timer():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return token
+
+    def set(self, key, token):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.timer() + self.ttl, token)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def evict_node(self, node_pk):
+        """
+        Evict every entry belonging to the node with primary key node_pk.
+        """
+        with self._lock:
+            stale = [
+                key
+                for key, (_, token) in self._entries.items()
+                if token.node_id == node_pk
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Return hit/miss counters and the current size of the cache.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+        }
+
+
+token_cache = TokenCache(
+    maxsize=getattr(settings, "NODE_AUTH_TOKEN_CACHE_SIZE", 1024),
+    ttl=getattr(settings, "NODE_AUTH_TOKEN_CACHE_TTL", 60.0),
+)
+
+
+def get_token(key, model=None):
+    """
+    Return the Token with key and its node, using the shared token cache.
+
+    Raises model.DoesNotExist if no such token exists.
+    """
+    token = token_cache.get(key)
+    if token is not None:
+        return token
+    model = model or get_node_token_model()
+    token = model.objects.select_related("node").get(key=key)
+    token_cache.set(key, token)
+    return token
+
+
+def get_request_token(request, key, model=None):
+    """
+    Return the Token for key, resolving it at most once per request, or None if it does not exist.
+
+    The result is memoized on the underlying HttpRequest so the node middleware's lazy
+    request.node and the DRF TokenAuthentication share a single lookup.
+    """
+    if request is not None:
+        # unwrap rest_framework.request.Request so both layers memoize on the same object
+        request = getattr(request, "_request", request)
+        resolved = getattr(request, "_node_auth_token", None)
+        if resolved is not None and resolved[0] == key:
+            return resolved[1]
+
+    model = model or get_node_token_model()
+    try:
+        token = get_token(key, model)
+    except model.DoesNotExist:
+        token = None
+
+    if request is not None:
+        request._node_auth_token = (key, token)
+    return token
@@ -1,6 +1,7 @@
 from django.utils.translation import gettext_lazy as _
 from rest_framework import HTTP_HEADER_ENCODING
 from node_auth import get_node_token_keyword, get_node_token_model
+from node_auth.cache import get_request_token
 from .models import AnonymousNode
 
 def get_node(request):
@@ -25,13 +26,11 @@ def get_node(request):
     except UnicodeError: # pragma: no cover
         return AnonymousNode()
 
-    return authenticate_credentials(token)
+    return authenticate_credentials(token, request)
 
-def authenticate_credentials(key):
-    TOKEN_MODEL = get_node_token_model()
-    try:
-        token = TOKEN_MODEL.objects.select_related("node").get(key=key)
-    except TOKEN_MODEL.DoesNotExist:
+def authenticate_credentials(key, request=None):
+    token = get_request_token(request, key, get_node_token_model())
+    if token is None:
         return AnonymousNode()
 
     if not token.node.is_active: 
@@ -2,7 +2,10 @@ import binascii
 import os
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
+from node_auth.cache import token_cache
 
 class Token(models.Model):
     """
@@ -29,3 +32,17 @@ class Token(models.Model):
 
     def __str__(self):
         return self.key
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def evict_cached_token(sender, instance=None, **kwargs):
+    # a saved token may be a rotated key for the same node, so drop any older keys for it too
+    token_cache.evict(instance.key)
+    token_cache.evict_node(instance.node_id)
+
+
+@receiver(post_save, sender=settings.AUTH_NODE_MODEL)
+@receiver(post_delete, sender=settings.AUTH_NODE_MODEL)
+def evict_cached_node_tokens(sender, instance=None, **kwargs):
+    token_cache.evict_node(instance.pk)
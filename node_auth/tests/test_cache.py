@@ -0,0 +1,119 @@
+from django.test import TestCase
+from rest_framework import exceptions
+from node_auth.authentication import TokenAuthentication
+from node_auth.cache import TokenCache, token_cache
+from node_auth.contrib.auth import authenticate_credentials
+from node_auth.contrib.auth.models import AnonymousNode
+from node_auth import get_node_model, get_node_token_model
+from unittest.mock import Mock
+
+Node = get_node_model()
+Token = get_node_token_model()
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = TokenCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_hit_and_miss_counters(self):
+        """
+        Test that lookups are counted as hits or misses
+        """
+        token = Mock(node_id=1)
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", token)
+        self.assertIs(self.cache.get("a"), token)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_entries_expire_after_ttl(self):
+        """
+        Test that entries are dropped once their ttl has passed
+        """
+        self.cache.set("a", Mock(node_id=1))
+        self.timer.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_cache_is_bounded(self):
+        """
+        Test that the least recently used entry is evicted when the cache is full
+        """
+        self.cache.set("a", Mock(node_id=1))
+        self.cache.set("b", Mock(node_id=2))
+        self.cache.get("a")
+        self.cache.set("c", Mock(node_id=3))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("c"))
+
+    def test_evict_node(self):
+        """
+        Test that evicting a node drops all of its entries
+        """
+        self.cache.set("a", Mock(node_id=1))
+        self.cache.set("b", Mock(node_id=2))
+        self.cache.evict_node(1)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("b"))
+
+
+class TestTokenCacheInvalidation(TestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.node = Node.objects.create(vsn="W001", mac="111")
+        self.token = Token.objects.get(node=self.node)
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def test_lookup_is_shared_across_auth_paths(self):
+        """
+        Test that the drf authenticator and middleware only query the token once between them
+        """
+        with self.assertNumQueries(1):
+            node, _ = TokenAuthentication().authenticate_credentials(self.token.key)
+            self.assertEqual(authenticate_credentials(self.token.key), node)
+        self.assertEqual(token_cache.stats()["hits"], 1)
+
+    def test_node_deactivation_invalidates_cache(self):
+        """
+        Test that deactivating a node takes effect on the next lookup
+        """
+        TokenAuthentication().authenticate_credentials(self.token.key)
+        self.node.is_active = False
+        self.node.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate_credentials(self.token.key)
+        self.assertEqual(authenticate_credentials(self.token.key), AnonymousNode())
+
+    def test_token_delete_invalidates_cache(self):
+        """
+        Test that a deleted token can no longer authenticate
+        """
+        TokenAuthentication().authenticate_credentials(self.token.key)
+        self.token.delete()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate_credentials(self.token.key)
+
+    def test_token_rotation_invalidates_cache(self):
+        """
+        Test that replacing a node's token stops the old key from authenticating
+        """
+        old_key = self.token.key
+        TokenAuthentication().authenticate_credentials(old_key)
+        Token.objects.filter(key=old_key).delete()
+        new_token = Token.objects.create(node=self.node)
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            TokenAuthentication().authenticate_credentials(old_key)
+        node, token = TokenAuthentication().authenticate_credentials(new_token.key)
+        self.assertEqual(node, self.node)
@@ -13,6 +13,9 @@ from manifests.serializers import ManifestSerializer
 from django.urls import reverse
 from node_auth.authentication import TokenAuthentication
 from node_auth import get_node_token_keyword, get_node_token_model, get_node_model
+from node_auth.cache import token_cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from unittest.mock import patch, Mock
 
 Token = get_node_token_model()
@@ -230,6 +233,26 @@ class NodeTokenAuthTests(TestCase):
             "Expected status code 403, Forbidden",
         )
 
+    def test_single_token_lookup_per_request(self):
+        """
+        Test that the node middleware and drf authenticator share one token lookup per request
+        """
+        LorawanDevice.objects.create(deveui="123456789", name="test")
+        self.csrf_client.credentials(HTTP_AUTHORIZATION=self.auth_header)
+        token_table = Token._meta.db_table
+
+        # disable the process wide cache so only the request scoped lookup is exercised
+        token_cache.clear()
+        with patch.object(token_cache, "maxsize", 0):
+            for url in ["/lorawanconnections/", "/lorawandevices/"]:
+                with CaptureQueriesContext(connection) as ctx:
+                    response = self.csrf_client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                token_queries = [
+                    q for q in ctx.captured_queries if token_table in q["sql"]
+                ]
+                self.assertEqual(len(token_queries), 1, url)
+
 
 if __name__ == "__main__":
     unittest.main()
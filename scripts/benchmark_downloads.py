@@ -0,0 +1,132 @@
+"""
+Benchmark of the S3 calls made per download by the downloads app, using a throwaway client per call
+as the app used to versus the process wide pooled client from get_minio_client.
+
+Runs against a local TLS S3 stand-in which answers every stat with a fixed object, so only client
+and connection overhead is measured. Run with:
+
+    python manage.py shell < scripts/benchmark_downloads.py
+"""
+import datetime
+import ipaddress
+import os
+import ssl
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from django.test import override_settings
+import downloads.views
+from downloads.views import Item, get_osn_object_name, get_minio_client
+
+DOWNLOADS = 200
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "1024")
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("ETag", '"d41d8cd98f00b204e9800998ecf8427e"')
+        self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_self_signed_cert(dir):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(hours=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(dir, "cert.pem")
+    key_path = os.path.join(dir, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
+
+
+def download(get_client, item):
+    # a GET stats the object then presigns its url, each with a client from get_client
+    object_name = get_osn_object_name(item)
+    get_client().stat_object(bucket_name="bench", object_name=object_name)
+    get_client().get_presigned_url(
+        method="GET",
+        bucket_name="bench",
+        object_name=object_name,
+        expires=datetime.timedelta(seconds=60),
+    )
+
+
+def measure(get_client):
+    item = Item("job", "task", "000048b02d15bc7c", "1700000000000000000-sample.jpg")
+    download(get_client, item)  # warm up
+    latencies = []
+    for _ in range(DOWNLOADS):
+        start = time.perf_counter()
+        download(get_client, item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies) * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{name:>10}: p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+
+
+with tempfile.TemporaryDirectory() as dir:
+    cert_path, key_path = write_self_signed_cert(dir)
+    os.environ["SSL_CERT_FILE"] = cert_path
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with override_settings(
+        S3_ENDPOINT=f"127.0.0.1:{server.server_address[1]}",
+        S3_ACCESS_KEY="bench",
+        S3_SECRET_KEY="bench",
+        S3_REGION="us-east-1",
+        S3_SECURE=True,
+    ):
+        print(f"{DOWNLOADS} downloads against {downloads.views.settings.S3_ENDPOINT}")
+        report("per call", measure(downloads.views.new_minio_client))
+        report("pooled", measure(get_minio_client))
+
+    server.shutdown()
@@ -0,0 +1,42 @@
+"""
+Micro-benchmark of single core presigning throughput for OSN download URLs, using Minio's
+get_presigned_url (with a region configured, so no location lookup) versus the local Presigner.
+Run with:
+
+    python manage.py shell < scripts/benchmark_presign.py
+"""
+import time
+from datetime import timedelta
+from minio import Minio
+from downloads.signing import Presigner
+
+SECONDS = 2.0
+ENDPOINT = "s3.example.org"
+OBJECT_NAME = "node-data/job/task/000048b02d15bc7c/1700000000000000000-sample.jpg"
+
+
+def measure(presign):
+    presign()  # warm up
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < SECONDS:
+        for _ in range(100):
+            presign()
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+client = Minio(ENDPOINT, "access", "secret", region="us-east-1")
+presigner = Presigner(ENDPOINT, "access", "secret", "us-east-1")
+
+results = {
+    "minio": measure(
+        lambda: client.get_presigned_url(
+            "GET", "bucket", OBJECT_NAME, expires=timedelta(seconds=60)
+        )
+    ),
+    "presigner": measure(lambda: presigner.presign("GET", "bucket", OBJECT_NAME, 60)),
+}
+
+for name, rate in results.items():
+    print(f"{name:>10}: {rate:,.0f} urls/s/core ({1e6 / rate:.1f} us/url)")